@@ -0,0 +1,273 @@
+"""Runs simulated users through the real bot handlers against fake Telegram and completion servers.
+
+Every user sends `--messages` prompts one after another and waits for each answer to be completely shown.
+Reported: time until the first answer text is visible (p50/p99), answers per second, database queries
+per handled update and event loop lag of the bot.
+
+    python3 benchmarks/loadtest/driver.py --users 200 --messages 3 --tokens-per-second 40 --ttft 0.5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import yaml
+from aiohttp import web
+from loguru import logger
+
+from fake_openai import ANSWER_END, FakeOpenAI
+from fake_telegram import FakeTelegram, SentEvent
+
+SRC_DIR = Path(__file__).resolve().parent.parent.parent / "src"
+PLACEHOLDER_TEXT = "..."
+# start of the reply to a prompt sent while the previous one is still being answered
+BUSY_TEXT = "⏳"
+# placeholder text while a completion waits for a free backend slot
+QUEUED_TEXT = "🕐"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class ServerThread:
+    """Runs the fake servers on a loop of their own, so they do not compete with the bot's loop."""
+
+    def __init__(self, apps: list[web.Application]):
+        self.apps = apps
+        self.ports: list[int] = []
+        self.loop = asyncio.new_event_loop()
+        self._runners: list[web.AppRunner] = []
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._setup())
+        self._started.set()
+        self.loop.run_forever()
+
+    async def _setup(self):
+        for app in self.apps:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            self._runners.append(runner)
+            self.ports.append(runner.addresses[0][1])
+
+    async def _cleanup(self):
+        for runner in self._runners:
+            await runner.cleanup()
+
+
+class PendingAnswer:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.sent_at = time.perf_counter()
+        self.first_visible_at = None
+        self.done = loop.create_future()
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.telegram = FakeTelegram(edit_interval=args.flood_interval)
+        self.openai = FakeOpenAI(
+            time_to_first_token=args.ttft,
+            tokens_per_second=args.tokens_per_second,
+            answer_tokens=args.answer_tokens
+        )
+        self.servers = ServerThread([self.telegram.app(), self.openai.app()])
+
+        self.loop: asyncio.AbstractEventLoop = None
+        self.pending: dict[int, PendingAnswer] = {}
+        self.time_to_first_visible: list[float] = []
+        self.time_to_complete: list[float] = []
+        self.loop_lags: list[float] = []
+        self.n_rejected = 0
+
+    def write_config(self, config_dir: Path):
+        telegram_port, openai_port = self.servers.ports
+        config_yaml = {
+            "telegram_token": "123456:load-test",
+            "telegram_api_base_url": f"http://127.0.0.1:{telegram_port}/bot",
+            "hugging_face_as_openai_api_key": "load-test",
+            "openai_api_base": f"http://127.0.0.1:{openai_port}/v1",
+            "allowed_telegram_usernames": [],
+            "new_dialog_timeout": 600,
+            "enable_message_streaming": True,
+            "stream_edit_chat_interval": self.args.edit_interval,
+            "stream_edit_global_rate": self.args.edit_rate,
+            "coordination_backend": self.args.coordination_backend,
+            "completion_max_in_flight": self.args.max_in_flight,
+            "completion_log_sample_rate": self.args.completion_log_sample_rate,
+            "fusion_brain_auth_token": "",
+        }
+        with open(config_dir / "config.yml", "w") as f:
+            yaml.safe_dump(config_yaml, f)
+        with open(config_dir / "config.env", "w") as f:
+            f.write(f"SQLITE_DATABASE_PATH={config_dir / 'sqlite.db'}\n")
+
+    def on_event(self, event: SentEvent):
+        # called on the servers' loop
+        self.loop.call_soon_threadsafe(self._on_event, event)
+
+    def _on_event(self, event: SentEvent):
+        pending = self.pending.get(event.chat_id)
+        if pending is None or event.text == PLACEHOLDER_TEXT or event.text.startswith(QUEUED_TEXT):
+            return
+        if event.text.startswith(BUSY_TEXT):
+            # a late busy reply may arrive after the prompt was already answered
+            if not pending.done.done():
+                self.n_rejected += 1
+                pending.done.set_result(None)
+            return
+        if pending.first_visible_at is None:
+            pending.first_visible_at = event.at
+            self.time_to_first_visible.append(event.at - pending.sent_at)
+        if event.text.rstrip().endswith(ANSWER_END) and not pending.done.done():
+            self.time_to_complete.append(event.at - pending.sent_at)
+            pending.done.set_result(None)
+
+    async def simulate_user(self, chat_id: int):
+        for i in range(self.args.messages):
+            pending = PendingAnswer(self.loop)
+            self.pending[chat_id] = pending
+            self.servers.loop.call_soon_threadsafe(self.telegram.push_update, chat_id, f"Question {i} from {chat_id}")
+            await asyncio.wait_for(pending.done, timeout=self.args.answer_timeout)
+            await asyncio.sleep(self.args.think_time)
+        del self.pending[chat_id]
+
+    async def probe_loop_lag(self, interval: float = 0.01):
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.perf_counter() - started_at - interval)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.telegram.on_event = self.on_event
+
+        import bot
+        import metrics
+
+        application = bot.build_application()
+        await application.initialize()
+        await bot.post_init(application)
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+        await application.start()
+
+        db_queries = metrics.REGISTRY["bot_db_queries_total"]
+        n_queries_before = db_queries.get()
+        lag_probe = asyncio.create_task(self.probe_loop_lag())
+
+        started_at = time.perf_counter()
+        results = await asyncio.gather(
+            *(self.simulate_user(1000 + i) for i in range(self.args.users)), return_exceptions=True
+        )
+        elapsed = time.perf_counter() - started_at
+
+        await bot.db.flush()
+        n_queries = db_queries.get() - n_queries_before
+        lag_probe.cancel()
+
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await bot.post_shutdown(application)
+
+        n_failed = sum(isinstance(result, Exception) for result in results)
+        self.report(elapsed, n_queries, n_failed)
+
+    def report(self, elapsed: float, n_queries: float, n_failed: int):
+        n_updates = self.args.users * self.args.messages
+        n_answers = len(self.time_to_complete)
+        ms = 1000
+
+        print(f"users: {self.args.users}, messages per user: {self.args.messages}, failed users: {n_failed}")
+        print(
+            f"answers: {n_answers} in {elapsed:.2f} s, {n_answers / elapsed:.1f} answers/s, "
+            f"prompts rejected as busy: {self.n_rejected}"
+        )
+        print(
+            f"time to first visible token: p50 {percentile(self.time_to_first_visible, 0.5) * ms:.0f} ms, "
+            f"p99 {percentile(self.time_to_first_visible, 0.99) * ms:.0f} ms "
+            f"(completion backend ttft {self.args.ttft * ms:.0f} ms)"
+        )
+        print(
+            f"time to complete answer: p50 {percentile(self.time_to_complete, 0.5) * ms:.0f} ms, "
+            f"p99 {percentile(self.time_to_complete, 0.99) * ms:.0f} ms"
+        )
+        print(f"db queries per update: {n_queries / n_updates:.1f}")
+        print(
+            f"event loop lag: p50 {percentile(self.loop_lags, 0.5) * ms:.1f} ms, "
+            f"p99 {percentile(self.loop_lags, 0.99) * ms:.1f} ms, "
+            f"max {max(self.loop_lags, default=0.0) * ms:.1f} ms"
+        )
+        print(
+            "telegram requests: "
+            + ", ".join(f"{method} {n}" for method, n in sorted(self.telegram.n_requests.items()))
+            + f", flood errors {self.telegram.n_flood_errors}"
+        )
+        print(f"completion requests: {self.openai.n_requests}, max in flight {self.openai.max_in_flight}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=3, help="prompts sent by every user")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a user waits between prompts")
+    parser.add_argument("--ttft", type=float, default=0.5, help="completion backend time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="completion backend streaming rate")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--edit-interval", type=float, default=1.0, help="stream_edit_chat_interval of the bot")
+    parser.add_argument("--edit-rate", type=float, default=20.0, help="stream_edit_global_rate of the bot")
+    parser.add_argument(
+        "--flood-interval", type=float, default=0.0,
+        help="fake Telegram answers 429 to edits of a chat more frequent than this"
+    )
+    parser.add_argument("--max-in-flight", type=int, default=64, help="completion_max_in_flight of the bot")
+    parser.add_argument(
+        "--completion-log-sample-rate", type=float, default=1.0,
+        help="completion_log_sample_rate of the bot, compare the event loop lag of 1 and 0"
+    )
+    parser.add_argument("--coordination-backend", default="local", choices=("local", "sqlite"))
+    parser.add_argument("--answer-timeout", type=float, default=300.0)
+    parser.add_argument("--log-level", default="WARNING", help="level of the bot's own log written to stderr")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    load_test = LoadTest(args)
+    load_test.servers.start()
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            load_test.write_config(Path(config_dir))
+            os.environ["CHATGPT_BOT_CONFIG_DIR"] = config_dir
+            # the bot resolves its files relative to src, as when started from the Dockerfile
+            os.chdir(SRC_DIR)
+            sys.path.insert(0, str(SRC_DIR / "bot"))
+            asyncio.run(load_test.run())
+    finally:
+        load_test.servers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Stand-in for an OpenAI-compatible chat completion endpoint with a configurable streaming speed."""
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+ANSWER_END = "END."
+
+
+class FakeOpenAI:
+    def __init__(self, time_to_first_token: float = 0.5, tokens_per_second: float = 50.0, answer_tokens: int = 200):
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+
+        self.n_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        return app
+
+    def answer_chunks(self) -> list[str]:
+        return [f"word{i} " for i in range(self.answer_tokens - 1)] + [ANSWER_END]
+
+    async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.n_requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.time_to_first_token)
+            if body.get("stream"):
+                return await self._stream(request, body)
+
+            await asyncio.sleep(self.answer_tokens / self.tokens_per_second)
+            return web.json_response({
+                "id": "chatcmpl-load-test",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(self.answer_chunks())},
+                    "finish_reason": "stop",
+                }],
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        started_at = time.perf_counter()
+        for i, chunk in enumerate(self.answer_chunks()):
+            # keep the configured rate regardless of how long writes take
+            await asyncio.sleep(max(0.0, started_at + i / self.tokens_per_second - time.perf_counter()))
+            await response.write(self._event({"content": chunk}, body["model"]))
+        await response.write(self._event({}, body["model"], finish_reason="stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def _event(delta: dict, model: str, finish_reason=None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-load-test",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
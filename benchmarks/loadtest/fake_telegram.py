@@ -0,0 +1,138 @@
+"""Stand-in for the Telegram Bot API covering what the bot uses while answering messages.
+
+Updates are queued with `push_update` and served by getUpdates. Outgoing messages and edits are recorded
+with timestamps. Edits more frequent than `edit_interval` per chat are answered with 429 like Telegram does.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "load_test_bot"}
+
+
+@dataclass
+class SentEvent:
+    method: str
+    chat_id: int
+    message_id: int
+    text: str
+    at: float = field(default_factory=time.perf_counter)
+
+
+class FakeTelegram:
+    def __init__(self, edit_interval: float = 0.0, retry_after: int = 1):
+        self.edit_interval = edit_interval
+        self.retry_after = retry_after
+
+        self.events: list[SentEvent] = []
+        self.n_requests: dict[str, int] = {}
+        self.n_flood_errors = 0
+        self.on_event: Optional[Callable[[SentEvent], None]] = None
+
+        self._updates: list[dict] = []
+        self._updates_available: Optional[asyncio.Event] = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._last_edit_at: dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.on_startup.append(self._on_startup)
+        return app
+
+    def push_update(self, chat_id: int, text: str):
+        """Thread-safe, must be called through the loop of the server (`loop.call_soon_threadsafe`)."""
+        self._updates.append({
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+                "text": text,
+            },
+        })
+        self._updates_available.set()
+
+    async def _on_startup(self, app: web.Application):
+        self._updates_available = asyncio.Event()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {key: self._decode(value) for key, value in (await request.post()).items()}
+        with self._lock:
+            self.n_requests[method] = self.n_requests.get(method, 0) + 1
+
+        handler = getattr(self, f"_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        return await handler(params)
+
+    @staticmethod
+    def _decode(value):
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            return value
+
+    async def _getMe(self, params: dict) -> web.Response:
+        return web.json_response({"ok": True, "result": BOT_USER})
+
+    async def _getUpdates(self, params: dict) -> web.Response:
+        offset = params.get("offset") or 0
+        self._updates = [item for item in self._updates if item["update_id"] >= offset]
+        if len(self._updates) == 0:
+            self._updates_available.clear()
+            try:
+                await asyncio.wait_for(self._updates_available.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": self._updates[:int(params.get("limit") or 100)]})
+
+    async def _sendMessage(self, params: dict) -> web.Response:
+        chat_id = int(params["chat_id"])
+        event = self._record("sendMessage", chat_id, next(self._message_ids), str(params["text"]))
+        return web.json_response({"ok": True, "result": self._message(event)})
+
+    async def _editMessageText(self, params: dict) -> web.Response:
+        chat_id = int(params["chat_id"])
+        now = time.perf_counter()
+        if now - self._last_edit_at.get(chat_id, -float("inf")) < self.edit_interval:
+            with self._lock:
+                self.n_flood_errors += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        self._last_edit_at[chat_id] = now
+
+        event = self._record("editMessageText", chat_id, int(params["message_id"]), str(params["text"]))
+        return web.json_response({"ok": True, "result": self._message(event)})
+
+    def _record(self, method: str, chat_id: int, message_id: int, text: str) -> SentEvent:
+        event = SentEvent(method, chat_id, message_id, text)
+        with self._lock:
+            self.events.append(event)
+        if self.on_event is not None:
+            self.on_event(event)
+        return event
+
+    @staticmethod
+    def _message(event: SentEvent) -> dict:
+        return {
+            "message_id": event.message_id,
+            "date": int(time.time()),
+            "chat": {"id": event.chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": event.text,
+        }
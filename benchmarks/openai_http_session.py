@@ -0,0 +1,85 @@
+"""Latency of a completion request with a new HTTP session per request vs a shared pooled session.
+
+Runs a local OpenAI-compatible stub server, so only the transport overhead is measured
+(TCP connect and session setup per request; against a TLS backend the difference is larger).
+
+    python3 benchmarks/openai_http_session.py --requests 500
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+import openai
+from aiohttp import web
+
+COMPLETION = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4-turbo",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello!"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+async def chat_completions(request: web.Request) -> web.Response:
+    await request.read()
+    return web.json_response(COMPLETION)
+
+
+async def measure(n_requests: int, session: aiohttp.ClientSession | None) -> list[float]:
+    openai.aiosession.set(session)
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        await openai.ChatCompletion.acreate(
+            model="gpt-4-turbo",
+            messages=[{"role": "user", "content": "Hi"}],
+            request_timeout=10,
+        )
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: list[float]):
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    print(f"{name:>16}: mean {statistics.mean(latencies_ms):.3f} ms, "
+          f"p50 {latencies_ms[len(latencies_ms) // 2]:.3f} ms, "
+          f"p99 {latencies_ms[int(len(latencies_ms) * 0.99) - 1]:.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    openai.api_key = "bench"
+    openai.api_base = f"http://127.0.0.1:{port}/v1"
+
+    try:
+        await measure(10, None)  # warm up
+        per_request = await measure(args.requests, None)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=30)) as session:
+            await measure(10, session)
+            shared = await measure(args.requests, session)
+    finally:
+        await runner.cleanup()
+
+    report("session/request", per_request)
+    report("shared session", shared)
+    print(f"saved per completion: {(statistics.mean(per_request) - statistics.mean(shared)) * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""CPU time per streamed token: accumulated answer strings vs delta events joined only when rendered.
+
+The accumulated variant is what the bot did before: every token is appended to the answer string, the
+whole answer is handed to the consumer, which compares it with the previous one. The delta variant passes
+only the new text and keeps the answer in an AnswerBuffer, which a StreamRenderer joins once per edit.
+
+    python3 benchmarks/streaming_deltas.py --tokens 2000 20000
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "bot"))
+
+import streaming  # noqa: E402
+
+TOKEN = "token "
+
+
+class TextDelta:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+async def render(text: str, final: bool):
+    pass
+
+
+async def accumulated(n_tokens: int, edit_interval: float) -> float:
+    async def stream():
+        answer = ""
+        for _ in range(n_tokens):
+            answer += TOKEN
+            yield "not_finished", answer, None, 0
+            await asyncio.sleep(0)
+        yield "finished", answer, None, 0
+
+    async def render_periodically():
+        while True:
+            await asyncio.sleep(edit_interval)
+            await render(latest_text, final=False)
+
+    latest_text = ""
+    renderer = asyncio.create_task(render_periodically())
+    started_at = time.process_time()
+    async for status, answer, _, _ in stream():
+        if answer == latest_text:
+            continue
+        latest_text = answer
+    elapsed = time.process_time() - started_at
+    renderer.cancel()
+    return elapsed
+
+
+async def deltas(n_tokens: int, edit_interval: float) -> float:
+    async def stream():
+        for _ in range(n_tokens):
+            yield TextDelta(TOKEN)
+            await asyncio.sleep(0)
+
+    budget = streaming.EditBudget(chat_interval=edit_interval, global_rate=1000.0)
+    renderer = streaming.StreamRenderer(render, 1, budget)
+    answer_buffer = streaming.AnswerBuffer()
+    started_at = time.process_time()
+    async for event in stream():
+        answer_buffer.append(event.text)
+        renderer.update(answer_buffer)
+    await renderer.finish(answer_buffer.text())
+    return time.process_time() - started_at
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, nargs="+", default=[2000, 20000])
+    parser.add_argument("--edit-interval", type=float, default=0.01, help="seconds between renders")
+    args = parser.parse_args()
+
+    for n_tokens in args.tokens:
+        accumulated_time = await accumulated(n_tokens, args.edit_interval)
+        deltas_time = await deltas(n_tokens, args.edit_interval)
+        print(
+            f"{n_tokens:>7} tokens: accumulated {accumulated_time / n_tokens * 1e6:.2f} us/token, "
+            f"deltas {deltas_time / n_tokens * 1e6:.2f} us/token"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,14 +3,18 @@
 # Load environment variables
 source .env
 
-# Get the current date in the format dd_mm_yyyy
-current_date=$(date +'%d_%m_%Y')
+# The bot writes consistent snapshots of its database (snapshot_interval in config.yml) to the snapshots
+# directory of the docker volume. Copying the live sqlite.db instead may capture a torn file.
+snapshots_dir="/var/lib/docker/volumes/chatgpt_telegram_bot_sqlite-volume/_data/snapshots/"
 
 # Ensure the backup directory exists
-mkdir -p ./db_backups
+mkdir -p ./db_backups/snapshots
 
-# Define the destination file name
-destination_file="./db_backups/${current_date}.db"
+# Snapshot files are never changed once written, so only new snapshots and deltas are transferred;
+# old generations removed by the bot are removed here as well
+rsync -az --delete "$HOST:$snapshots_dir" ./db_backups/snapshots/
 
-# Use scp to copy the file from the remote server docker volume to the local machine
-scp "$HOST:/var/lib/docker/volumes/chatgpt_telegram_bot_sqlite-volume/_data/sqlite.db" "$destination_file"
+# Check the copies and restore the latest database into the current date's file
+current_date=$(date +'%d_%m_%Y')
+ssh "$HOST" "docker exec chatgpt_telegram_bot python3 bot/snapshots.py verify /app/db/snapshots" || exit 1
+python3 src/bot/snapshots.py restore ./db_backups/snapshots "./db_backups/${current_date}.db"
@@ -0,0 +1,188 @@
+"""Cold storage of old dialogs, so the database keeps only what handlers read.
+
+Dialogs which are not the current dialog of their user and have had no new message for `max_age` are
+moved out of the database into archive segments: append-only files of zlib-compressed JSON records, one
+record per dialog. A segment is never rewritten, a new one is started once it reaches `segment_max_bytes`.
+The database keeps one row per archived dialog in `archived_dialogs` with the segment, offset and length of
+its record, so an archived dialog is read back with a single seek. Space freed in the database file is
+returned to the file system in small `incremental_vacuum` steps, if the file is in incremental auto-vacuum
+mode (see database_migrations.py); otherwise it is only reused by later writes.
+
+An archived dialog can be printed with
+
+    python3 bot/archive.py ./db/sqlite.db ./db/archive <dialog id>
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+import coordination
+import metrics
+
+ARCHIVED_DIALOGS = metrics.counter("bot_archived_dialogs_total", "Dialogs moved to the archive segments")
+RECLAIMED_PAGES = metrics.counter("bot_archive_reclaimed_pages_total", "Database pages returned by incremental vacuum")
+RETENTION_RUNS = metrics.counter("bot_retention_runs_total", "Runs of the dialog retention job", ("status",))
+
+_SEGMENT_NAME = re.compile(r"^segment-(\d{6})\.zz$")
+
+
+class DialogArchive:
+    def __init__(self, path: Path, segment_max_bytes: int = 64 * 1024 * 1024, compression_level: int = 6):
+        self.path = Path(path)
+        self.segment_max_bytes = segment_max_bytes
+        self.compression_level = compression_level
+
+    def append(self, records: list[dict]) -> list[tuple[str, int, int]]:
+        """Appends the records and syncs them to disk, returns (segment, offset, length) of each one.
+
+        Callers serialize appends (the retention job holds the database write lock meanwhile). Bytes of records
+        whose index rows were never committed stay in the segment unreferenced.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        segment = self._current_segment()
+        locations = []
+        with open(self.path / segment, "ab") as file:
+            offset = file.seek(0, os.SEEK_END)
+            for record in records:
+                data = zlib.compress(
+                    json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                    self.compression_level
+                )
+                file.write(data)
+                locations.append((segment, offset, len(data)))
+                offset += len(data)
+            file.flush()
+            os.fsync(file.fileno())
+        return locations
+
+    def read(self, segment: str, offset: int, length: int) -> dict:
+        if _SEGMENT_NAME.match(segment) is None:
+            raise ValueError(f"Invalid archive segment name {segment}")
+        with open(self.path / segment, "rb") as file:
+            file.seek(offset)
+            return json.loads(zlib.decompress(file.read(length)).decode("utf-8"))
+
+    def _current_segment(self) -> str:
+        numbers = [
+            int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(self.path)) if match is not None
+        ]
+        if len(numbers) == 0:
+            return "segment-000001.zz"
+        segment = f"segment-{max(numbers):06d}.zz"
+        if os.path.getsize(self.path / segment) >= self.segment_max_bytes:
+            segment = f"segment-{max(numbers) + 1:06d}.zz"
+        return segment
+
+
+class RetentionJob:
+    """Archives old dialogs every `interval` seconds, `batch_size` dialogs per database write."""
+
+    def __init__(
+            self,
+            db,
+            archive: DialogArchive,
+            max_age: timedelta,
+            interval: float = 3600.0,
+            batch_size: int = 100,
+            vacuum_pages: int = 1000
+    ):
+        self.db = db
+        self.archive = archive
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+        # workers sharing the database and the archive run the job one at a time
+        self._job_lock = coordination.JobLock(self.archive.path / "retention.lock")
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> bool:
+        """Starts the job, unless another worker runs it already; returns whether it was started."""
+        if not self._job_lock.acquire():
+            logger.info(f"Dialog retention runs in another worker, {self._job_lock.path} is locked")
+            return False
+        self._task = asyncio.create_task(self._run_periodically())
+        return True
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._job_lock.release()
+
+    async def run(self) -> int:
+        """Archives all dialogs which are old enough, returns how many."""
+        n_archived = 0
+        older_than = datetime.now() - self.max_age
+        while True:
+            # every batch is a separate write, so other writes are not held back until the whole run is done
+            n_batch = await self.db.archive_dialogs(self.archive, older_than, self.batch_size)
+            n_archived += n_batch
+            ARCHIVED_DIALOGS.inc(n_batch)
+            if n_batch < self.batch_size:
+                break
+
+        if n_archived > 0 and await self.db.has_incremental_vacuum():
+            while (n_pages := await self.db.incremental_vacuum(self.vacuum_pages)) > 0:
+                RECLAIMED_PAGES.inc(n_pages)
+                if n_pages < self.vacuum_pages:
+                    break
+        return n_archived
+
+    async def _run_periodically(self):
+        if not await self.db.has_incremental_vacuum():
+            logger.warning(
+                "Database file is not in incremental auto-vacuum mode, space freed by archiving is not returned to "
+                "the file system; convert it offline with `database_migrations.py --enable-incremental-vacuum`"
+            )
+        while True:
+            started_at = time.monotonic()
+            try:
+                n_archived = await self.run()
+                RETENTION_RUNS.inc(status="ok")
+                if n_archived > 0:
+                    logger.info(f"Archived {n_archived} dialogs in {time.monotonic() - started_at:.1f}s")
+            except Exception as e:
+                RETENTION_RUNS.inc(status="error")
+                logger.error(f"Failed to archive old dialogs: {e}")
+            await asyncio.sleep(self.interval)
+
+
+def main():
+    from database_sqlite import SqliteDataBase
+
+    parser = argparse.ArgumentParser(description="Print an archived dialog, or the archived dialogs of a user")
+    parser.add_argument("sqlite_path", help="path to the sqlite database file")
+    parser.add_argument("archive_path", help="directory of the archive segments")
+    parser.add_argument("dialog_id", nargs="?", help="id of the archived dialog")
+    parser.add_argument("--user", type=int, help="list the archived dialogs of this user id")
+    args = parser.parse_args()
+
+    db = SqliteDataBase(args.sqlite_path, read_only=True)
+    try:
+        if args.user is not None:
+            result = db.get_archived_dialogs(args.user)
+        elif args.dialog_id is not None:
+            result = db.get_archived_dialog(DialogArchive(Path(args.archive_path)), args.dialog_id)
+            if result is None:
+                parser.exit(1, f"Dialog {args.dialog_id} is not archived\n")
+        else:
+            parser.error("either a dialog id or --user is required")
+        print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
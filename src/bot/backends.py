@@ -0,0 +1,287 @@
+"""Routing of completion requests over several OpenAI-compatible backends.
+
+Every backend keeps a rolling time to first token and error rate. A request goes to the fastest backend
+whose circuit is closed; a backend failing too often is skipped for `open_seconds`, then a single probe
+request decides whether it is used again. With `hedge_after` set, a request which has not produced its
+first item in time is also sent to the next backend, and whichever answers first is used.
+"""
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Callable, Optional, TypeVar
+
+import aiohttp
+import openai
+from loguru import logger
+
+import metrics
+import tracing
+
+T = TypeVar("T")
+
+REQUESTS = metrics.counter(
+    "bot_backend_requests_total", "Completion requests sent to a backend", ("backend", "status")
+)
+HEDGED_REQUESTS = metrics.counter(
+    "bot_backend_hedged_requests_total", "Completion requests also sent to a second backend because of slowness"
+)
+TIME_TO_FIRST_ITEM = metrics.histogram(
+    "bot_backend_time_to_first_token_seconds", "Time until a backend produced the first part of an answer",
+    ("backend",)
+)
+LATENCY = metrics.gauge("bot_backend_latency_seconds", "Rolling time to first token of a backend", ("backend",))
+ERROR_RATE = metrics.gauge("bot_backend_error_rate", "Share of failed recent requests of a backend", ("backend",))
+CIRCUIT_OPEN = metrics.gauge("bot_backend_circuit_open", "1 while a backend is skipped after failures", ("backend",))
+
+# errors which do not tell anything about the backend's health, e.g. a prompt which is too long
+CLIENT_ERRORS = (openai.error.InvalidRequestError,)
+BACKEND_ERRORS = (openai.error.OpenAIError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class Backend:
+    def __init__(
+            self,
+            name: str,
+            api_base: Optional[str] = None,
+            api_key: Optional[str] = None,
+            model: Optional[str] = None,
+            request_timeout: Optional[float] = None,
+            window: int = 20,
+            latency_smoothing: float = 0.2
+    ):
+        self.name = name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+        self.request_timeout = request_timeout
+        self.latency_smoothing = latency_smoothing
+
+        self.latency: Optional[float] = None
+        self.open_until = 0.0
+        self.probing = False
+        self._outcomes: deque[bool] = deque(maxlen=window)
+
+        LATENCY.set_function(lambda: self.latency or 0.0, backend=name)
+        ERROR_RATE.set_function(lambda: self.error_rate, backend=name)
+        CIRCUIT_OPEN.set_function(lambda: float(time.monotonic() < self.open_until), backend=name)
+
+    @property
+    def error_rate(self) -> float:
+        if len(self._outcomes) == 0:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    @property
+    def n_outcomes(self) -> int:
+        return len(self._outcomes)
+
+    def request_options(self) -> dict:
+        options = {"api_base": self.api_base, "api_key": self.api_key}
+        if self.request_timeout is not None:
+            options["request_timeout"] = self.request_timeout
+        return options
+
+    def record_success(self, latency: float):
+        self._outcomes.append(True)
+        self.record_latency(latency)
+        self.open_until = 0.0
+        self.probing = False
+
+    def record_latency(self, latency: float):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_smoothing * (latency - self.latency)
+
+    def record_failure(self):
+        self._outcomes.append(False)
+        self.probing = False
+
+
+class BackendRouter:
+    def __init__(
+            self,
+            backends: list[Backend],
+            error_rate_threshold: float = 0.5,
+            min_requests: int = 5,
+            open_seconds: float = 30.0,
+            hedge_after: Optional[float] = None
+    ):
+        if len(backends) == 0:
+            raise ValueError("At least one completion backend is required")
+        self.backends = {backend.name: backend for backend in backends}
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.hedge_after = hedge_after
+
+    def candidates(self, preferred: Optional[str] = None) -> list[Backend]:
+        """Backends to try in order: the preferred one if it is healthy, then the fastest healthy ones."""
+        now = time.monotonic()
+        healthy = [
+            backend for backend in self.backends.values()
+            if now >= backend.open_until and not backend.probing
+        ]
+        if len(healthy) == 0:
+            # every circuit is open, the backend which failed longest ago is still better than nothing
+            return sorted(self.backends.values(), key=lambda backend: backend.open_until)[:1]
+
+        # a backend without latency samples yet is tried first, so it gets some
+        healthy.sort(key=lambda backend: backend.latency or 0.0)
+        if preferred is not None and preferred in self.backends and self.backends[preferred] in healthy:
+            healthy.remove(self.backends[preferred])
+            healthy.insert(0, self.backends[preferred])
+        return healthy
+
+    async def stream(
+            self,
+            request: Callable[[Backend], AsyncGenerator[T, None]],
+            preferred: Optional[str] = None
+    ) -> AsyncIterator[T]:
+        """Items of `request(backend)` from the first backend which produces one.
+
+        Backends are switched only before the first item; a failure later on is raised.
+        """
+        backend, iterator, first_item = await self._first_item(request, self.candidates(preferred))
+        try:
+            yield first_item
+            async for item in iterator:
+                yield item
+        except BACKEND_ERRORS as e:
+            if not isinstance(e, CLIENT_ERRORS):
+                self._record_failure(backend, e)
+            raise
+        finally:
+            await iterator.aclose()
+
+    async def complete(
+            self,
+            request: Callable[[Backend], AsyncGenerator[T, None]],
+            preferred: Optional[str] = None
+    ) -> T:
+        """The first item of `request(backend)`, e.g. a whole non-streamed answer."""
+        async with contextlib.aclosing(self.stream(request, preferred)) as items:
+            async for item in items:
+                return item
+        raise ValueError("Completion backend returned no answer")
+
+    async def _first_item(
+            self,
+            request: Callable[[Backend], AsyncGenerator[T, None]],
+            candidates: list[Backend]
+    ) -> tuple[Backend, AsyncGenerator[T, None], T]:
+        attempts: dict[asyncio.Task, tuple[Backend, AsyncGenerator[T, None]]] = {}
+        started_at = time.monotonic()
+        last_error: Optional[BaseException] = None
+
+        def start_next() -> bool:
+            if len(candidates) == 0:
+                return False
+            backend = candidates.pop(0)
+            if time.monotonic() >= backend.open_until and backend.open_until > 0:
+                backend.probing = True  # half-open: this request decides whether the backend is used again
+            iterator = request(backend)
+            attempts[asyncio.create_task(self._timed_first_item(backend, iterator))] = (backend, iterator)
+            return True
+
+        start_next()
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=self.hedge_after if candidates else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if len(done) == 0:
+                    HEDGED_REQUESTS.inc()
+                    start_next()
+                    continue
+
+                for task in done:
+                    backend, iterator = attempts.pop(task)
+                    try:
+                        first_item = task.result()
+                    except CLIENT_ERRORS:
+                        backend.probing = False
+                        raise
+                    except BACKEND_ERRORS as e:
+                        self._record_failure(backend, e)
+                        last_error = e
+                        await iterator.aclose()
+                        if len(attempts) == 0:
+                            start_next()
+                        continue
+                    REQUESTS.inc(backend=backend.name, status="ok")
+                    tracing.set_labels(backend=backend.name)
+                    return backend, iterator, first_item
+        finally:
+            for task, (backend, iterator) in attempts.items():
+                task.cancel()
+                with contextlib.suppress(BaseException):
+                    await task
+                # closing the loser's stream releases its connection now, not when it is garbage collected
+                with contextlib.suppress(Exception):
+                    await iterator.aclose()
+                backend.probing = False
+                # lost a hedge: the backend is at least this slow
+                backend.record_latency(time.monotonic() - started_at)
+
+        if last_error is None:
+            raise ValueError("No completion backend is available")
+        raise last_error
+
+    @staticmethod
+    async def _timed_first_item(backend: Backend, iterator: AsyncGenerator[T, None]) -> T:
+        started_at = time.monotonic()
+        try:
+            first_item = await iterator.__anext__()
+        except StopAsyncIteration:
+            raise openai.error.APIError(f"Backend {backend.name} returned an empty answer") from None
+        latency = time.monotonic() - started_at
+        backend.record_success(latency)
+        TIME_TO_FIRST_ITEM.observe(latency, backend=backend.name)
+        return first_item
+
+    def _record_failure(self, backend: Backend, error: BaseException):
+        backend.record_failure()
+        REQUESTS.inc(backend=backend.name, status="error")
+        logger.warning(f"Completion backend {backend.name} failed: {error!r}")
+
+        if backend.open_until > 0 or (
+                backend.n_outcomes >= self.min_requests and backend.error_rate >= self.error_rate_threshold
+        ):
+            # a failed probe reopens the circuit right away
+            backend.open_until = time.monotonic() + self.open_seconds
+            logger.warning(f"Completion backend {backend.name} is skipped for {self.open_seconds} s")
+
+
+def create_router(
+        backend_configs: list[dict],
+        default_api_base: Optional[str],
+        default_api_key: Optional[str],
+        error_rate_threshold: float = 0.5,
+        min_requests: int = 5,
+        open_seconds: float = 30.0,
+        hedge_after: Optional[float] = None
+) -> BackendRouter:
+    """Router over the configured backends, or over the single `default_api_base` if none are configured."""
+    if len(backend_configs) == 0:
+        backend_configs = [{"name": "default", "api_base": default_api_base}]
+    backends = [
+        Backend(
+            backend_config["name"],
+            api_base=backend_config.get("api_base", default_api_base),
+            api_key=backend_config.get("api_key", default_api_key),
+            model=backend_config.get("model"),
+            request_timeout=backend_config.get("request_timeout")
+        )
+        for backend_config in backend_configs
+    ]
+    return BackendRouter(
+        backends,
+        error_rate_threshold=error_rate_threshold,
+        min_requests=min_requests,
+        open_seconds=open_seconds,
+        hedge_after=hedge_after
+    )
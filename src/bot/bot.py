@@ -1,11 +1,13 @@
 import asyncio
+import contextlib
 import html
 import json
+import time
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from loguru import logger
-from telegram import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, Update, User
+from telegram import BotCommand, Message, Update, User
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
 from telegram.ext import (
@@ -19,13 +21,91 @@ from telegram.ext import (
     filters
 )
 
+import archive
 import chatgpt
 import conf as config
-import database_sqlite
+import coordination
+import database_async
+import formatting
+import metrics_http
+import prompt_queue
+import scheduler
+import snapshots
+import streaming
+import summarization
+import tracing
+import webhook
 
 # setup
-db = database_sqlite.SqliteDataBase(config.sqlite_database_uri)
-user_semaphores = {}
+# with snapshot deltas the WAL is checkpointed by the snapshot job only
+snapshot_deltas = config.snapshot_interval is not None and config.snapshot_delta_interval is not None
+db = database_async.AsyncSqliteDataBase(
+    config.sqlite_database_uri,
+    read_pool_size=config.sqlite_read_pool_size,
+    user_cache_size=config.user_cache_size,
+    user_cache_ttl=config.user_cache_ttl,
+    flush_interval_ms=config.sqlite_flush_interval_ms,
+    flush_max_rows=config.sqlite_flush_max_rows,
+    synchronous=config.sqlite_synchronous,
+    mmap_size=config.sqlite_mmap_size,
+    wal_autocheckpoint=0 if snapshot_deltas else None
+)
+# per-user locks and pending mode selections, shared with other workers of the bot if configured
+coordinator = coordination.create_coordinator(
+    config.coordination_backend,
+    config.coordination_sqlite_path,
+    lease=config.coordination_lock_lease,
+    max_users=config.coordination_max_users,
+    lock_idle_ttl=config.coordination_lock_idle_ttl,
+    pending_selection_ttl=config.pending_selection_ttl
+)
+# prompts sent while the previous prompt of the user is answered
+pending_prompts = prompt_queue.PromptQueue(
+    max_depth=config.queued_prompts_max_depth,
+    overflow=config.queued_prompts_overflow,
+    merge=config.merge_queued_prompts
+)
+# completions of all users share the backend capacity
+completion_scheduler = scheduler.CompletionScheduler(
+    max_in_flight=config.completion_max_in_flight,
+    model_limits=config.completion_model_concurrency,
+    user_weights=config.completion_user_weights
+)
+# long dialogs are folded into a summary in the background
+dialog_summarizer = summarization.DialogSummarizer(
+    db,
+    completion_scheduler,
+    threshold_tokens=config.dialog_summary_threshold_tokens,
+    keep_messages=config.dialog_summary_keep_messages,
+    max_tokens=config.dialog_summary_max_tokens
+)
+# old dialogs are moved out of the database into compressed archive segments
+retention_job = None
+if config.retention_max_age_days is not None:
+    retention_job = archive.RetentionJob(
+        db,
+        archive.DialogArchive(config.archive_path),
+        max_age=timedelta(days=config.retention_max_age_days),
+        interval=config.retention_interval,
+        batch_size=config.retention_batch_size,
+        vacuum_pages=config.retention_vacuum_pages
+    )
+# consistent copies of the database, taken while it is written to
+snapshot_job = None
+if config.snapshot_interval is not None:
+    snapshot_job = snapshots.SnapshotJob(
+        config.sqlite_database_uri,
+        config.snapshot_path,
+        snapshot_interval=config.snapshot_interval,
+        delta_interval=config.snapshot_delta_interval,
+        keep_generations=config.snapshot_keep,
+        pages_per_step=config.snapshot_pages_per_step,
+        step_sleep=config.snapshot_step_sleep
+    )
+edit_budget = streaming.EditBudget(
+    chat_interval=config.stream_edit_chat_interval,
+    global_rate=config.stream_edit_global_rate
+)
 
 HELP_MESSAGE = """Commands:
 /new – 🆕 Start new conversation
@@ -34,42 +114,50 @@ HELP_MESSAGE = """Commands:
 /help – ℹ️ Show help
 """
 
-# Dictionary to track if we're expecting a chat mode selection from a user
-expecting_mode_selection: dict[int, dict[str, bool | int]] = {}
 
-
-def split_text_into_chunks(text, chunk_size):
-    for i in range(0, len(text), chunk_size):
-        yield text[i:i + chunk_size]
+@contextlib.asynccontextmanager
+async def user_lock(user_id: int):
+    async with coordinator.lock(user_id):
+        if coordinator.shared:
+            # the previous holder may be another worker, its changes were flushed when it released the lock
+            db.user_cache.invalidate(user_id)
+        try:
+            yield
+        finally:
+            if coordinator.shared:
+                # the next worker taking the lock reads the user's changes from the database
+                await db.flush()
 
 
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    if coordinator.shared:
+        # the user might have been changed by another worker since it was cached; handlers which change
+        # the user reload it again once they hold its lock
+        db.user_cache.invalidate(user.id)
+
+    if not await db.check_if_user_exists(user.id):
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name=user.last_name
         )
-        db.start_new_dialog(user.id)
-
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+        await db.start_new_dialog(user.id)
 
-    if user.id not in user_semaphores:
-        user_semaphores[user.id] = asyncio.Semaphore(1)
+    if await db.get_user_attribute(user.id, "current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_chat_mode") is None:
-        db.set_user_attribute(user_id=user.id, key="current_chat_mode", value="assistant")
+    if await db.get_user_attribute(user.id, "current_chat_mode") is None:
+        await db.set_user_attribute(user_id=user.id, key="current_chat_mode", value="assistant")
 
 
 async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
 
     reply_text = "This is the <b>ChatGPT</b> Telegram Bot, powered by advanced AI language processing.\n\n"
     reply_text += HELP_MESSAGE
@@ -82,7 +170,7 @@ async def start_handle(update: Update, context: CallbackContext):
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
@@ -92,9 +180,9 @@ async def retry_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    last_dialog_message = db.remove_dialog_last_message(user_id)
+    last_dialog_message = await db.remove_dialog_last_message(user_id)
     if last_dialog_message is None:
         await update.message.reply_text("🤷‍♂️ No message to retry")
         return
@@ -109,140 +197,222 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         return
 
     await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context):
-        return
-
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
 
     # New check for chat mode selection
     if await is_chat_mode_selection_handle(update, context):
         return  # If the message was handled as a chat mode selection, exit early
 
-    async with user_semaphores[user_id]:
-        # new dialog timeout
-        if use_new_dialog_timeout:
-            if (
-                    datetime.now() - db.get_user_attribute(user_id, "last_interaction")
-            ).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
-                await update.message.reply_text(
-                    f'💬 Starting new dialog due to timeout (<b>{chatgpt.CHAT_MODES[chat_mode]["name"]}'
-                    f'</b> mode).',
-                    parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    # while a previous prompt of the user is answered, the prompt waits for it in the queue
+    prompt = prompt_queue.QueuedPrompt(update, message or update.message.text)
+    must_answer, dropped_prompt = pending_prompts.submit(user_id, prompt)
+    if dropped_prompt is not None:
+        await reply_previous_message_not_answered_yet(dropped_prompt.update)
+    if not must_answer:
+        return
+
+    try:
+        async with user_lock(user_id):
+            await answer_prompt(prompt.update, context, prompt.message, use_new_dialog_timeout)
+            while (prompt := pending_prompts.next(user_id)) is not None:
+                await answer_prompt(prompt.update, context, prompt.message, use_new_dialog_timeout=True)
+    except BaseException:
+        # the task may be cancelled, so the waiting prompts are replied to in the background
+        for dropped_prompt in pending_prompts.discard(user_id):
+            asyncio.create_task(reply_prompt_not_answered(dropped_prompt.update))
+        raise
+
+
+async def answer_prompt(update: Update, context: CallbackContext, message: str, use_new_dialog_timeout: bool):
+    started_at = time.perf_counter()
+    user_id = update.message.from_user.id
+    with tracing.span("db_read"):
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+    # the mode is kept for the whole answer, even if the chat modes are reloaded meanwhile
+    mode = chatgpt.CHAT_MODES.get(chat_mode)
+    chat_mode = mode.key
+    tracing.set_labels(chat_mode=chat_mode, backend="")
+
+    # new dialog timeout
+    if use_new_dialog_timeout:
+        if (
+                datetime.now() - await db.get_user_attribute(user_id, "last_interaction")
+        ).seconds > config.new_dialog_timeout and len(await db.get_dialog_messages(user_id)) > 0:
+            await db.start_new_dialog(user_id)
+            await update.message.reply_text(
+                f'💬 Starting new dialog due to timeout (<b>{mode.name}</b> mode).',
+                parse_mode=ParseMode.HTML)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-        try:
+    try:
 
-            # send placeholder message to user
+        # send placeholder message to user
+        with tracing.span("placeholder_send"):
             placeholder_message = await update.message.reply_text("...")
 
             # send typing action
             await update.message.chat.send_action(action="typing")
 
-            message = message or update.message.text
-
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-            parse_mode = {
-                "html": ParseMode.HTML,
-                "markdown": ParseMode.MARKDOWN
-            }[chatgpt.CHAT_MODES[chat_mode]["parse_mode"]]
-
-            chatgpt_instance = chatgpt.ChatGPT()
-            if config.enable_message_streaming:
-                gen = chatgpt_instance.send_message_stream(message, dialog_messages=dialog_messages,
-                                                           chat_mode=chat_mode)
-            else:
+        with tracing.span("db_read"):
+            dialog_id = await db.get_user_attribute(user_id, "current_dialog_id")
+            dialog_messages = await db.get_dialog_messages(user_id, dialog_id=dialog_id)
+            dialog_summary = None
+            if dialog_summarizer.enabled:
+                dialog_summary = await db.get_dialog_summary(user_id, dialog_id=dialog_id)
+                dialog_messages = summarization.unsummarized(dialog_messages, dialog_summary)
+        summary_text = dialog_summary["summary"] if dialog_summary is not None else None
+        parse_mode = mode.telegram_parse_mode
+
+        chatgpt_instance = chatgpt.ChatGPT()
+        if config.enable_message_streaming:
+            gen = chatgpt_instance.send_message_deltas(message, dialog_messages=dialog_messages,
+                                                       chat_mode=chat_mode, dialog_summary=summary_text)
+        else:
+            async def fake_gen():
                 answer, prompt, n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                     message,
                     dialog_messages=dialog_messages,
-                    chat_mode=chat_mode
+                    chat_mode=chat_mode,
+                    dialog_summary=summary_text
                 )
+                yield chatgpt.Finished(answer, prompt, n_first_dialog_messages_removed)
+
+            gen = fake_gen()
 
-                async def fake_gen():
-                    yield "finished", answer, prompt, n_first_dialog_messages_removed
-
-                gen = fake_gen()
-
-            prev_answer = ""
-            answer = ""
-            async for gen_item in gen:
-                status, answer, prompt, n_first_dialog_messages_removed = gen_item
-
-                answer = answer[:4096]  # telegram message limit
-
-                # update only when 100 new symbols are ready
-                if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
-
-                try:
-                    await context.bot.edit_message_text(
-                        text=answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                        parse_mode=parse_mode
-                    )
-                except BadRequest as e:
-                    if str(e).startswith("Message is not modified"):
-                        continue
-
-                    await context.bot.edit_message_text(
-                        text=answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id
-                    )
-
-                await asyncio.sleep(0.01)  # wait a bit to avoid flooding
-
-                prev_answer = answer
-
-            # update user data
-            new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}
-            db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
-
-        except Exception as e:
-            error_text = f"Something went wrong during completion. Reason: {e}"
-            logger.error(error_text)
-            await update.message.reply_text(error_text)
-            return
-
-        # send message if some messages were removed from the context
-        if n_first_dialog_messages_removed > 0:
-            if n_first_dialog_messages_removed == 1:
-                text = "✂️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed" \
-                       " from the context.\n Send /new command to start new dialog."
-            else:
-                text = f"✂️ <i>Note:</i> Your current dialog is too long, so" \
-                       f" <b>{n_first_dialog_messages_removed} first messages</b> were removed from the context.\n " \
-                       f"Send /new command to start new dialog."
-            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        @tracing.traced_async("telegram_edit")
+        async def edit_page(page_message: Message, text: str):
+            try:
+                await context.bot.edit_message_text(
+                    text=text,
+                    chat_id=page_message.chat_id,
+                    message_id=page_message.message_id,
+                    parse_mode=parse_mode
+                )
+            except BadRequest as e:
+                if str(e).startswith("Message is not modified"):
+                    return
 
+                await context.bot.edit_message_text(
+                    text=text,
+                    chat_id=page_message.chat_id,
+                    message_id=page_message.message_id
+                )
 
-async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+        @tracing.traced_async("telegram_send")
+        async def send_page(text: str) -> Message:
+            try:
+                return await update.message.chat.send_message(text, parse_mode=parse_mode)
+            except BadRequest:
+                return await update.message.chat.send_message(text)
+
+        pager = streaming.MessagePager(
+            edit_page,
+            send_page,
+            placeholder_message,
+            parse_mode=mode.parse_mode
+        )
+
+        async def show_queue_position(position: int):
+            await placeholder_message.edit_text(f"🕐 Waiting for a free slot, your position in the queue: {position}")
+
+        renderer = streaming.StreamRenderer(pager.render, placeholder_message.chat_id, edit_budget)
+        answer = ""
+        answer_buffer = streaming.AnswerBuffer()
+        n_first_dialog_messages_removed = 0
+        try:
+            # the completion starts once the scheduler admits it
+            queued_at = time.perf_counter()
+            first_token_at = None
+            async with completion_scheduler.slot(
+                    user_id,
+                    # per-model limits apply to the model of the backend the completion is routed to
+                    chatgpt_instance.routed_model(mode.backend),
+                    weight=completion_scheduler.weight(update.message.from_user.username),
+                    on_queued=show_queue_position
+            ):
+                admitted_at = time.perf_counter()
+                tracing.observe("queue_wait", admitted_at - queued_at)
+                with tracing.span("stream"):
+                    async for event in gen:
+                        if isinstance(event, chatgpt.ContextInfo):
+                            n_first_dialog_messages_removed = event.n_first_dialog_messages_removed
+                            continue
+
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            tracing.observe("first_token", first_token_at - admitted_at)
+
+                        if isinstance(event, chatgpt.Finished):
+                            answer = event.answer
+                            n_first_dialog_messages_removed = event.n_first_dialog_messages_removed
+                            await renderer.finish(answer)
+                        else:
+                            answer_buffer.append(event.text)
+                            renderer.update(answer_buffer)
+        finally:
+            renderer.cancel()
+
+        # update user data
+        new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}
+        with tracing.span("db_write"):
+            await db.append_dialog_message(user_id, new_dialog_message, dialog_id=dialog_id)
+        dialog_summarizer.maybe_schedule(user_id, dialog_id, [*dialog_messages, new_dialog_message])
+        tracing.observe("answer", time.perf_counter() - started_at)
+
+    except Exception as e:
+        tracing.observe("answer", time.perf_counter() - started_at, status="error")
+        error_text = f"Something went wrong during completion. Reason: {e}"
+        logger.error(error_text)
+        await update.message.reply_text(error_text)
+        return
 
+    # send message if some messages were removed from the context
+    if n_first_dialog_messages_removed > 0:
+        if n_first_dialog_messages_removed == 1:
+            text = "✂️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed" \
+                   " from the context.\n Send /new command to start new dialog."
+        else:
+            text = f"✂️ <i>Note:</i> Your current dialog is too long, so" \
+                   f" <b>{n_first_dialog_messages_removed} first messages</b> were removed from the context.\n " \
+                   f"Send /new command to start new dialog."
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+
+async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    if user_semaphores[user_id].locked():
-        text = "⏳ Please <b>wait</b> for a reply to the previous message"
-        await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+    if pending_prompts.is_active(user_id) or await coordinator.is_locked(user_id):
+        await reply_previous_message_not_answered_yet(update)
         return True
     else:
         return False
 
 
+async def reply_previous_message_not_answered_yet(update: Update):
+    text = "⏳ Please <b>wait</b> for a reply to the previous message"
+    await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+
+
+async def reply_prompt_not_answered(update: Update):
+    text = "⚠️ This message was <b>not answered</b>, please send it again"
+    try:
+        await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.warning(f"Failed to reply to a dropped queued message: {e}")
+
+
 async def new_dialog_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     await update.message.reply_text("💬 Starting new dialog.")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    await update.message.reply_text(f"{chatgpt.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+    await update.message.reply_text(chatgpt.CHAT_MODES.get(chat_mode).welcome_message, parse_mode=ParseMode.HTML)
 
 
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
@@ -251,50 +421,44 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     logger.info("User {} is setting chat mode", user_id)
 
-    keyboard = []
-    for i, (chat_mode, chat_mode_dict) in enumerate(chatgpt.CHAT_MODES.items(), start=1):
-        keyboard.append([InlineKeyboardButton(
-            text=f'{i}. {chat_mode_dict["name"]}',
-            callback_data=f"set_chat_mode|{chat_mode}")]
-        )
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     # Send the reply and capture the result
-    sent_message = await update.message.reply_text("Select chat mode:", reply_markup=reply_markup)
+    sent_message = await update.message.reply_text("Select chat mode:",
+                                                   reply_markup=chatgpt.CHAT_MODES.current.keyboard)
 
     # Store the message ID of the bot's reply
-    expecting_mode_selection[user_id] = {
+    await coordinator.set_pending_selection(user_id, {
         "expecting": True,
         "message_id": sent_message.message_id,  # This is the bot's message ID
         "chat_id": sent_message.chat_id
-    }
+    })
 
 
 async def is_chat_mode_selection_handle(update: Update, context: CallbackContext) -> bool:
     user_id = update.message.from_user.id
-    if user_id in expecting_mode_selection and expecting_mode_selection[user_id]["expecting"]:
+    pending_selection = await coordinator.get_pending_selection(user_id)
+    if pending_selection is not None and pending_selection["expecting"]:
         text = update.message.text.strip()
         if text.isdigit():
             option_number = int(text)
-            chat_modes = list(chatgpt.CHAT_MODES.keys())
+            chat_modes = chatgpt.CHAT_MODES.current
 
-            if 1 <= option_number <= len(chat_modes):
-                chat_mode = chat_modes[option_number - 1]
+            if 1 <= option_number <= len(chat_modes.keys):
+                chat_mode = chat_modes.keys[option_number - 1]
 
                 await context.bot.edit_message_text(
-                    text=f"{chatgpt.CHAT_MODES[chat_mode]['welcome_message']}",
+                    text=chat_modes.modes[chat_mode].welcome_message,
                     parse_mode=ParseMode.HTML,
-                    chat_id=expecting_mode_selection[user_id]["chat_id"],
-                    message_id=expecting_mode_selection[user_id]["message_id"]
+                    chat_id=pending_selection["chat_id"],
+                    message_id=pending_selection["message_id"]
                 )
 
-                del expecting_mode_selection[user_id]  # Clear the state after selection
+                await coordinator.pop_pending_selection(user_id)  # Clear the state after selection
 
-                db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-                db.start_new_dialog(user_id)
+                await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+                await db.start_new_dialog(user_id)
                 logger.info(
                     "User {} set chat mode to {} via number sending",
                     user_id,
@@ -313,14 +477,18 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await query.answer()
 
     chat_mode = query.data.split("|")[1]
+    if chat_mode not in chatgpt.CHAT_MODES:
+        # the keyboard was sent before the chat mode was removed from the file
+        await query.edit_message_text("This chat mode is no longer available, send /mode to select another one.")
+        return
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
     logger.info("User {} set chat mode to {} via message selection options (tg keyboard)", user_id, chat_mode)
 
-    del expecting_mode_selection[user_id]  # Clear the state after selection
+    await coordinator.pop_pending_selection(user_id)  # Clear the state after selection
 
-    await query.edit_message_text(f"{chatgpt.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+    await query.edit_message_text(chatgpt.CHAT_MODES.get(chat_mode).welcome_message, parse_mode=ParseMode.HTML)
 
 
 async def edited_message_handle(update: Update, context: CallbackContext):
@@ -344,7 +512,7 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
         )
 
         # split text into multiple messages due to 4096 character limit
-        for message_chunk in split_text_into_chunks(message, 4096):
+        for message_chunk in formatting.split_text_into_chunks(message, parse_mode="html"):
             try:
                 await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML)
             except BadRequest:
@@ -361,17 +529,54 @@ async def post_init(application: Application):
         BotCommand("/retry", "Regenerate response for previous query"),
         BotCommand("/help", "Show help message"),
     ])
-
-
-def run_bot() -> None:
-    application = (
+    await chatgpt.open_http_session(
+        pool_size=config.openai_http_pool_size,
+        keepalive_timeout=config.openai_http_keepalive_timeout
+    )
+    if config.metrics_port is not None:
+        await metrics_http.start(config.metrics_listen, config.metrics_port)
+    chatgpt.CHAT_MODES.start_watching(config.chat_modes_reload_interval)
+    if retention_job is not None:
+        retention_job.start()
+    if snapshot_job is not None:
+        snapshot_job.start()
+
+
+async def post_shutdown(application: Application):
+    await chatgpt.CHAT_MODES.stop_watching()
+    if retention_job is not None:
+        await retention_job.stop()
+    await dialog_summarizer.close()
+    await metrics_http.stop()
+    await chatgpt.close_http_session()
+    await chatgpt.cache.close()
+    chatgpt.prompt_log.close()
+    await coordinator.close()
+    if snapshot_job is not None:
+        # the last changes are copied before closing the database checkpoints the WAL
+        await db.flush()
+        await snapshot_job.stop()
+    await db.close()
+
+
+def build_application() -> Application:
+    application_builder = (
         ApplicationBuilder()
         .token(config.telegram_token)
         .concurrent_updates(True)
         .rate_limiter(AIORateLimiter(max_retries=5))
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    if config.telegram_api_base_url is not None:
+        # a self-hosted Bot API server is usually reached over plain http, which has no HTTP/2 negotiation
+        application_builder = (
+            application_builder
+            .base_url(config.telegram_api_base_url)
+            .http_version("1.1")
+            .get_updates_http_version("1.1")
+        )
+    application = application_builder.build()
 
     # add handlers
     if len(config.allowed_telegram_usernames) == 0:
@@ -391,8 +596,30 @@ def run_bot() -> None:
 
     application.add_error_handler(error_handle)
 
+    return application
+
+
+def run_bot() -> None:
+    if config.telegram_update_mode == "webhook":
+        # checked before anything is started, an open webhook would accept forged updates
+        webhook.check_webhook_config(config.telegram_webhook_url, config.telegram_webhook_secret_token)
+
+    application = build_application()
+
     # start the bot
-    application.run_polling()
+    if config.telegram_update_mode == "webhook":
+        asyncio.run(webhook.run_webhook(
+            application,
+            config.telegram_webhook_url,
+            listen=config.telegram_webhook_listen,
+            port=config.telegram_webhook_port,
+            path=config.telegram_webhook_path,
+            secret_token=config.telegram_webhook_secret_token
+        ))
+    elif config.telegram_update_mode == "polling":
+        application.run_polling()
+    else:
+        raise ValueError(f"Unknown telegram_update_mode: {config.telegram_update_mode}")
 
 
 if __name__ == "__main__":
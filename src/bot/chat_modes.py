@@ -0,0 +1,176 @@
+"""Chat modes from `chat_modes.json`, compiled once per load and reloaded without a restart.
+
+Loading validates the file and builds what handlers need from a mode: its system message, Telegram parse
+mode, the token count of its system prompt and the /mode keyboard. A load results in an immutable
+ChatModes snapshot which replaces the previous one in a single assignment, so a reload is never seen half
+done. A handler resolves the mode of an update once and keeps the ChatMode, so answers streamed during a
+reload finish with the mode they started with.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import signal
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+import metrics
+import tokens
+
+RELOADS = metrics.counter("bot_chat_mode_reloads_total", "Reloads of the chat mode file", ("result",))
+
+DEFAULT_CHAT_MODE = "assistant"
+
+PARSE_MODES = {
+    "html": ParseMode.HTML,
+    "markdown": ParseMode.MARKDOWN
+}
+
+_REQUIRED_FIELDS = ("name", "welcome_message", "prompt_start", "parse_mode")
+
+
+class ChatMode:
+    __slots__ = (
+        "key", "name", "welcome_message", "prompt_start", "parse_mode", "telegram_parse_mode", "backend",
+        "cache", "system_message", "prompt_start_tokens"
+    )
+
+    def __init__(self, key: str, chat_mode_dict: dict, token_model: str):
+        self.key = key
+        self.name: str = chat_mode_dict["name"]
+        self.welcome_message: str = chat_mode_dict["welcome_message"]
+        self.prompt_start: str = chat_mode_dict["prompt_start"]
+        self.parse_mode: str = chat_mode_dict["parse_mode"]
+        self.telegram_parse_mode = PARSE_MODES[self.parse_mode]
+        self.backend: Optional[str] = chat_mode_dict.get("backend")
+        self.cache: Optional[bool] = chat_mode_dict.get("cache")
+
+        self.system_message = {"role": "system", "content": self.prompt_start}
+        self.prompt_start_tokens = tokens.count_message_tokens(self.system_message, token_model)
+
+
+class ChatModes:
+    """One loaded version of the chat mode file."""
+
+    def __init__(self, modes: dict[str, ChatMode], file_id: tuple):
+        self.modes = modes
+        self.keys = tuple(modes)
+        self.file_id = file_id
+        self.keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(text=f"{i}. {chat_mode.name}", callback_data=f"set_chat_mode|{key}")]
+            for i, (key, chat_mode) in enumerate(modes.items(), start=1)
+        ])
+        self.default = modes.get(DEFAULT_CHAT_MODE) or next(iter(modes.values()))
+
+
+def validate(raw: object) -> dict[str, dict]:
+    """Raises ValueError describing the first problem of the chat mode file."""
+    if not isinstance(raw, dict) or len(raw) == 0:
+        raise ValueError("chat modes must be a non-empty object of chat mode name to chat mode")
+    for key, chat_mode_dict in raw.items():
+        if not isinstance(chat_mode_dict, dict):
+            raise ValueError(f"chat mode {key} must be an object")
+        for field in _REQUIRED_FIELDS:
+            if not isinstance(chat_mode_dict.get(field), str):
+                raise ValueError(f"chat mode {key} must have a string field {field}")
+        # Telegram does not send empty texts, an empty prompt_start is fine
+        for field in ("name", "welcome_message"):
+            if not chat_mode_dict[field].strip():
+                raise ValueError(f"chat mode {key} field {field} must not be empty")
+        if chat_mode_dict["parse_mode"] not in PARSE_MODES:
+            raise ValueError(f"chat mode {key} has unsupported parse_mode {chat_mode_dict['parse_mode']}, "
+                             f"expected one of {', '.join(PARSE_MODES)}")
+        if chat_mode_dict.get("backend") is not None and not isinstance(chat_mode_dict["backend"], str):
+            raise ValueError(f"chat mode {key} field backend must be a string")
+        if chat_mode_dict.get("cache") is not None and not isinstance(chat_mode_dict["cache"], bool):
+            raise ValueError(f"chat mode {key} field cache must be true or false")
+        # the key is sent back in callback data, which Telegram limits to 64 bytes
+        if len(f"set_chat_mode|{key}".encode("utf-8")) > 64:
+            raise ValueError(f"chat mode name {key} is too long")
+    return raw
+
+
+class ChatModeRegistry:
+    def __init__(self, path: Path, token_model: str):
+        self.path = Path(path)
+        self.token_model = token_model
+
+        # an invalid file at startup is fatal, later it only keeps the previous chat modes
+        self.current = self._load()
+        # a broken version of the file is reported once, not on every check
+        self._failed_file_id: Optional[tuple] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.current.modes
+
+    def get(self, key: str) -> ChatMode:
+        """The chat mode, the default one if it was removed from the file."""
+        current = self.current
+        return current.modes.get(key) or current.default
+
+    def reload(self) -> bool:
+        try:
+            chat_modes = self._load()
+        except (OSError, ValueError) as e:
+            try:
+                self._failed_file_id = self._file_id()
+            except OSError:
+                self._failed_file_id = None
+            RELOADS.inc(result="error")
+            logger.error(f"Failed to reload chat modes from {self.path}, keeping the previous ones: {e}")
+            return False
+
+        self.current = chat_modes
+        RELOADS.inc(result="ok")
+        logger.info(f"Reloaded {len(chat_modes.modes)} chat modes from {self.path}")
+        return True
+
+    def reload_if_changed(self) -> bool:
+        try:
+            file_id = self._file_id()
+        except OSError:
+            return False
+        return file_id not in (self.current.file_id, self._failed_file_id) and self.reload()
+
+    def start_watching(self, interval: Optional[float]):
+        """Reloads the file on SIGHUP and, if `interval` is set, when it changes."""
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(asyncio.to_thread(self.reload)))
+        except (AttributeError, NotImplementedError, RuntimeError):
+            # no SIGHUP on this platform, or not running in the main thread
+            pass
+        if interval is not None:
+            self._watcher = asyncio.create_task(self._watch(interval))
+
+    async def stop_watching(self):
+        with contextlib.suppress(AttributeError, NotImplementedError, RuntimeError):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+
+    async def _watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            # token counts of long prompts are computed off the event loop
+            await asyncio.to_thread(self.reload_if_changed)
+
+    def _file_id(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _load(self) -> ChatModes:
+        file_id = self._file_id()
+        with open(self.path, "r", encoding="utf-8") as file:
+            raw = validate(json.load(file))
+        return ChatModes(
+            {key: ChatMode(key, chat_mode_dict, self.token_model) for key, chat_mode_dict in raw.items()},
+            file_id
+        )
@@ -1,15 +1,42 @@
-import json
+import bisect
 
+import aiohttp
 import openai
-from loguru import logger
 
+import backends
+import chat_modes
+import completion_cache
+import completion_log
 import conf as config
+import tokens
+import tracing
 
 # setup openai
 openai.api_key = config.hugging_face_as_openai_api_key
 if config.openai_api_base is not None:
     openai.api_base = config.openai_api_base
 
+router = backends.create_router(
+    config.completion_backends,
+    config.openai_api_base,
+    config.hugging_face_as_openai_api_key,
+    error_rate_threshold=config.completion_backend_error_rate_threshold,
+    open_seconds=config.completion_backend_open_seconds,
+    hedge_after=config.completion_backend_hedge_after
+)
+
+cache = completion_cache.CompletionCache(
+    max_size=config.completion_cache_size,
+    ttl=config.completion_cache_ttl,
+    sqlite_path=config.completion_cache_sqlite_path
+)
+
+# prompts and answers are logged by a background thread
+prompt_log = completion_log.CompletionLog(
+    sample_rate=config.completion_log_sample_rate,
+    max_chars=config.completion_log_max_chars
+)
+
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
     "max_tokens": 1000,
@@ -19,92 +46,206 @@ OPENAI_COMPLETION_OPTIONS = {
     "request_timeout": 60.0,
 }
 
-with open('bot/chat_modes.json', 'r') as file:
-    CHAT_MODES = json.load(file)
+DEFAULT_MODEL = "gpt-4-turbo"
+
+# compiled chat modes, reloaded when the file changes
+CHAT_MODES = chat_modes.ChatModeRegistry(config.chat_modes_path, DEFAULT_MODEL)
+
+# earlier messages of long dialogs are sent as a summary
+DIALOG_SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for your own memory. Keep facts, names, decisions, open questions and "
+    "preferences of the user, drop small talk. Write in the language of the conversation, as briefly as possible."
+)
+
+# cached answers are replayed as a stream growing by about this many characters per delta
+CACHED_ANSWER_PART_SIZE = 200
+
+# application-wide HTTP session, so completions reuse pooled keep-alive connections to the backend
+_http_session: aiohttp.ClientSession | None = None
+
+
+async def open_http_session(pool_size: int = 100, keepalive_timeout: float = 30.0):
+    global _http_session
+    connector = aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=keepalive_timeout)
+    _http_session = aiohttp.ClientSession(connector=connector)
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+class ContextInfo:
+    """Prompt messages sent to the backend and how many first dialog messages were left out of them."""
+    __slots__ = ("messages", "n_first_dialog_messages_removed")
+
+    def __init__(self, messages: list[dict[str, str]], n_first_dialog_messages_removed: int):
+        self.messages = messages
+        self.n_first_dialog_messages_removed = n_first_dialog_messages_removed
+
+
+class TextDelta:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class Finished:
+    __slots__ = ("answer", "messages", "n_first_dialog_messages_removed")
+
+    def __init__(self, answer: str, messages: list[dict[str, str]], n_first_dialog_messages_removed: int):
+        self.answer = answer
+        self.messages = messages
+        self.n_first_dialog_messages_removed = n_first_dialog_messages_removed
 
 
 class ChatGPT:
-    def __init__(self, model="gpt-4-turbo"):
+    def __init__(self, model=DEFAULT_MODEL):
         self.model = model
 
-    async def send_message_stream(
+    def routed_model(self, preferred_backend: str | None = None) -> str:
+        """Model of the backend a completion is sent to first, unless that backend fails."""
+        return router.candidates(preferred_backend)[0].model or self.model
+
+    async def send_message_deltas(
             self,
             message: str,
             dialog_messages: list[dict[str, str]] | None = None,
-            chat_mode: str = "assistant"
+            chat_mode: str = "assistant",
+            dialog_summary: str | None = None
     ):
+        """Streams the answer as events: ContextInfo once the prompt is sent, TextDelta for every new part
+        of the answer and Finished with the whole postprocessed answer."""
         if dialog_messages is None:
             dialog_messages = []
 
-        if chat_mode not in CHAT_MODES.keys():
+        if chat_mode not in CHAT_MODES:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
+        # resolved once, a reload of the chat modes does not change a completion in progress
+        mode = CHAT_MODES.get(chat_mode)
+        # the prompt is fitted to, and cached for, the model of the backend it is sent to
+        model = self.routed_model(mode.backend)
 
         n_dialog_messages_before = len(dialog_messages)
+        with tracing.span("context_fit"):
+            dialog_messages = self._fit_dialog_messages(message, dialog_messages, mode, model, dialog_summary)
         answer = None
         while answer is None:
+            n_deltas = 0
             try:
-                messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                logger.info(f'Prompt:\n{messages}')
-
-                r_gen = await openai.ChatCompletion.acreate(
-                    model=self.model,
-                    messages=messages,
-                    stream=True,
-                    **OPENAI_COMPLETION_OPTIONS
-                )
-
-                answer = ""
-                async for r_item in r_gen:
-                    delta = r_item.choices[0].delta
-                    if "content" in delta:
-                        answer += delta.content
-                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, messages, n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
+                messages = self._generate_prompt_messages(message, dialog_messages, mode, dialog_summary)
+                completion_id = prompt_log.log_prompt(messages, chat_mode, model)
+
+                n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                yield ContextInfo(messages, n_first_dialog_messages_removed)
+
+                cache_key = self._cache_key(messages, mode, model)
+                with tracing.span("cache_lookup"):
+                    cached_answer = await cache.get(cache_key) if cache_key is not None else None
+                if cached_answer is not None:
+                    for answer_part in self._replay_parts(cached_answer):
+                        yield TextDelta(answer_part)
+                    answer = cached_answer
+                    break
+
+                openai.aiosession.set(_http_session)
+                answer_parts = []
+                async for delta_content in router.stream(
+                        lambda backend: self._stream_completion(backend, messages),
+                        preferred=mode.backend
+                ):
+                    answer_parts.append(delta_content)
+                    n_deltas += 1
+                    yield TextDelta(delta_content)
+
+                answer = self._postprocess_answer("".join(answer_parts))
+                if cache_key is not None and answer:
+                    await cache.put(cache_key, answer)
+
+            except openai.error.InvalidRequestError as e:  # too many tokens, local count was not accurate enough
+                if len(dialog_messages) == 0 or n_deltas > 0:
                     raise e
 
                 # forget first message in dialog_messages
                 dialog_messages = dialog_messages[1:]
 
-        logger.info(answer)
+        prompt_log.log_answer(completion_id, answer, cached=cached_answer is not None)
 
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-        yield 'finished', answer, messages, n_first_dialog_messages_removed
+        yield Finished(answer, messages, n_first_dialog_messages_removed)
+
+    async def send_message_stream(
+            self,
+            message: str,
+            dialog_messages: list[dict[str, str]] | None = None,
+            chat_mode: str = "assistant",
+            dialog_summary: str | None = None
+    ):
+        """`send_message_deltas` as (status, answer so far, prompt messages, n first dialog messages removed)."""
+        answer = ""
+        messages = None
+        n_first_dialog_messages_removed = 0
+        async for event in self.send_message_deltas(
+                message, dialog_messages=dialog_messages, chat_mode=chat_mode, dialog_summary=dialog_summary
+        ):
+            if isinstance(event, ContextInfo):
+                messages = event.messages
+                n_first_dialog_messages_removed = event.n_first_dialog_messages_removed
+            elif isinstance(event, TextDelta):
+                answer += event.text
+                yield "not_finished", answer, messages, n_first_dialog_messages_removed
+            else:
+                yield "finished", event.answer, event.messages, event.n_first_dialog_messages_removed
 
     async def send_message(
             self,
             message: str,
             dialog_messages: list[dict[str, str]] | None = None,
-            chat_mode: str = "assistant"
+            chat_mode: str = "assistant",
+            dialog_summary: str | None = None
     ):
         if dialog_messages is None:
             dialog_messages = []
 
-        if chat_mode not in CHAT_MODES.keys():
+        if chat_mode not in CHAT_MODES:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
+        # resolved once, a reload of the chat modes does not change a completion in progress
+        mode = CHAT_MODES.get(chat_mode)
+        # the prompt is fitted to, and cached for, the model of the backend it is sent to
+        model = self.routed_model(mode.backend)
 
         n_dialog_messages_before = len(dialog_messages)
+        with tracing.span("context_fit"):
+            dialog_messages = self._fit_dialog_messages(message, dialog_messages, mode, model, dialog_summary)
         answer = None
         while answer is None:
             try:
-                messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                logger.info(f'Prompt:\n{messages}')
-                r = await openai.ChatCompletion.acreate(
-                    model=self.model,
-                    messages=messages,
-                    **OPENAI_COMPLETION_OPTIONS
+                messages = self._generate_prompt_messages(message, dialog_messages, mode, dialog_summary)
+                completion_id = prompt_log.log_prompt(messages, chat_mode, model)
+                cache_key = self._cache_key(messages, mode, model)
+                with tracing.span("cache_lookup"):
+                    answer = await cache.get(cache_key) if cache_key is not None else None
+                if answer is not None:
+                    prompt_log.log_answer(completion_id, answer, cached=True)
+                    break
+
+                openai.aiosession.set(_http_session)
+                answer = await router.complete(
+                    lambda backend: self._completion(backend, messages),
+                    preferred=mode.backend
                 )
-                answer = r.choices[0].message["content"]
-                logger.info(f'ChatGPT answer:\n{answer}')
+                prompt_log.log_answer(completion_id, answer)
 
                 answer = self._postprocess_answer(answer)
+                if cache_key is not None and answer:
+                    await cache.put(cache_key, answer)
 
-            except openai.error.InvalidRequestError as e:  # too many tokens
+            except openai.error.InvalidRequestError as e:  # too many tokens, local count was not accurate enough
                 if len(dialog_messages) == 0:
                     raise ValueError(
                         "Dialog messages is reduced to zero, but still has too many tokens to make completion"
@@ -117,9 +258,150 @@ class ChatGPT:
 
         return answer, messages, n_first_dialog_messages_removed
 
+    @staticmethod
+    def _cache_key(messages: list[dict[str, str]], mode: chat_modes.ChatMode, model: str) -> str | None:
+        """Key of the answer in the completion cache, None if the chat mode is not cached."""
+        if not (mode.cache if mode.cache is not None else config.completion_cache_enabled):
+            return None
+        options = {key: value for key, value in OPENAI_COMPLETION_OPTIONS.items() if key != "request_timeout"}
+        return completion_cache.make_key(model, mode.key, messages, options)
+
+    @staticmethod
+    def _replay_parts(answer: str):
+        """A cached answer in parts of about CACHED_ANSWER_PART_SIZE characters, cut at word boundaries."""
+        part_start = 0
+        while part_start < len(answer):
+            part_end = answer.find(" ", part_start + CACHED_ANSWER_PART_SIZE)
+            if part_end == -1:
+                part_end = len(answer)
+            yield answer[part_start:part_end]
+            part_start = part_end
+
+    async def _stream_completion(self, backend: backends.Backend, messages: list[dict[str, str]]):
+        r_gen = await openai.ChatCompletion.acreate(
+            model=backend.model or self.model,
+            messages=messages,
+            stream=True,
+            **{**OPENAI_COMPLETION_OPTIONS, **backend.request_options()}
+        )
+        try:
+            async for r_item in r_gen:
+                delta = r_item.choices[0].delta
+                if "content" in delta:
+                    yield delta.content
+        finally:
+            # the response is closed even if the stream is abandoned, e.g. by a lost hedge
+            await r_gen.aclose()
+
+    async def _completion(self, backend: backends.Backend, messages: list[dict[str, str]], **options):
+        r = await openai.ChatCompletion.acreate(
+            model=backend.model or self.model,
+            messages=messages,
+            **{**OPENAI_COMPLETION_OPTIONS, **options, **backend.request_options()}
+        )
+        yield r.choices[0].message["content"]
+
+    async def summarize(
+            self,
+            dialog_messages: list[dict[str, str]],
+            previous_summary: str | None = None,
+            max_tokens: int = 500
+    ) -> tuple[str, int]:
+        """Folds the oldest dialog messages into the previous summary of the dialog, as many as fit into the
+        context window. Returns the new summary and how many dialog messages it folded."""
+        earlier_summary = f"Earlier summary:\n{previous_summary}\n\n" if previous_summary else ""
+        dialog_messages = self._fit_messages_to_summarize(
+            dialog_messages, earlier_summary, self.routed_model(), max_tokens
+        )
+        if len(dialog_messages) == 0:
+            raise ValueError("The previous summary leaves no room for dialog messages")
+
+        transcript = earlier_summary
+        for dialog_message in dialog_messages:
+            transcript += f"User: {dialog_message['user']}\nAssistant: {dialog_message['bot']}\n"
+        messages = [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}]
+
+        openai.aiosession.set(_http_session)
+        summary = await router.complete(
+            lambda backend: self._completion(backend, messages, max_tokens=max_tokens, temperature=0)
+        )
+        return self._postprocess_answer(summary), len(dialog_messages)
+
+    @staticmethod
+    def _fit_messages_to_summarize(
+            dialog_messages: list[dict[str, str]],
+            earlier_summary: str,
+            model: str,
+            max_tokens: int
+    ) -> list[dict[str, str]]:
+        """The oldest dialog messages which fit into the context window of model next to the summary prompt.
+
+        Unlike a prompt, the transcript keeps the oldest messages: the ones left out are folded next time.
+        """
+        max_context_tokens = config.max_context_tokens or tokens.get_context_window(model)
+        budget = max_context_tokens - max_tokens - tokens.TOKENS_PER_REPLY
+        budget -= tokens.count_message_tokens({"role": "system", "content": SUMMARY_PROMPT}, model)
+        budget -= tokens.count_message_tokens({"role": "user", "content": earlier_summary}, model)
+
+        n_kept = 0
+        for dialog_message in dialog_messages:
+            n_tokens = tokens.count_dialog_message_tokens(dialog_message, model)
+            if n_tokens > budget:
+                break
+            budget -= n_tokens
+            n_kept += 1
+
+        if n_kept == 0 and len(dialog_messages) > 0 and budget > 0:
+            # a single exchange longer than the context window is cut, a token takes at least one character
+            first = dialog_messages[0]
+            n_chars = budget // 2
+            return [{**first, "user": (first["user"] or "")[:n_chars], "bot": (first["bot"] or "")[:n_chars]}]
+        return dialog_messages[:n_kept]
+
+    @staticmethod
+    def _fit_dialog_messages(
+            message: str,
+            dialog_messages: list[dict[str, str]],
+            mode: chat_modes.ChatMode,
+            model: str,
+            dialog_summary: str | None = None
+    ) -> list[dict[str, str]]:
+        """Drops the oldest dialog messages until the prompt and the answer fit into the context window of model."""
+        max_context_tokens = config.max_context_tokens or tokens.get_context_window(model)
+        budget = max_context_tokens - OPENAI_COMPLETION_OPTIONS["max_tokens"] - tokens.TOKENS_PER_REPLY
+        if model == CHAT_MODES.token_model:
+            budget -= mode.prompt_start_tokens
+        else:
+            budget -= tokens.count_message_tokens(mode.system_message, model)
+        budget -= tokens.count_message_tokens({"role": "user", "content": message}, model)
+        if dialog_summary is not None:
+            budget -= tokens.count_message_tokens(ChatGPT._summary_message(dialog_summary), model)
+
+        if (
+                len(dialog_messages) > 0
+                and tokens.has_same_tokenizer(model, tokens.STORED_COUNTS_MODEL)
+                and all(dialog_message.get("cum_tokens") is not None for dialog_message in dialog_messages)
+        ):
+            # running totals stored with messages: find the first message to keep with a binary search
+            cum_tokens = [dialog_message["cum_tokens"] for dialog_message in dialog_messages]
+            total_tokens = cum_tokens[-1]
+            first_cum_tokens = cum_tokens[0] - dialog_messages[0]["n_tokens"]
+            if total_tokens - first_cum_tokens <= budget:
+                return dialog_messages
+            return dialog_messages[bisect.bisect_left(cum_tokens, total_tokens - budget) + 1:]
+
+        n_kept = 0
+        for dialog_message in reversed(dialog_messages):
+            budget -= tokens.count_dialog_message_tokens(dialog_message, model)
+            if budget < 0:
+                break
+            n_kept += 1
+
+        return dialog_messages[len(dialog_messages) - n_kept:]
+
     @staticmethod
     def _generate_prompt(message, dialog_messages, chat_mode):
-        prompt = CHAT_MODES[chat_mode]["prompt_start"]
+        prompt = CHAT_MODES.get(chat_mode).prompt_start
         prompt += "\n\n"
 
         # add chat context
@@ -135,15 +417,21 @@ class ChatGPT:
 
         return prompt
 
+    @staticmethod
+    def _summary_message(dialog_summary: str) -> dict[str, str]:
+        return {"role": "system", "content": f"{DIALOG_SUMMARY_PREFIX}{dialog_summary}"}
+
     @staticmethod
     def _generate_prompt_messages(
             message: str,
             dialog_messages: list[dict[str, str]],
-            chat_mode: str
+            mode: chat_modes.ChatMode,
+            dialog_summary: str | None = None
     ) -> list[dict[str, str]]:
-        prompt = CHAT_MODES[chat_mode]["prompt_start"]
-
-        messages = [{"role": "system", "content": prompt}]
+        messages = [mode.system_message]
+        if dialog_summary is not None:
+            # stands in for the dialog messages it was made of
+            messages.append(ChatGPT._summary_message(dialog_summary))
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
@@ -0,0 +1,145 @@
+"""Answers to repeated prompts, e.g. the same greeting sent as the first message of a dialog.
+
+Answers are kept in memory (LRU, at most `max_size`) and, if `sqlite_path` is set, in a SQLite file
+which survives restarts and is shared by all workers on the host. Both tiers expire answers `ttl`
+seconds after they were stored.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Optional
+
+from loguru import logger
+
+import metrics
+
+REQUESTS = metrics.counter(
+    "bot_completion_cache_requests_total", "Completion cache lookups by the tier which answered them", ("result",)
+)
+SIZE = metrics.gauge("bot_completion_cache_size", "Answers kept in the in-memory completion cache")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    # case is kept, it can change the answer (e.g. code, names, "US" and "us")
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def make_key(model: str, chat_mode: str, messages: list[dict[str, str]], options: dict) -> str:
+    payload = json.dumps(
+        {
+            "model": model,
+            "chat_mode": chat_mode,
+            "messages": [{"role": message["role"], "content": normalize_text(message["content"])}
+                         for message in messages],
+            "options": options,
+        },
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(
+            self,
+            max_size: int = 1000,
+            ttl: float = 86400.0,
+            sqlite_path: Optional[str] = None,
+            sqlite_max_rows: int = 100000
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sqlite_max_rows = sqlite_max_rows
+
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._n_puts = 0
+
+        self._conn = None
+        self._executor = None
+        if sqlite_path is not None:
+            self._conn = sqlite3.connect(sqlite_path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, answer TEXT, created_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS completions_created_at ON completions (created_at)")
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="completion-cache")
+
+        SIZE.set_function(lambda: len(self._entries))
+
+    async def close(self):
+        if self._conn is not None:
+            self._executor.shutdown(wait=True)
+            self._conn.close()
+            self._conn = None
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            answer, created_at = entry
+            if time.time() - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                REQUESTS.inc(result="memory_hit")
+                return answer
+            del self._entries[key]
+
+        if self._conn is not None:
+            try:
+                rows = await self._execute(
+                    "SELECT answer, created_at FROM completions WHERE key = ? AND created_at >= ?",
+                    (key, time.time() - self.ttl)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to read completion cache: {e}")
+                rows = []
+            if rows:
+                answer, created_at = rows[0]
+                self._put_in_memory(key, answer, created_at)
+                REQUESTS.inc(result="disk_hit")
+                return answer
+
+        REQUESTS.inc(result="miss")
+        return None
+
+    async def put(self, key: str, answer: str):
+        created_at = time.time()
+        self._put_in_memory(key, answer, created_at)
+
+        if self._conn is not None:
+            self._n_puts += 1
+            try:
+                await self._execute(
+                    "INSERT OR REPLACE INTO completions (key, answer, created_at) VALUES (?, ?, ?)",
+                    (key, answer, created_at)
+                )
+                if self._n_puts % 100 == 0:
+                    await self._execute("DELETE FROM completions WHERE created_at < ?", (created_at - self.ttl,))
+                    await self._execute(
+                        "DELETE FROM completions WHERE key IN "
+                        "(SELECT key FROM completions ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                        (self.sqlite_max_rows,)
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to write completion cache: {e}")
+
+    def _put_in_memory(self, key: str, answer: str, created_at: float):
+        self._entries[key] = (answer, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _execute(self, query: str, params: tuple = ()) -> list[tuple]:
+        def execute():
+            with closing(self._conn.execute(query, params)) as cursor:
+                return cursor.fetchall()
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, execute)
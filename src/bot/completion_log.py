@@ -0,0 +1,86 @@
+"""Logging of prompts and answers off the event loop.
+
+The handler only decides whether a completion is sampled and puts references to its prompt and answer
+into a bounded queue. A background thread truncates them, turns them into one JSON record each and
+hands the record to loguru, so a long dialog history is never formatted on the event loop. Records which
+do not fit into the queue are dropped and counted.
+"""
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+import metrics
+
+RECORDS = metrics.counter("bot_completion_log_records_total", "Prompt and answer log records", ("result",))
+
+_STOP = object()
+
+
+class CompletionLog:
+    def __init__(self, sample_rate: float = 1.0, max_chars: int = 2000, max_pending: int = 1000):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+
+        self._ids = itertools.count(1)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+    def log_prompt(self, messages: list[dict[str, str]], chat_mode: str, model: str) -> Optional[int]:
+        """Returns the id to log the answer with, None if the completion is not sampled."""
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        completion_id = next(self._ids)
+        # the prompt messages are not changed once they were sent, so they are not copied
+        self._put(("prompt", completion_id, time.time(), {"chat_mode": chat_mode, "model": model}, messages))
+        return completion_id
+
+    def log_answer(self, completion_id: Optional[int], answer: str, cached: bool = False):
+        if completion_id is None:
+            return
+        self._put(("answer", completion_id, time.time(), {"cached": cached}, answer))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _put(self, record: tuple):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_records, name="completion-log", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            RECORDS.inc(result="dropped")
+
+    def _write_records(self):
+        while (record := self._queue.get()) is not _STOP:
+            try:
+                logger.info(self._format_record(*record))
+                RECORDS.inc(result="written")
+            except Exception as e:
+                logger.warning(f"Failed to write completion log record: {e}")
+
+    def _format_record(self, event: str, completion_id: int, at: float, fields: dict, payload) -> str:
+        record = {"event": event, "completion_id": completion_id, "at": at, **fields}
+        if event == "prompt":
+            record["n_messages"] = len(payload)
+            record["messages"] = [
+                {"role": message["role"], "content": self._truncate(message["content"])} for message in payload
+            ]
+        else:
+            record["chars"] = len(payload)
+            record["answer"] = self._truncate(payload)
+        return json.dumps(record, ensure_ascii=False)
+
+    def _truncate(self, text: str) -> str:
+        if len(text) <= self.max_chars:
+            return text
+        return text[:self.max_chars] + f"... [{len(text) - self.max_chars} more chars]"
@@ -1,8 +1,10 @@
+import os
+
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+config_dir = Path(os.environ.get("CHATGPT_BOT_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"))
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -14,12 +16,74 @@ config_env = dotenv.dotenv_values(config_dir / "config.env")
 # config parameters
 telegram_token = config_yaml["telegram_token"]
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
+telegram_api_base_url = config_yaml.get("telegram_api_base_url", None)
+telegram_update_mode = config_yaml.get("telegram_update_mode", "polling")
+telegram_webhook_url = config_yaml.get("telegram_webhook_url", None)
+telegram_webhook_listen = config_yaml.get("telegram_webhook_listen", "0.0.0.0")
+telegram_webhook_port = config_yaml.get("telegram_webhook_port", 8443)
+telegram_webhook_path = config_yaml.get("telegram_webhook_path", "/telegram")
+telegram_webhook_secret_token = config_yaml.get("telegram_webhook_secret_token", None)
 
 hugging_face_as_openai_api_key = config_yaml["hugging_face_as_openai_api_key"]
 openai_api_base = config_yaml.get("openai_api_base", None)
+max_context_tokens = config_yaml.get("max_context_tokens", None)
+openai_http_pool_size = config_yaml.get("openai_http_pool_size", 100)
+openai_http_keepalive_timeout = config_yaml.get("openai_http_keepalive_timeout", 30)
+completion_backends = config_yaml.get("completion_backends") or []
+completion_backend_error_rate_threshold = config_yaml.get("completion_backend_error_rate_threshold", 0.5)
+completion_backend_open_seconds = config_yaml.get("completion_backend_open_seconds", 30)
+completion_backend_hedge_after = config_yaml.get("completion_backend_hedge_after", None)
+completion_cache_enabled = config_yaml.get("completion_cache_enabled", False)
+completion_cache_size = config_yaml.get("completion_cache_size", 1000)
+completion_cache_ttl = config_yaml.get("completion_cache_ttl", 86400)
+completion_cache_sqlite_path = config_yaml.get("completion_cache_sqlite_path", None)
+completion_log_sample_rate = config_yaml.get("completion_log_sample_rate", 1.0)
+completion_log_max_chars = config_yaml.get("completion_log_max_chars", 2000)
+completion_max_in_flight = config_yaml.get("completion_max_in_flight", 64)
+completion_model_concurrency = config_yaml.get("completion_model_concurrency") or {}
+completion_user_weights = config_yaml.get("completion_user_weights") or {}
 
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
+# relative to the config directory, the chat modes shipped with the bot by default
+chat_modes_path = config_dir / (config_yaml.get("chat_modes_path") or Path(__file__).parent / "chat_modes.json")
+chat_modes_reload_interval = config_yaml.get("chat_modes_reload_interval", 5)
+dialog_summary_threshold_tokens = config_yaml.get("dialog_summary_threshold_tokens", None)
+dialog_summary_keep_messages = config_yaml.get("dialog_summary_keep_messages", 4)
+dialog_summary_max_tokens = config_yaml.get("dialog_summary_max_tokens", 500)
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+stream_edit_chat_interval = config_yaml.get("stream_edit_chat_interval", 1.0)
+stream_edit_global_rate = config_yaml.get("stream_edit_global_rate", 20)
 sqlite_database_uri = config_env['SQLITE_DATABASE_PATH']
+sqlite_read_pool_size = config_yaml.get("sqlite_read_pool_size", 4)
+user_cache_size = config_yaml.get("user_cache_size", 10000)
+user_cache_ttl = config_yaml.get("user_cache_ttl", 300)
+sqlite_flush_interval_ms = config_yaml.get("sqlite_flush_interval_ms", 50)
+sqlite_flush_max_rows = config_yaml.get("sqlite_flush_max_rows", 200)
+sqlite_synchronous = config_yaml.get("sqlite_synchronous", "normal")
+sqlite_mmap_size = config_yaml.get("sqlite_mmap_size", 256 * 1024 * 1024)
+archive_path = config_yaml.get("archive_path", str(Path(sqlite_database_uri).parent / "archive"))
+retention_max_age_days = config_yaml.get("retention_max_age_days", None)
+retention_interval = config_yaml.get("retention_interval", 3600)
+retention_batch_size = config_yaml.get("retention_batch_size", 100)
+retention_vacuum_pages = config_yaml.get("retention_vacuum_pages", 1000)
+snapshot_path = config_yaml.get("snapshot_path", str(Path(sqlite_database_uri).parent / "snapshots"))
+snapshot_interval = config_yaml.get("snapshot_interval", None)
+snapshot_delta_interval = config_yaml.get("snapshot_delta_interval", 60)
+snapshot_keep = config_yaml.get("snapshot_keep", 3)
+snapshot_pages_per_step = config_yaml.get("snapshot_pages_per_step", 256)
+snapshot_step_sleep = config_yaml.get("snapshot_step_sleep", 0.01)
+coordination_backend = config_yaml.get("coordination_backend", "local")
+coordination_sqlite_path = config_yaml.get(
+    "coordination_sqlite_path", str(Path(sqlite_database_uri).parent / "coordination.db")
+)
+coordination_lock_lease = config_yaml.get("coordination_lock_lease", 30)
+coordination_max_users = config_yaml.get("coordination_max_users", 10000)
+coordination_lock_idle_ttl = config_yaml.get("coordination_lock_idle_ttl", 3600)
+pending_selection_ttl = config_yaml.get("pending_selection_ttl", 600)
+queued_prompts_max_depth = config_yaml.get("queued_prompts_max_depth", 5)
+queued_prompts_overflow = config_yaml.get("queued_prompts_overflow", "reject")
+merge_queued_prompts = config_yaml.get("merge_queued_prompts", False)
+metrics_listen = config_yaml.get("metrics_listen", "127.0.0.1")
+metrics_port = config_yaml.get("metrics_port", None)
 
 fusion_brain_auth_token = config_yaml["fusion_brain_auth_token"]
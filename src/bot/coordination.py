@@ -0,0 +1,321 @@
+"""Per-user locks and pending mode selections, shared by all workers serving one bot token.
+
+LocalCoordinator keeps everything in the memory of a single process. SqliteCoordinator keeps it in a
+SQLite file next to the database, so several worker processes on one host (e.g. behind a webhook load
+balancer) never answer the same user twice at once.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from loguru import logger
+
+import metrics
+
+USER_LOCKS = metrics.gauge("bot_coordination_user_locks", "User locks kept in memory by the local coordinator")
+PENDING_SELECTIONS = metrics.gauge(
+    "bot_coordination_pending_selections", "Pending chat mode selections kept in memory by the local coordinator"
+)
+
+
+class _UserLock:
+    __slots__ = ("lock", "n_users", "used_at")
+
+    def __init__(self, used_at: float):
+        self.lock = asyncio.Lock()
+        # tasks holding or waiting for the lock, a lock is released before its waiter acquires it
+        self.n_users = 0
+        self.used_at = used_at
+
+
+class LockRegistry:
+    """Per-user locks, created on first use.
+
+    Idle locks are evicted in LRU order once `max_size` is reached or `ttl` seconds after their last use,
+    acquiring or releasing a lock both count as a use.
+    A lock which is held or waited for is never evicted, so two tasks never hold different locks of one user.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[int, _UserLock] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = _UserLock(now)
+        self._entries.move_to_end(user_id)
+        entry.used_at = now
+        entry.n_users += 1
+        self._evict_idle(now)
+
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.n_users -= 1
+            entry.used_at = time.monotonic()
+            # entries stay ordered by their last use, so a lock held for long is not the first one evicted
+            if self._entries.get(user_id) is entry:
+                self._entries.move_to_end(user_id)
+
+    def is_locked(self, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        return entry is not None and entry.lock.locked()
+
+    def _evict_idle(self, now: float):
+        # locks in use are moved to the end, every entry is looked at most once
+        for _ in range(len(self._entries)):
+            user_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and now - entry.used_at <= self.ttl:
+                break
+            if entry.n_users > 0:
+                self._entries.move_to_end(user_id)
+            else:
+                del self._entries[user_id]
+
+
+class PendingStateStore:
+    """Per-user state which is dropped `ttl` seconds after it was set, or in LRU order beyond `max_size`."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[int, tuple[dict, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set(self, user_id: int, state: dict):
+        now = time.monotonic()
+        self._entries[user_id] = (state, now)
+        self._entries.move_to_end(user_id)
+
+        # entries are ordered by the time they were set
+        while self._entries:
+            oldest_user_id, (_, set_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_size and now - set_at <= self.ttl:
+                break
+            del self._entries[oldest_user_id]
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        state, set_at = entry
+        if time.monotonic() - set_at > self.ttl:
+            del self._entries[user_id]
+            return None
+        return state
+
+    def pop(self, user_id: int) -> Optional[dict]:
+        state = self.get(user_id)
+        self._entries.pop(user_id, None)
+        return state
+
+
+class LocalCoordinator:
+    shared = False
+
+    def __init__(self, max_users: int = 10000, lock_idle_ttl: float = 3600.0, pending_selection_ttl: float = 600.0):
+        self._locks = LockRegistry(max_size=max_users, ttl=lock_idle_ttl)
+        self._pending_selections = PendingStateStore(max_size=max_users, ttl=pending_selection_ttl)
+
+        USER_LOCKS.set_function(lambda: len(self._locks))
+        PENDING_SELECTIONS.set_function(lambda: len(self._pending_selections))
+
+    async def close(self):
+        pass
+
+    def lock(self, user_id: int):
+        return self._locks.lock(user_id)
+
+    async def is_locked(self, user_id: int) -> bool:
+        return self._locks.is_locked(user_id)
+
+    async def set_pending_selection(self, user_id: int, state: dict):
+        self._pending_selections.set(user_id, state)
+
+    async def get_pending_selection(self, user_id: int) -> Optional[dict]:
+        return self._pending_selections.get(user_id)
+
+    async def pop_pending_selection(self, user_id: int) -> Optional[dict]:
+        return self._pending_selections.pop(user_id)
+
+
+class SqliteCoordinator:
+    """Locks are leases: a lock row expires `lease` seconds after it was last renewed, so a crashed worker
+    can not keep a user locked forever. The holder renews its lease every `lease / 3` seconds.
+
+    SQLite file locking only works on a local file system, so all workers must run on the same host.
+    """
+
+    shared = True
+
+    def __init__(
+            self,
+            path: str,
+            lease: float = 30.0,
+            pending_selection_ttl: float = 600.0,
+            poll_interval: float = 0.05
+    ):
+        self.path = path
+        self.lease = lease
+        self.pending_selection_ttl = pending_selection_ttl
+        self.poll_interval = poll_interval
+        # lock rows are owned by a worker, not by a user, so any worker can tell whose lease it is
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._conn = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_locks (user_id INTEGER PRIMARY KEY, owner TEXT, expires_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_selections (user_id INTEGER PRIMARY KEY, state TEXT, created_at REAL)"
+        )
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coordination")
+
+    async def close(self):
+        await self._execute("DELETE FROM user_locks WHERE owner = ?", (self.owner,))
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+    @asynccontextmanager
+    async def lock(self, user_id: int) -> AsyncIterator[None]:
+        while not await self._try_acquire(user_id):
+            await asyncio.sleep(self.poll_interval)
+
+        renew_task = asyncio.create_task(self._renew_periodically(user_id))
+        try:
+            yield
+        finally:
+            renew_task.cancel()
+            await self._execute("DELETE FROM user_locks WHERE user_id = ? AND owner = ?", (user_id, self.owner))
+
+    async def is_locked(self, user_id: int) -> bool:
+        rows = await self._execute(
+            "SELECT 1 FROM user_locks WHERE user_id = ? AND expires_at >= ?", (user_id, time.time())
+        )
+        return len(rows) > 0
+
+    async def set_pending_selection(self, user_id: int, state: dict):
+        now = time.time()
+        await self._execute(
+            "INSERT OR REPLACE INTO pending_selections (user_id, state, created_at) VALUES (?, ?, ?)",
+            (user_id, json.dumps(state), now)
+        )
+        # selections which were never made
+        await self._execute(
+            "DELETE FROM pending_selections WHERE created_at < ?", (now - self.pending_selection_ttl,)
+        )
+
+    async def get_pending_selection(self, user_id: int) -> Optional[dict]:
+        rows = await self._execute(
+            "SELECT state FROM pending_selections WHERE user_id = ? AND created_at >= ?",
+            (user_id, time.time() - self.pending_selection_ttl)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    async def pop_pending_selection(self, user_id: int) -> Optional[dict]:
+        rows = await self._execute(
+            "DELETE FROM pending_selections WHERE user_id = ? RETURNING state, created_at", (user_id,)
+        )
+        if rows and rows[0][1] >= time.time() - self.pending_selection_ttl:
+            return json.loads(rows[0][0])
+        return None
+
+    async def _try_acquire(self, user_id: int) -> bool:
+        now = time.time()
+        rows = await self._execute(
+            "INSERT INTO user_locks (user_id, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE user_locks.expires_at < ? "
+            "RETURNING owner",
+            (user_id, self.owner, now + self.lease, now)
+        )
+        return len(rows) > 0
+
+    async def _renew_periodically(self, user_id: int):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self._execute(
+                    "UPDATE user_locks SET expires_at = ? WHERE user_id = ? AND owner = ?",
+                    (time.time() + self.lease, user_id, self.owner)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to renew lock lease of user {user_id}: {e}")
+
+    async def _execute(self, query: str, params: tuple = ()) -> list[tuple]:
+        def execute():
+            with closing(self._conn.execute(query, params)) as cursor:
+                return cursor.fetchall()
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, execute)
+
+
+class JobLock:
+    """Exclusive lock on a file, so a background job runs in one of the workers sharing its files only.
+
+    The lock is held until `release` or until the process exits, whatever way it exits.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self) -> bool:
+        """Takes the lock if no other process holds it, returns whether it did."""
+        if self._file is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def create_coordinator(
+        backend: str,
+        sqlite_path: str,
+        lease: float = 30.0,
+        max_users: int = 10000,
+        lock_idle_ttl: float = 3600.0,
+        pending_selection_ttl: float = 600.0
+):
+    if backend == "local":
+        return LocalCoordinator(
+            max_users=max_users, lock_idle_ttl=lock_idle_ttl, pending_selection_ttl=pending_selection_ttl
+        )
+    if backend == "sqlite":
+        return SqliteCoordinator(sqlite_path, lease=lease, pending_selection_ttl=pending_selection_ttl)
+    raise ValueError(f"Unknown coordination backend: {backend}")
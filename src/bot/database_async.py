@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Any, Optional
+
+from loguru import logger
+
+from database_sqlite import SqliteDataBase, WriteJournal
+from user_cache import UserCache
+
+
+class AsyncSqliteDataBase:
+    """Non-blocking facade over SqliteDataBase.
+
+    All writes go through a single dedicated writer thread (SQLite allows one writer at a time anyway),
+    reads are served by a small pool of read-only connections working in WAL mode, so handlers can
+    `await` storage calls without stalling the event loop.
+
+    `users` rows are kept in a UserCache: a user is loaded with a single query and then served from memory.
+    User attribute updates and new dialog messages are put into a WriteJournal, which is written in one
+    transaction every `flush_interval_ms` or as soon as `flush_max_rows` changes are pending, before any other
+    write, before reading a dialog with pending messages and on close.
+    """
+
+    def __init__(
+            self,
+            sqlite_uri: str,
+            read_pool_size: int = 4,
+            user_cache_size: int = 10000,
+            user_cache_ttl: float = 300.0,
+            flush_interval_ms: int = 50,
+            flush_max_rows: int = 200,
+            synchronous: str = "NORMAL",
+            mmap_size: int = 256 * 1024 * 1024,
+            wal_autocheckpoint: Optional[int] = None
+    ):
+        self.sqlite_uri = sqlite_uri
+        self.mmap_size = mmap_size
+        self.user_cache = UserCache(max_size=user_cache_size, ttl=user_cache_ttl)
+
+        # writer connection is created first, so the schema is migrated and WAL mode is on before readers connect
+        self._writer = SqliteDataBase(
+            sqlite_uri, synchronous=synchronous, mmap_size=mmap_size, wal_autocheckpoint=wal_autocheckpoint
+        )
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+        self._readers: list[SqliteDataBase] = []
+        self._readers_lock = threading.Lock()
+        self._reader_local = threading.local()
+        self._reader_executor = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="sqlite-reader")
+
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_rows = flush_max_rows
+        self._journal = WriteJournal()
+        # journals handed over to the writer thread and not committed yet, oldest first
+        self._inflight_journals: list[WriteJournal] = []
+        self._flush_requested = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+        self._writer_executor.shutdown(wait=True)
+        self._reader_executor.shutdown(wait=True)
+        self._writer.close()
+        for reader in self._readers:
+            reader.close()
+
+    async def flush(self):
+        """Writes all journaled changes to the database."""
+        await self._run_in_writer(lambda: None)
+
+    def cache_stats(self) -> dict[str, int]:
+        return self.user_cache.stats()
+
+    # users
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False) -> bool:
+        if await self._load_user(user_id) is not None:
+            return True
+        if raise_exception:
+            raise ValueError(f"User {user_id} does not exist")
+        return False
+
+    async def get_user_attribute(self, user_id: int, key: str):
+        return (await self._load_existing_user(user_id))[key]
+
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self._load_existing_user(user_id)
+        self.user_cache.update(user_id, {key: value})
+        self._journal.set_user_attributes(user_id, {key: value})
+        self._on_journal_changed()
+
+    async def add_new_user(
+            self,
+            user_id: int,
+            chat_id: int,
+            username: str = "",
+            first_name: str = "",
+            last_name: str = "",
+    ):
+        def add_and_load():
+            self._writer.add_new_user(
+                user_id, chat_id, username=username, first_name=first_name, last_name=last_name
+            )
+            return self._writer.get_user(user_id)
+
+        self.user_cache.put(user_id, await self._run_in_writer(add_and_load))
+
+    async def start_new_dialog(self, user_id: int) -> str:
+        await self._load_existing_user(user_id)
+        dialog_id = await self._write("start_new_dialog", user_id)
+        self.user_cache.update(user_id, {"current_dialog_id": dialog_id})
+        return dialog_id
+
+    # dialogs
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+        dialog_id = dialog_id or await self.get_user_attribute(user_id, "current_dialog_id")
+        if any(journal.has_dialog_messages(dialog_id) for journal in [*self._inflight_journals, self._journal]):
+            await self.flush()
+        return await self._read("get_dialog_messages", user_id, dialog_id=dialog_id)
+
+    async def append_dialog_message(self, user_id: int, new_dialog_message: dict, dialog_id: Optional[str] = None):
+        dialog_id = dialog_id or await self.get_user_attribute(user_id, "current_dialog_id")
+        self._journal.append_dialog_message(user_id, dialog_id, new_dialog_message)
+        self._on_journal_changed()
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        dialog_id = dialog_id or await self.get_user_attribute(user_id, "current_dialog_id")
+        return await self._read("get_dialog_summary", dialog_id)
+
+    async def set_dialog_summary(
+            self,
+            dialog_id: str,
+            summary: str,
+            until_id: int,
+            previous_until_id: Optional[int] = None
+    ) -> bool:
+        return await self._write(
+            "set_dialog_summary", dialog_id, summary, until_id, previous_until_id=previous_until_id
+        )
+
+    async def remove_dialog_last_message(self, user_id: int, dialog_id: Optional[str] = None):
+        dialog_id = dialog_id or await self.get_user_attribute(user_id, "current_dialog_id")
+        return await self._write("remove_dialog_last_message", user_id, dialog_id=dialog_id)
+
+    # retention
+
+    async def archive_dialogs(self, archive, older_than: datetime, limit: int) -> int:
+        return await self._write("archive_dialogs", archive, older_than, limit)
+
+    async def get_archived_dialogs(self, user_id: int) -> list[dict]:
+        return await self._read("get_archived_dialogs", user_id)
+
+    async def get_archived_dialog(self, archive, dialog_id: str) -> Optional[dict]:
+        return await self._read("get_archived_dialog", archive, dialog_id)
+
+    async def has_incremental_vacuum(self) -> bool:
+        return await self._read("has_incremental_vacuum")
+
+    async def incremental_vacuum(self, max_pages: int) -> int:
+        return await self._write("incremental_vacuum", max_pages)
+
+    async def _load_user(self, user_id: int) -> Optional[dict]:
+        record = self.user_cache.get(user_id)
+        if record is None:
+            # a journal committed while the row is read leaves the in-flight list, but the read may predate it
+            journals = [*self._inflight_journals, self._journal]
+            record = await self._read("get_user", user_id)
+            if record is not None:
+                # journaled values are newer than the stored ones
+                journals += [
+                    journal for journal in [*self._inflight_journals, self._journal] if journal not in journals
+                ]
+                for journal in journals:
+                    record.update(journal.user_attributes.get(user_id, {}))
+                record = self.user_cache.put(user_id, record)
+        return record
+
+    async def _load_existing_user(self, user_id: int) -> dict:
+        record = await self._load_user(user_id)
+        if record is None:
+            raise ValueError(f"User {user_id} does not exist")
+        return record
+
+    def _on_journal_changed(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+        if len(self._journal) >= self.flush_max_rows:
+            self._flush_requested.set()
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+
+            if len(self._journal) == 0:
+                continue
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush write journal: {e}")
+
+    def _get_reader(self) -> SqliteDataBase:
+        # one read-only connection per pool thread
+        reader = getattr(self._reader_local, "db", None)
+        if reader is None:
+            reader = SqliteDataBase(self.sqlite_uri, read_only=True, mmap_size=self.mmap_size)
+            self._reader_local.db = reader
+            with self._readers_lock:
+                self._readers.append(reader)
+        return reader
+
+    def _run_read(self, method_name: str, *args, **kwargs):
+        return getattr(self._get_reader(), method_name)(*args, **kwargs)
+
+    async def _read(self, method_name: str, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # run_in_executor does not copy the context, spans of the query would lose the labels of the update
+        return await loop.run_in_executor(
+            self._reader_executor,
+            partial(contextvars.copy_context().run, self._run_read, method_name, *args, **kwargs)
+        )
+
+    async def _write(self, method_name: str, *args, **kwargs):
+        return await self._run_in_writer(partial(getattr(self._writer, method_name), *args, **kwargs))
+
+    async def _run_in_writer(self, func):
+        # pending journal is always written first, so changes reach the database in the order they were made
+        journal, self._journal = self._journal, WriteJournal()
+        self._inflight_journals.append(journal)
+
+        def apply_and_run():
+            self._writer.apply_journal(journal)
+            return func()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._writer_executor, contextvars.copy_context().run, apply_and_run)
+        # the journal stays in flight until the writer is done with it, even if the caller is cancelled meanwhile
+        future.add_done_callback(lambda _: self._inflight_journals.remove(journal))
+        return await asyncio.shield(future)
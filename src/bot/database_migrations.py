@@ -0,0 +1,211 @@
+"""Versioned schema migrations of the sqlite database.
+
+The schema version is kept in `PRAGMA user_version`. Migrations are applied on startup by SqliteDataBase,
+an existing database can also be upgraded offline (with a backup copy made first):
+
+    python3 bot/database_migrations.py ./db/sqlite.db
+
+Files created before incremental auto-vacuum was turned on for new databases are converted offline, by
+rewriting the whole file once, with `--enable-incremental-vacuum`.
+"""
+import argparse
+import sqlite3
+from contextlib import closing
+
+from loguru import logger
+
+import tokens
+
+
+def _v1_initial_schema(cursor: sqlite3.Cursor):
+    # databases created before migrations were introduced already have these tables, with user_version 0
+    cursor.execute("CREATE TABLE IF NOT EXISTS users("
+                   "_id INT PRIMARY KEY NOT NULL, "
+                   "chat_id INT NOT NULL, "
+                   "username TEXT, "
+                   "first_name TEXT, "
+                   "last_name TEXT, "
+                   "last_interaction INT NOT NULL, "
+                   "first_seen INT NOT NULL, "
+                   "current_dialog_id TEXT, "
+                   "current_chat_mode TEXT NOT NULL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS dialogs("
+                   "_id TEXT PRIMARY KEY NOT NULL, "
+                   "user_id INT NOT NULL, "
+                   "chat_mode INT NOT NULL, "
+                   "start_time INT NOT NULL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS messages("
+                   "_date INT PRIMARY KEY NOT NULL, "
+                   "user_id INT NOT NULL, "
+                   "dialog_id TEXT NOT NULL, "
+                   "user TEXT, "
+                   "bot TEXT)")
+
+
+def _v2_messages_rowid_and_indexes(cursor: sqlite3.Cursor):
+    # messages get their own key, so messages with the same timestamp do not collide anymore
+    cursor.execute("CREATE TABLE messages_v2("
+                   "_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "_date REAL NOT NULL, "
+                   "user_id INT NOT NULL, "
+                   "dialog_id TEXT NOT NULL, "
+                   "user TEXT, "
+                   "bot TEXT)")
+    cursor.execute("INSERT INTO messages_v2(_date, user_id, dialog_id, user, bot) "
+                   "SELECT _date, user_id, dialog_id, user, bot FROM messages ORDER BY _date")
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_v2 RENAME TO messages")
+    cursor.execute("CREATE INDEX messages_user_dialog_date_idx ON messages(user_id, dialog_id, _date)")
+
+    # chat mode is a name, not a number
+    cursor.execute("CREATE TABLE dialogs_v2("
+                   "_id TEXT PRIMARY KEY NOT NULL, "
+                   "user_id INT NOT NULL, "
+                   "chat_mode TEXT NOT NULL, "
+                   "start_time REAL NOT NULL)")
+    cursor.execute("INSERT INTO dialogs_v2(_id, user_id, chat_mode, start_time) "
+                   "SELECT _id, user_id, chat_mode, start_time FROM dialogs")
+    cursor.execute("DROP TABLE dialogs")
+    cursor.execute("ALTER TABLE dialogs_v2 RENAME TO dialogs")
+    cursor.execute("CREATE INDEX dialogs_user_start_time_idx ON dialogs(user_id, start_time)")
+
+
+def _v3_message_token_counts(cursor: sqlite3.Cursor):
+    # token count of each message and running total of its dialog, so prompts are built without re-tokenization
+    cursor.execute("ALTER TABLE messages ADD COLUMN n_tokens INT")
+    cursor.execute("ALTER TABLE messages ADD COLUMN cum_tokens INT")
+
+    updates = []
+    dialog_id, cum_tokens = None, 0
+    for _id, message_dialog_id, user, bot in cursor.execute(
+            "SELECT _id, dialog_id, user, bot FROM messages ORDER BY user_id, dialog_id, _date, _id"
+    ).fetchall():
+        if message_dialog_id != dialog_id:
+            dialog_id, cum_tokens = message_dialog_id, 0
+        n_tokens = tokens.count_dialog_message_tokens({"user": user, "bot": bot}, tokens.STORED_COUNTS_MODEL)
+        cum_tokens += n_tokens
+        updates.append((n_tokens, cum_tokens, _id))
+
+    cursor.executemany("UPDATE messages SET n_tokens=?, cum_tokens=? WHERE _id=?", updates)
+
+
+def _v4_dialog_summaries(cursor: sqlite3.Cursor):
+    # running summary of the dialog's messages up to and including summary_until_id
+    cursor.execute("ALTER TABLE dialogs ADD COLUMN summary TEXT")
+    cursor.execute("ALTER TABLE dialogs ADD COLUMN summary_until_id INT")
+
+
+def _v5_archived_dialogs(cursor: sqlite3.Cursor):
+    # where dialogs moved to the archive segments are found (see archive.py)
+    cursor.execute("CREATE TABLE archived_dialogs("
+                   "_id TEXT PRIMARY KEY NOT NULL, "
+                   "user_id INT NOT NULL, "
+                   "chat_mode TEXT NOT NULL, "
+                   "start_time REAL NOT NULL, "
+                   "n_messages INT NOT NULL, "
+                   "segment TEXT NOT NULL, "
+                   "offset INT NOT NULL, "
+                   "length INT NOT NULL, "
+                   "archived_at REAL NOT NULL)")
+    cursor.execute("CREATE INDEX archived_dialogs_user_start_time_idx ON archived_dialogs(user_id, start_time)")
+
+    # the retention job looks for old dialogs which are not the current one of their user
+    cursor.execute("CREATE INDEX dialogs_start_time_idx ON dialogs(start_time)")
+    cursor.execute("CREATE INDEX users_current_dialog_idx ON users(current_dialog_id)")
+
+
+MIGRATIONS = [
+    _v1_initial_schema,
+    _v2_messages_rowid_and_indexes,
+    _v3_message_token_counts,
+    _v4_dialog_summaries,
+    _v5_archived_dialogs,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(db_conn: sqlite3.Connection) -> int:
+    return db_conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_conn: sqlite3.Connection) -> tuple[int, int]:
+    """Applies all pending migrations, each one in its own transaction.
+
+    Safe to run from several processes at once: the version is checked again under the write lock of each
+    migration, so a migration is applied by one of them only.
+
+    Returns schema versions before and after the upgrade.
+    """
+    version_before = get_schema_version(db_conn)
+    if version_before > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version_before} is newer than the supported one ({SCHEMA_VERSION})"
+        )
+
+    for version, migration in enumerate(MIGRATIONS[version_before:], start=version_before + 1):
+        with closing(db_conn.cursor()) as cursor:
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                # another process opening the database at the same time may have applied it meanwhile
+                if get_schema_version(db_conn) >= version:
+                    db_conn.rollback()
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version={version}")
+                db_conn.commit()
+            except Exception:
+                db_conn.rollback()
+                raise
+        logger.info("Migrated database schema to version {} ({})", version, migration.__name__)
+
+    return version_before, get_schema_version(db_conn)
+
+
+def has_incremental_vacuum(db_conn: sqlite3.Connection) -> bool:
+    return db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def enable_incremental_vacuum(db_conn: sqlite3.Connection) -> bool:
+    """Switches the database file to incremental auto-vacuum, returns True if the file had to be rewritten.
+
+    VACUUM rewrites the whole file and blocks all writers meanwhile, so this is never done by the running bot.
+    """
+    if has_incremental_vacuum(db_conn):
+        return False
+    with closing(db_conn.cursor()) as cursor:
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade the bot sqlite database schema in place")
+    parser.add_argument("sqlite_path", help="path to the sqlite database file")
+    parser.add_argument("--no-backup", action="store_true", help="do not make a backup copy before migrating")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="rewrite the database file once so the retention job can return freed space to the file system"
+    )
+    args = parser.parse_args()
+
+    with closing(sqlite3.connect(args.sqlite_path)) as db_conn:
+        converts = args.enable_incremental_vacuum and not has_incremental_vacuum(db_conn)
+        if not args.no_backup and (get_schema_version(db_conn) < SCHEMA_VERSION or converts):
+            backup_path = f"{args.sqlite_path}.v{get_schema_version(db_conn)}.bak"
+            with closing(sqlite3.connect(backup_path)) as backup_conn:
+                db_conn.backup(backup_conn)
+            logger.info("Saved backup to {}", backup_path)
+
+        version_before, version_after = migrate(db_conn)
+        logger.info("Database schema version: {} -> {}", version_before, version_after)
+
+        if args.enable_incremental_vacuum:
+            if enable_incremental_vacuum(db_conn):
+                logger.info("Rewrote the database file with incremental auto-vacuum")
+            else:
+                logger.info("Incremental auto-vacuum is already enabled")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 import sqlite3
+import time
 import uuid
 from contextlib import closing
 from datetime import datetime
 from typing import Any, Optional
 
+from loguru import logger
+
+import database_migrations
+import metrics
+import tokens
+import tracing
+
 _TABLE_TYPE_CONVERTOR = {
     datetime: (
         lambda x: x.timestamp(),
@@ -24,36 +32,72 @@ _USER_TABLE_FIELD_TYPES = {
 }
 
 
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+DB_QUERIES = metrics.counter("bot_db_queries_total", "SQL statements executed by the sqlite storage")
+
+
+class WriteJournal:
+    """Write-behind buffer of pending changes, applied by SqliteDataBase.apply_journal in a single transaction.
+
+    Repeated attribute updates of the same user are merged, so only the latest values are written.
+    """
+
+    def __init__(self):
+        self.user_attributes: dict[int, dict[str, Any]] = {}
+        self.dialog_messages: list[tuple[int, str, dict]] = []
+
+    def __len__(self):
+        return len(self.user_attributes) + len(self.dialog_messages)
+
+    def set_user_attributes(self, user_id: int, values: dict[str, Any]):
+        self.user_attributes.setdefault(user_id, {}).update(values)
+
+    def append_dialog_message(self, user_id: int, dialog_id: str, new_dialog_message: dict):
+        self.dialog_messages.append((user_id, dialog_id, new_dialog_message))
+
+    def has_dialog_messages(self, dialog_id: str) -> bool:
+        return any(item[1] == dialog_id for item in self.dialog_messages)
+
+
 class SqliteDataBase:
 
-    def __init__(self, sqlite_uri: str):
-        self.db_conn = sqlite3.connect(sqlite_uri)
+    def __init__(
+            self,
+            sqlite_uri: str,
+            read_only: bool = False,
+            synchronous: str = "NORMAL",
+            mmap_size: int = 256 * 1024 * 1024,
+            wal_autocheckpoint: Optional[int] = None
+    ):
+        if synchronous.upper() not in _SYNCHRONOUS_MODES:
+            raise ValueError(f"Unsupported synchronous mode {synchronous}")
+
+        # connection is created on the caller thread but may be handed over to a worker thread
+        # (see database_async), access is still serialized by the owner
+        self.db_conn = sqlite3.connect(sqlite_uri, check_same_thread=False)
+        self.db_conn.set_trace_callback(lambda statement: DB_QUERIES.inc())
         with closing(self.db_conn.cursor()) as cursor:
-            cursor.execute("CREATE TABLE IF NOT EXISTS users("
-                           "_id INT PRIMARY KEY NOT NULL, "
-                           "chat_id INT NOT NULL, "
-                           "username TEXT, "
-                           "first_name TEXT, "
-                           "last_name TEXT, "
-                           "last_interaction INT NOT NULL, "
-                           "first_seen INT NOT NULL, "
-                           "current_dialog_id TEXT, "
-                           "current_chat_mode TEXT NOT NULL)")
-            cursor.execute("CREATE TABLE IF NOT EXISTS dialogs("
-                           "_id TEXT PRIMARY KEY NOT NULL, "
-                           "user_id INT NOT NULL, "
-                           "chat_mode INT NOT NULL, "
-                           "start_time INT NOT NULL)")
-            cursor.execute("CREATE TABLE IF NOT EXISTS messages("
-                           "_date INT PRIMARY KEY NOT NULL, "
-                           "user_id INT NOT NULL, "
-                           "dialog_id TEXT NOT NULL, "
-                           "user TEXT, "
-                           "bot TEXT)")
-            self.db_conn.commit()
+            cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+                return
+
+            # takes effect for new database files only, existing ones are converted offline by
+            # `database_migrations.py --enable-incremental-vacuum`
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL lets readers run concurrently with the single writer
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={synchronous.upper()}")
+            if wal_autocheckpoint is not None:
+                # 0 leaves checkpoints to the snapshot job, which copies WAL frames before they are checkpointed
+                cursor.execute(f"PRAGMA wal_autocheckpoint={int(wal_autocheckpoint)}")
+
+        database_migrations.migrate(self.db_conn)
 
     def close(self):
-        self.db_conn or self.db_conn.close()
+        self.db_conn and self.db_conn.close()
 
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.__get_table_attribute("users", ("_id", user_id), "_id") is not None:
@@ -64,6 +108,7 @@ class SqliteDataBase:
             else:
                 return False
 
+    @tracing.traced("sqlite_add_new_user")
     def add_new_user(
             self,
             user_id: int,
@@ -74,30 +119,31 @@ class SqliteDataBase:
     ):
         if not self.check_if_user_exists(user_id):
             time_now = datetime.now()
-            self.__insert_table_row("users", [
-                user_id,  # _id
-                chat_id,  # chat_id
-                username,  # username
-                first_name,  # first_name
-                last_name,  # last_name
-                time_now,  # last_interaction
-                time_now,  # first_seen
-                None,  # current_dialog_id
-                "assistant"  # current_chat_mode
-            ])
+            self.__insert_table_row("users", {
+                "_id": user_id,
+                "chat_id": chat_id,
+                "username": username,
+                "first_name": first_name,
+                "last_name": last_name,
+                "last_interaction": time_now,
+                "first_seen": time_now,
+                "current_dialog_id": None,
+                "current_chat_mode": "assistant"
+            })
 
+    @tracing.traced("sqlite_start_new_dialog")
     def start_new_dialog(self, user_id: int):
         self.check_if_user_exists(user_id, raise_exception=True)
 
         dialog_id = str(uuid.uuid4())
 
         # add new dialog
-        self.__insert_table_row("dialogs", [
-            dialog_id,  # _id
-            user_id,  # user_id
-            self.get_user_attribute(user_id, "current_chat_mode"),  # chat_mode
-            datetime.now(),  # start_time
-        ])
+        self.__insert_table_row("dialogs", {
+            "_id": dialog_id,
+            "user_id": user_id,
+            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "start_time": datetime.now(),
+        })
 
         # update user's current dialog
         self.__update_table_row("users", ("_id", user_id), {
@@ -118,36 +164,136 @@ class SqliteDataBase:
         self.check_if_user_exists(user_id, raise_exception=True)
         self.__update_table_row("users", ("_id", user_id), {key: value})
 
+    @tracing.traced("sqlite_get_user")
+    def get_user(self, user_id: int) -> Optional[dict]:
+        with closing(self.db_conn.cursor()) as cursor:
+            res = cursor.execute("SELECT * FROM users WHERE _id=? LIMIT 1", (user_id,))
+            row = res.fetchone()
+            if row is None:
+                return None
+            return {
+                column[0]: SqliteDataBase.__from_query_return(value, _USER_TABLE_FIELD_TYPES[column[0]])
+                for column, value in zip(res.description, row)
+            }
+
+    def set_user_attributes(self, user_id: int, values: dict[str, Any], commit: bool = True):
+        self.__update_table_row("users", ("_id", user_id), values, commit=commit)
+
+    @tracing.traced("sqlite_apply_journal")
+    def apply_journal(self, journal: WriteJournal):
+        """Writes all changes of the journal in one transaction.
+
+        If the batch fails as a whole, changes are retried one by one, so a single bad row
+        (e.g. a duplicate key) is dropped instead of the whole batch.
+        """
+        if len(journal) == 0:
+            return
+
+        try:
+            self.__apply_journal(journal, commit=False)
+            self.db_conn.commit()
+        except sqlite3.Error as e:
+            self.db_conn.rollback()
+            logger.warning("Failed to apply write journal as a batch ({}), applying changes one by one", e)
+            self.__apply_journal(journal, commit=True, skip_errors=True)
+
+    def __apply_journal(self, journal: WriteJournal, commit: bool, skip_errors: bool = False):
+        changes = [
+            (self.set_user_attributes, (user_id, values))
+            for user_id, values in journal.user_attributes.items()
+        ] + [
+            (self.append_dialog_message, (user_id, new_dialog_message, dialog_id))
+            for user_id, dialog_id, new_dialog_message in journal.dialog_messages
+        ]
+        for method, args in changes:
+            try:
+                method(*args, commit=commit)
+            except sqlite3.Error as e:
+                if not skip_errors:
+                    raise
+                self.db_conn.rollback()
+                logger.error("Dropped journaled change {}{}: {}", method.__name__, args, e)
+
+    @tracing.traced("sqlite_get_dialog_messages")
     def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
         self.check_if_user_exists(user_id, raise_exception=True)
         dialog_id = dialog_id or self.get_user_attribute(user_id, "current_dialog_id")
         with closing(self.db_conn.cursor()) as cursor:
-            res = cursor.execute(f"SELECT user,bot,_date FROM messages "
-                                 f"WHERE dialog_id='{dialog_id}' AND user_id={user_id} "
-                                 f"ORDER BY _date")
+            res = cursor.execute("SELECT user,bot,_date,n_tokens,cum_tokens,_id FROM messages "
+                                 "WHERE user_id=? AND dialog_id=? "
+                                 "ORDER BY _date, _id", (user_id, dialog_id))
             return list(map(
-                lambda item: {"user": item[0], "bot": item[1], "date": datetime.fromtimestamp(item[2])},
+                lambda item: {
+                    "user": item[0],
+                    "bot": item[1],
+                    "date": datetime.fromtimestamp(item[2]),
+                    "n_tokens": item[3],
+                    "cum_tokens": item[4],
+                    "id": item[5],
+                },
                 res
             ))
 
-    def append_dialog_message(self, user_id: int, new_dialog_message: dict, dialog_id: Optional[str] = None):
+    @tracing.traced("sqlite_get_dialog_summary")
+    def get_dialog_summary(self, dialog_id: str) -> Optional[dict]:
+        with closing(self.db_conn.cursor()) as cursor:
+            res = cursor.execute("SELECT summary, summary_until_id FROM dialogs WHERE _id=?", (dialog_id,)).fetchone()
+            if res is None or res[0] is None:
+                return None
+            return {"summary": res[0], "until_id": res[1]}
+
+    @tracing.traced("sqlite_set_dialog_summary")
+    def set_dialog_summary(
+            self,
+            dialog_id: str,
+            summary: str,
+            until_id: int,
+            previous_until_id: Optional[int] = None
+    ) -> bool:
+        """Stores the summary unless another one was stored since `previous_until_id` was read."""
+        with closing(self.db_conn.cursor()) as cursor:
+            cursor.execute("UPDATE dialogs SET summary=?, summary_until_id=? "
+                           "WHERE _id=? AND summary_until_id IS ?", (summary, until_id, dialog_id, previous_until_id))
+            self.db_conn.commit()
+            return cursor.rowcount > 0
+
+    @tracing.traced("sqlite_append_dialog_message")
+    def append_dialog_message(
+            self,
+            user_id: int,
+            new_dialog_message: dict,
+            dialog_id: Optional[str] = None,
+            commit: bool = True
+    ):
         self.check_if_user_exists(user_id, raise_exception=True)
         dialog_id = dialog_id or self.get_user_attribute(user_id, "current_dialog_id")
-        self.__insert_table_row("messages", [
-            new_dialog_message["date"],  # _date
-            user_id,
-            dialog_id,
-            new_dialog_message["user"],  # user
-            new_dialog_message["bot"],  # bot
-        ])
 
+        # token count is computed once here, together with the running total of the dialog
+        n_tokens = tokens.count_dialog_message_tokens(new_dialog_message, tokens.STORED_COUNTS_MODEL)
+        with closing(self.db_conn.cursor()) as cursor:
+            res = cursor.execute("SELECT cum_tokens FROM messages WHERE user_id=? AND dialog_id=? "
+                                 "ORDER BY _date DESC, _id DESC LIMIT 1", (user_id, dialog_id)).fetchone()
+            prev_cum_tokens = res[0] if res is not None and res[0] is not None else 0
+
+        self.__insert_table_row("messages", {
+            "_date": new_dialog_message["date"],
+            "user_id": user_id,
+            "dialog_id": dialog_id,
+            "user": new_dialog_message["user"],
+            "bot": new_dialog_message["bot"],
+            "n_tokens": n_tokens,
+            "cum_tokens": prev_cum_tokens + n_tokens,
+        }, commit=commit)
+
+    @tracing.traced("sqlite_remove_dialog_last_message")
     def remove_dialog_last_message(self, user_id: int, dialog_id: Optional[str] = None):
         dialog_id = dialog_id or self.get_user_attribute(user_id, "current_dialog_id")
         last_message = None
         with closing(self.db_conn.cursor()) as cursor:
             # First, fetch the last message
-            cursor.execute("SELECT user, bot, _date FROM messages WHERE dialog_id=? ORDER BY _date DESC LIMIT 1",
-                           (dialog_id,))
+            cursor.execute("SELECT user, bot, _date, _id FROM messages WHERE user_id=? AND dialog_id=? "
+                           "ORDER BY _date DESC, _id DESC LIMIT 1",
+                           (user_id, dialog_id))
             last_row = cursor.fetchone()
             if last_row:
                 last_message = {
@@ -156,26 +302,125 @@ class SqliteDataBase:
                     "date": datetime.fromtimestamp(last_row[2]),
                 }
                 # Then, delete the last message
-                cursor.execute("DELETE FROM messages WHERE _date=? AND dialog_id=?", (last_row[2], dialog_id))
+                cursor.execute("DELETE FROM messages WHERE _id=?", (last_row[3],))
                 self.db_conn.commit()
         return last_message
 
-    def __insert_table_row(self, table_name: str, datas: list):
-        sql_str = f"INSERT INTO {table_name} VALUES("
-        should_add_comma = False
-        params = []
-        for d in datas:
-            if should_add_comma:
-                sql_str += ","
-            sql_str += "?"
-            params.append(SqliteDataBase.__to_query_parameter(d))
-            should_add_comma = True
-        sql_str += ")"
+    @tracing.traced("sqlite_archive_dialogs")
+    def archive_dialogs(self, archive, older_than: datetime, limit: int) -> int:
+        """Moves up to `limit` dialogs, which are not current and had no message since `older_than`, to the archive.
+
+        The write lock is taken before the archive is appended to, so workers sharing the database archive
+        dialogs one after another.
+        """
+        cutoff = older_than.timestamp()
+        with closing(self.db_conn.cursor()) as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                dialogs = cursor.execute(
+                    "SELECT _id, user_id, chat_mode, start_time, summary, summary_until_id FROM dialogs d "
+                    "WHERE start_time < ? "
+                    "AND NOT EXISTS (SELECT 1 FROM users u WHERE u.current_dialog_id = d._id) "
+                    "AND NOT EXISTS (SELECT 1 FROM messages m "
+                    "WHERE m.user_id = d.user_id AND m.dialog_id = d._id AND m._date >= ?) "
+                    "ORDER BY start_time LIMIT ?", (cutoff, cutoff, limit)
+                ).fetchall()
+                if len(dialogs) == 0:
+                    self.db_conn.rollback()
+                    return 0
+
+                records = []
+                for dialog_id, user_id, chat_mode, start_time, summary, summary_until_id in dialogs:
+                    messages = cursor.execute(
+                        "SELECT user, bot, _date, n_tokens, _id FROM messages WHERE user_id=? AND dialog_id=? "
+                        "ORDER BY _date, _id", (user_id, dialog_id)
+                    ).fetchall()
+                    records.append({
+                        "dialog_id": dialog_id,
+                        "user_id": user_id,
+                        "chat_mode": chat_mode,
+                        "start_time": start_time,
+                        "summary": summary,
+                        "summary_until_id": summary_until_id,
+                        "messages": [
+                            {"user": user, "bot": bot, "date": date, "n_tokens": n_tokens, "id": _id}
+                            for user, bot, date, n_tokens, _id in messages
+                        ],
+                    })
+                locations = archive.append(records)
+
+                archived_at = time.time()
+                cursor.executemany(
+                    "INSERT INTO archived_dialogs(_id, user_id, chat_mode, start_time, n_messages, segment, offset, "
+                    "length, archived_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (record["dialog_id"], record["user_id"], record["chat_mode"], record["start_time"],
+                         len(record["messages"]), segment, offset, length, archived_at)
+                        for record, (segment, offset, length) in zip(records, locations)
+                    ]
+                )
+                cursor.executemany("DELETE FROM messages WHERE user_id=? AND dialog_id=?",
+                                   [(record["user_id"], record["dialog_id"]) for record in records])
+                cursor.executemany("DELETE FROM dialogs WHERE _id=?", [(record["dialog_id"],) for record in records])
+                self.db_conn.commit()
+            except BaseException:
+                self.db_conn.rollback()
+                raise
+        return len(records)
+
+    @tracing.traced("sqlite_get_archived_dialogs")
+    def get_archived_dialogs(self, user_id: int) -> list[dict]:
+        with closing(self.db_conn.cursor()) as cursor:
+            res = cursor.execute("SELECT _id, chat_mode, start_time, n_messages, archived_at FROM archived_dialogs "
+                                 "WHERE user_id=? ORDER BY start_time", (user_id,))
+            return [
+                {
+                    "dialog_id": dialog_id,
+                    "chat_mode": chat_mode,
+                    "start_time": datetime.fromtimestamp(start_time),
+                    "n_messages": n_messages,
+                    "archived_at": datetime.fromtimestamp(archived_at),
+                }
+                for dialog_id, chat_mode, start_time, n_messages, archived_at in res
+            ]
+
+    @tracing.traced("sqlite_get_archived_dialog")
+    def get_archived_dialog(self, archive, dialog_id: str) -> Optional[dict]:
+        """The archived dialog with its messages, None if the dialog is not archived."""
+        with closing(self.db_conn.cursor()) as cursor:
+            res = cursor.execute("SELECT segment, offset, length FROM archived_dialogs WHERE _id=?",
+                                 (dialog_id,)).fetchone()
+        if res is None:
+            return None
+
+        record = archive.read(*res)
+        record["start_time"] = datetime.fromtimestamp(record["start_time"])
+        for message in record["messages"]:
+            message["date"] = datetime.fromtimestamp(message["date"])
+        return record
+
+    def has_incremental_vacuum(self) -> bool:
+        return database_migrations.has_incremental_vacuum(self.db_conn)
+
+    @tracing.traced("sqlite_incremental_vacuum")
+    def incremental_vacuum(self, max_pages: int) -> int:
+        """Returns up to `max_pages` free pages to the file system, returns how many were freed."""
+        with closing(self.db_conn.cursor()) as cursor:
+            free_pages_before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            # executescript steps the pragma to completion, execute would free a single page
+            cursor.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+            free_pages_after = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        return free_pages_before - free_pages_after
+
+    def __insert_table_row(self, table_name: str, datas: dict, commit: bool = True):
+        sql_str = f"INSERT INTO {table_name}({', '.join(datas.keys())}) VALUES({', '.join('?' * len(datas))})"
+        params = [SqliteDataBase.__to_query_parameter(d) for d in datas.values()]
         with closing(self.db_conn.cursor()) as cursor:
             cursor.execute(sql_str, params)
-            self.db_conn.commit()
+            if commit:
+                self.db_conn.commit()
 
-    def __update_table_row(self, table_name: str, where: tuple, datas: dict):
+    def __update_table_row(self, table_name: str, where: tuple, datas: dict, commit: bool = True):
         sql_str = f"UPDATE {table_name} SET "
         params = []
         for k, v in datas.items():
@@ -184,7 +429,8 @@ class SqliteDataBase:
         sql_str = f"{sql_str[0:-2]} WHERE {str(where[0])} = {str(where[1])}"
         with closing(self.db_conn.cursor()) as cursor:
             cursor.execute(sql_str, params)
-            self.db_conn.commit()
+            if commit:
+                self.db_conn.commit()
 
     def __get_table_attribute(self, table_name: str, where: tuple, key: str):
         with closing(self.db_conn.cursor()) as cursor:
@@ -0,0 +1,300 @@
+"""Helpers for fitting formatted answers into Telegram messages."""
+import bisect
+import re
+from typing import Iterator, NamedTuple, Optional
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# preferred split points, best first: paragraph, code block start, line, word;
+# number is how many characters of the separator stay in the previous chunk
+_BOUNDARIES = {
+    None: (("\n\n", 2), ("\n", 1), (" ", 1)),
+    "html": (("\n\n", 2), ("\n<pre>", 1), ("\n", 1), (" ", 1)),
+    "markdown": (("\n\n", 2), ("\n```", 1), ("\n", 1), (" ", 1)),
+}
+
+
+def _find_split(text: str, start: int, end: int, parse_mode: Optional[str]) -> int:
+    """Position in text[start:end] where the text can be cut, the next chunk starts there."""
+    min_position = start + (end - start) // 2
+    for separator, n_kept in _BOUNDARIES[parse_mode]:
+        position = text.rfind(separator, min_position, end)
+        while separator == "\n```" and position != -1 and text.count("```", 0, position) % 2 == 1:
+            # a closing fence, the code block would be cut in two
+            position = text.rfind(separator, min_position, position)
+        if position != -1:
+            return position + n_kept
+    return end
+
+
+def _move_out_of_markup(text: str, start: int, position: int) -> int:
+    """Moves a cut position out of an html tag or entity it would break."""
+    tag_start = text.rfind("<", start, position)
+    if tag_start != -1 and text.rfind(">", start, position) < tag_start:
+        position = tag_start
+
+    entity_start = text.rfind("&", start, position)
+    if entity_start != -1 and text.rfind(";", start, position) < entity_start and position - entity_start <= 10:
+        position = entity_start
+
+    return position
+
+
+def _move_out_of_link(text: str, start: int, position: int) -> int:
+    """Moves a cut position out of a markdown link it would break."""
+    link_start = text.rfind("[", start, position)
+    if link_start != -1:
+        link = _MARKDOWN_LINK.match(text, link_start)
+        if link is not None and link.end() > position:
+            position = link_start
+    return position
+
+
+def split_text_into_chunks(
+        text: str,
+        chunk_size: int = TELEGRAM_MESSAGE_LIMIT,
+        parse_mode: Optional[str] = None
+) -> Iterator[str]:
+    """Splits text into chunks of at most `chunk_size` characters on the safest boundary available.
+
+    A chunk boundary depends only on the text before it, so while a streamed text grows,
+    chunks which are already complete never change.
+    """
+    start = 0
+    while len(text) - start > chunk_size:
+        end = start + chunk_size
+        position = _find_split(text, start, end, parse_mode)
+        if parse_mode == "html":
+            position = _move_out_of_markup(text, start, position)
+        elif parse_mode == "markdown":
+            position = _move_out_of_link(text, start, position)
+        if position <= start:
+            position = end
+        yield text[start:position]
+        start = position
+    if start < len(text) or start == 0:
+        yield text[start:]
+
+
+# tags supported by Telegram html parse mode
+_HTML_TAGS = {
+    "a", "b", "blockquote", "code", "del", "em", "i", "ins", "pre", "s",
+    "span", "strike", "strong", "tg-emoji", "tg-spoiler", "u",
+}
+_MAX_HTML_ENTITY_LENGTH = 10
+_MARKDOWN_LINK = re.compile(r"\[[^\]\n]*\]\([^)\s]*\)")
+_MARKDOWN_PARTIAL_LINK = re.compile(r"\[[^\]\n]*(\](\([^)\s]*)?)?")
+_MARKDOWN_SPECIAL = re.compile(r"[`*_\[\\]")
+# characters which legacy markdown lets escape with a backslash
+_MARKDOWN_ESCAPABLE = "`*_["
+
+
+class _Checkpoint(NamedTuple):
+    position: int  # right after the token
+    token_start: int
+    stack: tuple[str, ...]  # entities open after the token
+
+
+class FormattingTracker:
+    """Incrementally tracks entities (tags, code blocks, bold, ...) open in a streamed html or markdown text.
+
+    Every `feed` scans only the newly arrived part of the text. `frame` returns a part of the text which
+    Telegram can parse on its own: entities open at its start are reopened, entities open at its end are
+    closed, and a trailing token which is not complete yet (e.g. `<co` or `&am`) is cut off.
+
+    The final frame is different for markdown: the text is complete, so a marker which is still open (the
+    `*` of `2*3=6`) or an unfinished token is stray and is escaped instead of closed. Only a code block left
+    open is closed, the answer was cut off in the middle of it.
+    """
+
+    def __init__(self, parse_mode: Optional[str]):
+        self.parse_mode = parse_mode
+        self.text = ""
+        # text before this position is scanned, the rest is an incomplete token
+        self.position = 0
+        self._stack: tuple[str, ...] = ()
+        self._checkpoints = [_Checkpoint(0, 0, ())]
+        # positions of stray markdown markers, which are shown as plain text
+        self._literals: set[int] = set()
+
+    def feed(self, text: str):
+        """Takes the current text of the stream, which normally starts with the previously fed one."""
+        if not text.startswith(self.text[:self.position]) or (self._literals and text != self.text):
+            # text was rewritten (e.g. stripped when finished), it is scanned from the beginning;
+            # so is a text which grew after its stray markers were found, they might be closed now
+            self.position = 0
+            self._stack = ()
+            self._checkpoints = [_Checkpoint(0, 0, ())]
+            self._literals = set()
+        self.text = text
+        if self.parse_mode == "html":
+            self._scan_html()
+        elif self.parse_mode == "markdown":
+            self._scan_markdown()
+        else:
+            self.position = len(text)
+
+    def frame(self, start: int = 0, end: Optional[int] = None, final: bool = False) -> str:
+        end = len(self.text) if end is None else end
+        if self.parse_mode is None:
+            return self.text[start:end]
+
+        if final and self.parse_mode == "markdown":
+            self._escape_stray_markers()
+        elif not final:
+            end = min(end, self.position)
+            # do not show an entity which is opened right at the end of the frame and has no content yet
+            checkpoint = self._checkpoint_at(end)
+            while checkpoint.position == end and end > start and len(checkpoint.stack) > len(self._state_at(
+                    checkpoint.token_start)):
+                end = checkpoint.token_start
+                checkpoint = self._checkpoint_at(end)
+
+        return (
+            "".join(self._opening(entity) for entity in self._state_at(start))
+            + self._escaped(start, end)
+            + "".join(self._closing(entity) for entity in reversed(self._state_at(end)))
+        )
+
+    def _escape_stray_markers(self):
+        """Marks markdown markers which are never closed as plain text and rescans the text after them."""
+        while True:
+            if self._stack and self._stack[-1] != "```":
+                # nothing is parsed inside an entity, so the last checkpoint is the one which opened it
+                marker = self._checkpoints[-1].token_start
+            elif not self._stack and self.position < len(self.text):
+                marker = self.position  # unfinished token, e.g. `[link` or a trailing backtick
+            else:
+                return
+
+            self._literals.add(marker)
+            while self._checkpoints[-1].position > marker:
+                self._checkpoints.pop()
+            self._stack = self._checkpoints[-1].stack
+            self.position = marker
+            self._scan_markdown()
+
+    def _escaped(self, start: int, end: int) -> str:
+        parts, i = [], start
+        for position in sorted(self._literals):
+            if start <= position < end and self.text[position] in _MARKDOWN_ESCAPABLE:
+                parts += [self.text[i:position], "\\"]
+                i = position
+        parts.append(self.text[i:end])
+        return "".join(parts)
+
+    def _checkpoint_at(self, position: int) -> _Checkpoint:
+        return self._checkpoints[bisect.bisect_right(self._checkpoints, position, key=lambda c: c.position) - 1]
+
+    def _state_at(self, position: int) -> tuple[str, ...]:
+        return self._checkpoint_at(position).stack
+
+    def _push(self, entity: str, token_start: int, position: int):
+        self._stack = self._stack + (entity,)
+        self._checkpoints.append(_Checkpoint(position, token_start, self._stack))
+
+    def _pop(self, index: int, token_start: int, position: int):
+        self._stack = self._stack[:index]
+        self._checkpoints.append(_Checkpoint(position, token_start, self._stack))
+
+    def _opening(self, entity: str) -> str:
+        if self.parse_mode == "markdown" and entity == "```":
+            return "```\n"
+        return entity
+
+    def _closing(self, entity: str) -> str:
+        if self.parse_mode == "html":
+            return f"</{self._html_tag_name(entity)}>"
+        return entity
+
+    @staticmethod
+    def _html_tag_name(tag: str) -> str:
+        return tag.strip("</>").split(maxsplit=1)[0].lower() if tag.strip("</>") else ""
+
+    def _scan_html(self):
+        text, i = self.text, self.position
+        while True:
+            tag_start, entity_start = text.find("<", i), text.find("&", i)
+            if tag_start == -1 and entity_start == -1:
+                i = len(text)
+                break
+
+            if entity_start != -1 and (tag_start == -1 or entity_start < tag_start):
+                entity_end = text.find(";", entity_start)
+                if entity_end == -1 and len(text) - entity_start <= _MAX_HTML_ENTITY_LENGTH:
+                    i = entity_start  # entity is not complete yet
+                    break
+                i = entity_end + 1 if entity_end != -1 else entity_start + 1
+                continue
+
+            tag_end = text.find(">", tag_start)
+            if tag_end == -1:
+                i = tag_start  # tag is not complete yet
+                break
+
+            tag = text[tag_start:tag_end + 1]
+            name = self._html_tag_name(tag)
+            if tag.startswith("</"):
+                open_names = [self._html_tag_name(entity) for entity in self._stack]
+                if name in open_names:
+                    index = len(open_names) - 1 - open_names[::-1].index(name)
+                    self._pop(index, tag_start, tag_end + 1)
+            elif name in _HTML_TAGS and not tag.endswith("/>"):
+                self._push(tag, tag_start, tag_end + 1)
+            i = tag_end + 1
+
+        self.position = i
+
+    def _scan_markdown(self):
+        text, i = self.text, self.position
+        while i < len(text):
+            entity = self._stack[-1] if self._stack else None
+
+            if entity is not None:
+                # inside an entity nothing else is parsed, only its end is looked for
+                entity_end = text.find(entity, i)
+                if entity_end == -1:
+                    # backticks at the end might be the start of the closing ```
+                    i = max(len(text.rstrip("`")), i) if entity == "```" else len(text)
+                    break
+                self._pop(len(self._stack) - 1, entity_end, entity_end + len(entity))
+                i = entity_end + len(entity)
+                continue
+
+            match = _MARKDOWN_SPECIAL.search(text, i)
+            if match is None:
+                i = len(text)
+                break
+
+            special_start, special = match.start(), match.group()
+            if special_start in self._literals:
+                i = special_start + 1
+            elif special == "\\":
+                if special_start + 1 == len(text):
+                    i = special_start
+                    break
+                i = special_start + 2
+            elif special == "[":
+                link = _MARKDOWN_LINK.match(text, special_start)
+                if link is not None:
+                    i = link.end()
+                elif _MARKDOWN_PARTIAL_LINK.fullmatch(text, special_start):
+                    i = special_start  # link is not complete yet
+                    break
+                else:
+                    i = special_start + 1
+            elif special == "`":
+                if text.startswith("```", special_start):
+                    self._push("```", special_start, special_start + 3)
+                    i = special_start + 3
+                elif text[special_start:] in ("`", "``"):
+                    i = special_start  # might be the start of ```
+                    break
+                else:
+                    self._push("`", special_start, special_start + 1)
+                    i = special_start + 1
+            else:
+                self._push(special, special_start, special_start + 1)
+                i = special_start + 1
+
+        self.position = i
@@ -0,0 +1,161 @@
+"""Minimal in-process metrics: counters, gauges and histograms with labels."""
+import bisect
+import threading
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REGISTRY: dict[str, "_Metric"] = {}
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """Value is read from `function` whenever the gauge is collected."""
+        self._functions[self._key(labels)] = function
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self.values.get(key, 0)
+
+    def collect(self) -> dict[tuple[str, ...], float]:
+        return {**self.values, **{key: function() for key, function in self._functions.items()}}
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: counts per bucket (+Inf last), sum, count
+        self.values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            bucket_counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (bucket_counts, total + value, count + 1)
+
+
+def _register(metric):
+    if metric.name in REGISTRY:
+        existing = REGISTRY[metric.name]
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f"Metric {metric.name} is already registered with a different type or labels")
+        return existing
+    REGISTRY[metric.name] = metric
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS
+) -> Histogram:
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], key: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{labelname}="{_escape_label_value(value)}"' for labelname, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        if isinstance(metric, Histogram):
+            for key, (bucket_counts, total, count) in list(metric.values.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip((*metric.buckets, float("inf")), bucket_counts):
+                    cumulative += bucket_count
+                    le = f'le="{_format_value(bucket)}"'
+                    lines.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, key, le)} {cumulative}")
+                lines.append(f"{metric.name}_sum{_format_labels(metric.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{metric.name}_count{_format_labels(metric.labelnames, key)} {count}")
+        else:
+            values = metric.collect() if isinstance(metric, Gauge) else dict(metric.values)
+            for key, value in values.items():
+                lines.append(f"{metric.name}{_format_labels(metric.labelnames, key)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,30 @@
+"""Local http endpoint serving all metrics of the bot in the Prometheus text format."""
+from aiohttp import web
+from loguru import logger
+
+import metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_runner: web.AppRunner | None = None
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render_prometheus().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start(listen: str = "127.0.0.1", port: int = 9090, path: str = "/metrics"):
+    global _runner
+    app = web.Application()
+    app.router.add_get(path, handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, listen, port).start()
+    logger.info("Serving metrics on {}:{}{}", listen, port, path)
+
+
+async def stop():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
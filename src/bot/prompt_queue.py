@@ -0,0 +1,106 @@
+"""Prompts a user sends while their previous prompt is still being answered.
+
+Instead of being rejected, such prompts wait in a bounded per-user FIFO and are answered in order by the
+task which answers the user's current prompt. Several waiting prompts can be merged into one completion.
+"""
+from collections import deque
+from typing import Any, Optional
+
+import metrics
+
+QUEUED_PROMPTS = metrics.gauge("bot_queued_prompts", "Prompts waiting for the previous answer of their user")
+DROPPED_PROMPTS = metrics.counter(
+    "bot_queued_prompts_dropped_total", "Prompts dropped because the queue of their user was full", ("policy",)
+)
+MERGED_PROMPTS = metrics.counter(
+    "bot_queued_prompts_merged_total", "Queued prompts answered together with another prompt in one completion"
+)
+
+OVERFLOW_POLICIES = ("reject", "drop_oldest")
+
+
+class QueuedPrompt:
+    __slots__ = ("update", "message")
+
+    def __init__(self, update: Any, message: str):
+        self.update = update
+        self.message = message
+
+
+class PromptQueue:
+    """Per-user FIFO of waiting prompts.
+
+    A user has an entry only while one of their prompts is being answered, `submit` and `next` never
+    await, so a prompt can not be queued after its user's answering task has looked at the queue for
+    the last time. Beyond `max_depth` waiting prompts the new prompt is rejected (`overflow="reject"`)
+    or the oldest waiting one is dropped (`overflow="drop_oldest"`).
+    """
+
+    def __init__(self, max_depth: int = 5, overflow: str = "reject", merge: bool = False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown queue overflow policy: {overflow}")
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.merge = merge
+
+        self._queues: dict[int, deque[QueuedPrompt]] = {}
+        self._n_queued = 0
+
+        QUEUED_PROMPTS.set_function(lambda: self._n_queued)
+
+    def is_active(self, user_id: int) -> bool:
+        return user_id in self._queues
+
+    def submit(self, user_id: int, prompt: QueuedPrompt) -> tuple[bool, Optional[QueuedPrompt]]:
+        """Returns whether the caller has to answer the prompt itself, and a prompt which was dropped.
+
+        If a prompt of the user is already being answered, `prompt` is queued for that task instead.
+        """
+        queue = self._queues.get(user_id)
+        if queue is None:
+            self._queues[user_id] = deque()
+            return True, None
+
+        if len(queue) >= self.max_depth:
+            DROPPED_PROMPTS.inc(policy=self.overflow)
+            if self.overflow == "reject" or self.max_depth == 0:
+                return False, prompt
+            dropped = queue.popleft()
+            queue.append(prompt)
+            return False, dropped
+
+        queue.append(prompt)
+        self._n_queued += 1
+        return False, None
+
+    def next(self, user_id: int) -> Optional[QueuedPrompt]:
+        """Next prompt to answer, all waiting prompts merged into one if enabled.
+
+        Once nothing is waiting, the user's entry is removed and the caller must stop answering.
+        """
+        queue = self._queues.get(user_id)
+        if not queue:
+            self._queues.pop(user_id, None)
+            return None
+
+        if not self.merge or len(queue) == 1:
+            self._n_queued -= 1
+            return queue.popleft()
+
+        prompts = list(queue)
+        queue.clear()
+        self._n_queued -= len(prompts)
+        MERGED_PROMPTS.inc(len(prompts) - 1)
+        # the answer is sent as a reply to the latest message
+        return QueuedPrompt(prompts[-1].update, "\n\n".join(prompt.message for prompt in prompts))
+
+    def discard(self, user_id: int) -> list[QueuedPrompt]:
+        """Forgets the user's waiting prompts, e.g. when their answering task failed unexpectedly.
+
+        Returns the forgotten prompts, so their senders can be told they will not be answered.
+        """
+        queue = self._queues.pop(user_id, None)
+        if not queue:
+            return []
+        self._n_queued -= len(queue)
+        return list(queue)
@@ -0,0 +1,163 @@
+"""Admission control for completion requests.
+
+At most `max_in_flight` completions run at once, and at most `model_limits[model]` of one model. Requests
+beyond that wait and are admitted in start-time fair queuing order: every user gets a share of the
+completion slots proportional to their weight, no matter how many requests they send.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from loguru import logger
+
+import metrics
+
+QUEUE_DEPTH = metrics.gauge("bot_completion_queue_depth", "Completion requests waiting for a free slot")
+IN_FLIGHT = metrics.gauge("bot_completions_in_flight", "Completion requests being served", ("model",))
+WAIT_TIME = metrics.histogram(
+    "bot_completion_queue_wait_seconds", "Time a completion request waited for a free slot", ("model",)
+)
+
+
+class _Waiter:
+    __slots__ = ("user_id", "model", "start_tag", "future")
+
+    def __init__(self, user_id: int, model: str, start_tag: float, future: asyncio.Future):
+        self.user_id = user_id
+        self.model = model
+        self.start_tag = start_tag
+        self.future = future
+
+
+class CompletionScheduler:
+    def __init__(
+            self,
+            max_in_flight: int = 64,
+            model_limits: Optional[dict[str, int]] = None,
+            user_weights: Optional[dict[str, float]] = None
+    ):
+        for username, weight in (user_weights or {}).items():
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise ValueError(f"Completion weight of user {username} must be a positive number, got {weight}")
+        self.max_in_flight = max_in_flight
+        self.model_limits = model_limits or {}
+        self.user_weights = user_weights or {}
+
+        self._n_in_flight = 0
+        self._model_in_flight: dict[str, int] = {}
+        # per model: heap of (start tag, arrival number, waiter)
+        self._waiting: dict[str, list[tuple[float, int, _Waiter]]] = {}
+        self._n_waiting = 0
+        self._arrivals = itertools.count()
+        # virtual time is the start tag of the last admitted request
+        self._virtual_time = 0.0
+        self._user_finish_tags: dict[int, float] = {}
+
+        QUEUE_DEPTH.set_function(lambda: self._n_waiting)
+
+    def weight(self, username: Optional[str]) -> float:
+        """Share of the completion slots a user gets, relative to users without a configured weight."""
+        return self.user_weights.get(username, 1.0)
+
+    @asynccontextmanager
+    async def slot(
+            self,
+            user_id: int,
+            model: str,
+            weight: float = 1.0,
+            on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> AsyncIterator[None]:
+        """Holds a completion slot. `on_queued` is called with the 1-based queue position if the request waits."""
+        if weight <= 0:
+            raise ValueError(f"Completion weight must be positive, got {weight}")
+        start_tag = max(self._virtual_time, self._user_finish_tags.get(user_id, 0.0))
+        self._user_finish_tags[user_id] = start_tag + 1.0 / weight
+
+        queued_at = time.monotonic()
+        # requests which still wait are blocked by their model limit, so they never get passed by this one
+        if self._has_capacity(model):
+            self._admit(start_tag, model)
+        else:
+            waiter = _Waiter(user_id, model, start_tag, asyncio.get_running_loop().create_future())
+            await self._wait(waiter, on_queued)
+        WAIT_TIME.observe(time.monotonic() - queued_at, model=model)
+
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    async def _wait(self, waiter: _Waiter, on_queued: Optional[Callable[[int], Awaitable[None]]]):
+        heapq.heappush(self._waiting.setdefault(waiter.model, []), (waiter.start_tag, next(self._arrivals), waiter))
+        self._n_waiting += 1
+
+        try:
+            if on_queued is not None:
+                position = 1 + sum(
+                    1 for heap in self._waiting.values() for start_tag, _, other in heap
+                    if other is not waiter and start_tag <= waiter.start_tag and not other.future.done()
+                )
+                try:
+                    await on_queued(position)
+                except Exception as e:
+                    logger.warning(f"Failed to show queue position to user {waiter.user_id}: {e}")
+
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was granted just before the request was cancelled
+                self._release(waiter.model)
+            else:
+                waiter.future.cancel()
+                self._n_waiting -= 1
+            raise
+
+    def _has_capacity(self, model: str) -> bool:
+        if self._n_in_flight >= self.max_in_flight:
+            return False
+        model_limit = self.model_limits.get(model)
+        return model_limit is None or self._model_in_flight.get(model, 0) < model_limit
+
+    def _admit(self, start_tag: float, model: str):
+        self._virtual_time = max(self._virtual_time, start_tag)
+        self._n_in_flight += 1
+        self._model_in_flight[model] = self._model_in_flight.get(model, 0) + 1
+        IN_FLIGHT.set(self._model_in_flight[model], model=model)
+
+    def _release(self, model: str):
+        self._n_in_flight -= 1
+        self._model_in_flight[model] -= 1
+        IN_FLIGHT.set(self._model_in_flight[model], model=model)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._n_waiting > 0:
+            # waiter with the smallest start tag among models which have a free slot
+            best_model = None
+            for model, heap in list(self._waiting.items()):
+                while heap and heap[0][2].future.done():
+                    heapq.heappop(heap)  # cancelled while waiting
+                if not heap:
+                    del self._waiting[model]
+                elif self._has_capacity(model) and (best_model is None or heap[0] < self._waiting[best_model][0]):
+                    best_model = model
+            if best_model is None:
+                break
+
+            start_tag, _, waiter = heapq.heappop(self._waiting[best_model])
+            self._n_waiting -= 1
+            self._admit(start_tag, waiter.model)
+            waiter.future.set_result(None)
+
+        self._forget_idle_users()
+
+    def _forget_idle_users(self):
+        # a user whose finish tag is behind the virtual time starts at the virtual time anyway
+        if len(self._user_finish_tags) > 2 * (self._n_in_flight + self._n_waiting) + 1000:
+            self._user_finish_tags = {
+                user_id: finish_tag for user_id, finish_tag in self._user_finish_tags.items()
+                if finish_tag > self._virtual_time
+            }
@@ -0,0 +1,470 @@
+"""Online snapshots of the sqlite database, taken while the bot keeps writing to it.
+
+A generation starts with a full snapshot, copied with SQLite's online backup API from inside a read
+transaction: it is consistent, the writer is never blocked, and `pages_per_step` pages are copied at a time
+with a pause after every step, so the copy does not compete with request handling for disk I/O. Between full
+snapshots, deltas keep the WAL frames committed since the previous delta. So that no frame reaches the
+database file before it was copied, the bot's writer does not checkpoint while deltas are enabled: the job
+checkpoints after each delta, with a read transaction pinning the WAL at the frames it has copied. Only
+one process may run the job for a database, and no other process may checkpoint it: of several workers
+sharing the database, the one holding the lock file in the snapshot directory runs it.
+
+A generation is stored as <generation>.db, <generation>.<n>.delta files and the manifest <generation>.json,
+which lists them with their sha256 and is replaced atomically. A database is restored by copying the
+snapshot and writing the pages of its deltas into the copy, in order:
+
+    python3 bot/snapshots.py restore ./db/snapshots ./db/restored.db
+    python3 bot/snapshots.py verify ./db/snapshots
+"""
+import argparse
+import array
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+import coordination
+import metrics
+
+SNAPSHOTS = metrics.counter("bot_snapshots_total", "Database snapshots taken", ("kind", "status"))
+SNAPSHOT_BYTES = metrics.counter("bot_snapshot_bytes_total", "Bytes written to database snapshots", ("kind",))
+LAST_SNAPSHOT = metrics.gauge(
+    "bot_snapshot_last_success_timestamp_seconds", "Time of the last successful database snapshot", ("kind",)
+)
+
+_WAL_HEADER_SIZE = 32
+_WAL_FRAME_HEADER_SIZE = 24
+# magic number of the WAL header tells the byte order of its checksums
+_WAL_CHECKSUM_BYTE_ORDERS = {0x377f0682: "little", 0x377f0683: "big"}
+
+
+class ChainBrokenError(Exception):
+    """WAL frames were checkpointed by someone else before they were copied, a new full snapshot is needed."""
+
+
+def _wal_checksum(data: bytes, s0: int, s1: int, byte_order: str) -> tuple[int, int]:
+    values = array.array("I", data)
+    if byte_order != sys.byteorder:
+        values.byteswap()
+    for i in range(0, len(values), 2):
+        s0 = (s0 + values[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + values[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+
+def _read_wal_header(wal_path: Path) -> Optional[tuple[list[int], str, int]]:
+    """Salts, checksum byte order and page size of the WAL, None if there is no valid WAL."""
+    try:
+        with open(wal_path, "rb") as file:
+            header = file.read(_WAL_HEADER_SIZE)
+    except FileNotFoundError:
+        return None
+    if len(header) < _WAL_HEADER_SIZE:
+        return None
+    magic, _, page_size, _, salt1, salt2, checksum1, checksum2 = struct.unpack(">8I", header)
+    byte_order = _WAL_CHECKSUM_BYTE_ORDERS.get(magic)
+    if byte_order is None or _wal_checksum(header[:24], 0, 0, byte_order) != (checksum1, checksum2):
+        return None
+    return [salt1, salt2], byte_order, page_size
+
+
+def read_wal_frames(wal_path: Path, wal_state: dict) -> tuple[bytes, int, dict]:
+    """Committed WAL frames after the position in `wal_state`: (frames, number of frames, new state)."""
+    header = _read_wal_header(wal_path)
+    if header is None:
+        return b"", 0, wal_state
+    salts, byte_order, page_size = header
+
+    if salts == wal_state["salts"]:
+        n_frames_before = wal_state["frame"]
+        checksum = tuple(wal_state["checksum"])
+    elif wal_state["checkpointed"]:
+        # the WAL was restarted after all frames of the previous one were copied and checkpointed
+        n_frames_before = 0
+        with open(wal_path, "rb") as file:
+            checksum = _wal_checksum(file.read(24), 0, 0, byte_order)
+    else:
+        raise ChainBrokenError(f"WAL was restarted with frames which were not copied ({wal_path})")
+
+    frame_size = _WAL_FRAME_HEADER_SIZE + page_size
+    frames = bytearray()
+    n_frames = n_committed = n_frames_before
+    committed_checksum = checksum
+    with open(wal_path, "rb") as file:
+        file.seek(_WAL_HEADER_SIZE + n_frames_before * frame_size)
+        transaction = bytearray()
+        while len(frame := file.read(frame_size)) == frame_size:
+            _, db_size, salt1, salt2, checksum1, checksum2 = struct.unpack(">6I", frame[:_WAL_FRAME_HEADER_SIZE])
+            if [salt1, salt2] != salts:
+                break
+            checksum = _wal_checksum(frame[:8], *checksum, byte_order)
+            checksum = _wal_checksum(frame[_WAL_FRAME_HEADER_SIZE:], *checksum, byte_order)
+            if checksum != (checksum1, checksum2):
+                # a frame being written right now, or left over from an earlier use of the WAL
+                break
+            transaction += frame
+            n_frames += 1
+            if db_size != 0:
+                # frames of a transaction count once its commit frame is written
+                frames += transaction
+                transaction.clear()
+                n_committed, committed_checksum = n_frames, checksum
+
+    new_state = {
+        "salts": salts,
+        "frame": n_committed,
+        "checksum": list(committed_checksum),
+        "page_size": page_size,
+        "checkpointed": False
+    }
+    return bytes(frames), n_committed - n_frames_before, new_state
+
+
+def apply_wal_frames(file, frames: bytes, page_size: int):
+    """Writes the pages of the frames into an open database file, as a checkpoint would."""
+    frame_size = _WAL_FRAME_HEADER_SIZE + page_size
+    for offset in range(0, len(frames), frame_size):
+        page_number, db_size = struct.unpack(">2I", frames[offset:offset + 8])
+        file.seek((page_number - 1) * page_size)
+        file.write(frames[offset + _WAL_FRAME_HEADER_SIZE:offset + frame_size])
+        if db_size != 0:
+            file.truncate(db_size * page_size)
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_durably(path: Path, data: bytes):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_manifests(snapshot_dir: Path) -> list[dict]:
+    """Manifests of all generations, oldest first."""
+    manifests = []
+    for path in Path(snapshot_dir).glob("*.json"):
+        with open(path, "r", encoding="utf-8") as file:
+            manifests.append(json.load(file))
+    return sorted(manifests, key=lambda manifest: manifest["created_at"])
+
+
+class SnapshotJob:
+    def __init__(
+            self,
+            sqlite_path: str,
+            snapshot_dir: str,
+            snapshot_interval: float = 86400.0,
+            delta_interval: Optional[float] = 60.0,
+            keep_generations: int = 3,
+            pages_per_step: int = 256,
+            step_sleep: float = 0.01
+    ):
+        self.sqlite_path = Path(sqlite_path)
+        self.wal_path = Path(f"{sqlite_path}-wal")
+        self.snapshot_dir = Path(snapshot_dir)
+        self.snapshot_interval = snapshot_interval
+        self.delta_interval = delta_interval
+        self.keep_generations = keep_generations
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+
+        self._manifest: Optional[dict] = None
+        # a snapshot still running in its thread when the job is stopped must not overlap the last delta
+        self._lock = threading.Lock()
+        self._job_lock = coordination.JobLock(self.snapshot_dir / "snapshots.lock")
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> bool:
+        """Starts the job, unless another worker runs it already; returns whether it was started."""
+        if not self._job_lock.acquire():
+            logger.info(f"Database snapshots are taken by another worker, {self._job_lock.path} is locked")
+            return False
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        manifests = load_manifests(self.snapshot_dir)
+        if len(manifests) > 0 and self.delta_interval is not None:
+            # deltas of the latest generation are continued after a restart, if its chain is intact
+            self._manifest = manifests[-1]
+        self._task = asyncio.create_task(self._run_periodically())
+        return True
+
+    async def stop(self):
+        """Stops the job, with deltas enabled the WAL frames committed so far are copied first."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.delta_interval is not None and self._manifest is not None:
+            try:
+                await self._run("delta", self.take_delta)
+            except Exception as e:
+                logger.error(f"Failed to copy the last database changes: {e}")
+        self._job_lock.release()
+
+    def take_snapshot(self) -> str:
+        with self._lock:
+            generation = datetime.now().strftime("%Y%m%dT%H%M%S")
+            if (self.snapshot_dir / f"{generation}.json").exists():
+                generation = f"{generation}-{time.monotonic_ns()}"
+            snapshot_path = self.snapshot_dir / f"{generation}.db"
+            tmp_path = self.snapshot_dir / f"{generation}.db.tmp"
+            tmp_path.unlink(missing_ok=True)
+
+            source = sqlite3.connect(f"file:{self.sqlite_path}?mode=ro", uri=True, isolation_level=None,
+                                     check_same_thread=False)
+            try:
+                # the snapshot is the database as seen by this read transaction, writes go on meanwhile
+                source.execute("BEGIN")
+                source.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+                wal_header = _read_wal_header(self.wal_path)
+                with closing(sqlite3.connect(tmp_path)) as target:
+                    source.backup(
+                        target,
+                        pages=self.pages_per_step,
+                        progress=lambda status, remaining, total: time.sleep(self.step_sleep)
+                    )
+                    page_size = target.execute("PRAGMA page_size").fetchone()[0]
+                    check = target.execute("PRAGMA quick_check").fetchone()[0]
+                # frames checkpointed now are in the snapshot, the read transaction keeps later ones in the WAL
+                fully_checkpointed = self._checkpoint() if wal_header is not None else True
+            finally:
+                source.close()
+            if check != "ok":
+                tmp_path.unlink(missing_ok=True)
+                raise RuntimeError(f"Snapshot {generation} failed its check: {check}")
+            with open(tmp_path, "rb+") as file:
+                os.fsync(file.fileno())
+            os.replace(tmp_path, snapshot_path)
+
+            if wal_header is None:
+                wal_state = {"salts": None, "frame": 0, "checksum": None, "page_size": page_size, "checkpointed": True}
+            else:
+                # deltas start with the first frame of the current WAL, frames already in the snapshot are
+                # written again on restore, which leaves the same pages
+                salts, byte_order, _ = wal_header
+                with open(self.wal_path, "rb") as file:
+                    checksum = _wal_checksum(file.read(24), 0, 0, byte_order)
+                wal_state = {
+                    "salts": salts, "frame": 0, "checksum": list(checksum), "page_size": page_size,
+                    "checkpointed": fully_checkpointed
+                }
+            self._manifest = {
+                "generation": generation,
+                "created_at": time.time(),
+                "page_size": page_size,
+                "snapshot": {
+                    "file": snapshot_path.name,
+                    "sha256": _sha256(snapshot_path),
+                    "size": snapshot_path.stat().st_size
+                },
+                "deltas": [],
+                "wal": wal_state,
+            }
+            self._write_manifest()
+            self._remove_old_generations()
+            SNAPSHOT_BYTES.inc(snapshot_path.stat().st_size, kind="full")
+            return generation
+
+    def take_delta(self) -> int:
+        """Copies the WAL frames committed since the last delta, returns how many."""
+        with self._lock:
+            manifest = self._manifest
+            pin = sqlite3.connect(f"file:{self.sqlite_path}?mode=ro", uri=True, isolation_level=None,
+                                  check_same_thread=False)
+            try:
+                # the read transaction keeps the checkpoint below from going past the frames copied now
+                pin.execute("BEGIN")
+                pin.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+                frames, n_frames, wal_state = read_wal_frames(self.wal_path, manifest["wal"])
+                if n_frames > 0:
+                    n_delta = len(manifest["deltas"]) + 1
+                    delta_path = self.snapshot_dir / f"{manifest['generation']}.{n_delta:06d}.delta"
+                    _write_durably(delta_path, frames)
+                    manifest["deltas"].append({
+                        "file": delta_path.name,
+                        "sha256": hashlib.sha256(frames).hexdigest(),
+                        "frames": n_frames,
+                        "created_at": time.time(),
+                    })
+                    SNAPSHOT_BYTES.inc(len(frames), kind="delta")
+
+                # once everything copied is also checkpointed, the writer may start the WAL over
+                wal_state["checkpointed"] = self._checkpoint(wal_state["frame"])
+            finally:
+                pin.close()
+
+            manifest["wal"] = wal_state
+            self._write_manifest()
+            return n_frames
+
+    def _checkpoint(self, n_frames_copied: Optional[int] = None) -> bool:
+        """Checkpoints the WAL, returns True if all of its frames (and no more than were copied) are checkpointed."""
+        with closing(sqlite3.connect(self.sqlite_path, isolation_level=None)) as checkpointer:
+            _, n_wal_frames, n_checkpointed = checkpointer.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        return n_wal_frames == n_checkpointed and (n_frames_copied is None or n_wal_frames == n_frames_copied)
+
+    async def _run(self, kind: str, func):
+        try:
+            result = await asyncio.to_thread(func)
+        except Exception:
+            SNAPSHOTS.inc(kind=kind, status="error")
+            raise
+        SNAPSHOTS.inc(kind=kind, status="ok")
+        LAST_SNAPSHOT.set(time.time(), kind=kind)
+        return result
+
+    async def _run_periodically(self):
+        while True:
+            try:
+                if (
+                        self._manifest is None
+                        or time.time() - self._manifest["created_at"] >= self.snapshot_interval
+                ):
+                    generation = await self._run("full", self.take_snapshot)
+                    logger.info(f"Took database snapshot {generation}")
+                elif self.delta_interval is not None:
+                    try:
+                        await self._run("delta", self.take_delta)
+                    except ChainBrokenError as e:
+                        logger.warning(f"{e}, taking a new full snapshot")
+                        self._manifest = None
+                        continue
+            except Exception as e:
+                logger.error(f"Failed to snapshot the database: {e}")
+            await asyncio.sleep(self.delta_interval if self.delta_interval is not None else self.snapshot_interval)
+
+    def _write_manifest(self):
+        manifest = self._manifest
+        _write_durably(
+            self.snapshot_dir / f"{manifest['generation']}.json",
+            json.dumps(manifest, indent=2).encode("utf-8")
+        )
+
+    def _remove_old_generations(self):
+        for manifest in load_manifests(self.snapshot_dir)[:-self.keep_generations]:
+            for path in self.snapshot_dir.glob(f"{manifest['generation']}.*"):
+                path.unlink()
+
+
+def restore(snapshot_dir: Path, target_path: Path, generation: Optional[str] = None,
+            until: Optional[float] = None) -> tuple[dict, int]:
+    """Restores a generation (the latest one by default) with its deltas created up to `until`.
+
+    Returns the manifest of the generation and the number of deltas applied.
+    """
+    manifests = load_manifests(snapshot_dir)
+    if generation is not None:
+        manifests = [manifest for manifest in manifests if manifest["generation"] == generation]
+    if len(manifests) == 0:
+        raise ValueError(f"No snapshot {generation or ''} in {snapshot_dir}")
+    manifest = manifests[-1]
+
+    snapshot_path = Path(snapshot_dir) / manifest["snapshot"]["file"]
+    if _sha256(snapshot_path) != manifest["snapshot"]["sha256"]:
+        raise ValueError(f"Snapshot {snapshot_path} does not match its checksum")
+
+    tmp_path = target_path.with_name(target_path.name + ".tmp")
+    with open(snapshot_path, "rb") as source, open(tmp_path, "wb") as target:
+        while chunk := source.read(1024 * 1024):
+            target.write(chunk)
+
+    n_deltas = 0
+    with open(tmp_path, "rb+") as file:
+        for delta in manifest["deltas"]:
+            if until is not None and delta["created_at"] > until:
+                break
+            with open(Path(snapshot_dir) / delta["file"], "rb") as delta_file:
+                frames = delta_file.read()
+            if hashlib.sha256(frames).hexdigest() != delta["sha256"]:
+                raise ValueError(f"Delta {delta['file']} does not match its checksum")
+            apply_wal_frames(file, frames, manifest["page_size"])
+            n_deltas += 1
+        file.flush()
+        os.fsync(file.fileno())
+
+    with closing(sqlite3.connect(tmp_path)) as db_conn:
+        check = db_conn.execute("PRAGMA integrity_check").fetchone()[0]
+    if check != "ok":
+        tmp_path.unlink()
+        raise ValueError(f"Restored database failed its integrity check: {check}")
+    os.replace(tmp_path, target_path)
+    return manifest, n_deltas
+
+
+def verify(snapshot_dir: Path) -> list[str]:
+    """Checks the files of every generation against their checksums and restores the latest one."""
+    problems = []
+    manifests = load_manifests(snapshot_dir)
+    if len(manifests) == 0:
+        return [f"No snapshots in {snapshot_dir}"]
+
+    for manifest in manifests:
+        files = [manifest["snapshot"], *manifest["deltas"]]
+        for file in files:
+            path = Path(snapshot_dir) / file["file"]
+            if not path.exists():
+                problems.append(f"{file['file']} is missing")
+            elif _sha256(path) != file["sha256"]:
+                problems.append(f"{file['file']} does not match its checksum")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            restore(snapshot_dir, Path(tmp_dir) / "verify.db")
+        except (OSError, ValueError, sqlite3.Error) as e:
+            problems.append(f"Generation {manifests[-1]['generation']} cannot be restored: {e}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore or verify snapshots of the bot sqlite database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    restore_parser = subparsers.add_parser("restore", help="restore a database from its snapshots")
+    restore_parser.add_argument("snapshot_dir", help="directory of the snapshots")
+    restore_parser.add_argument("target_path", help="path of the restored database file, must not exist")
+    restore_parser.add_argument("--generation", help="generation to restore, the latest one by default")
+    restore_parser.add_argument("--until", help="apply deltas created up to this time, e.g. 2024-05-01T12:00")
+
+    verify_parser = subparsers.add_parser("verify", help="check checksums and restore the latest generation")
+    verify_parser.add_argument("snapshot_dir", help="directory of the snapshots")
+    args = parser.parse_args()
+
+    if args.command == "restore":
+        target_path = Path(args.target_path)
+        if target_path.exists():
+            parser.error(f"{target_path} already exists")
+        until = datetime.fromisoformat(args.until).timestamp() if args.until is not None else None
+        manifest, n_deltas = restore(Path(args.snapshot_dir), target_path, args.generation, until)
+        print(f"Restored generation {manifest['generation']} with {n_deltas} of "
+              f"{len(manifest['deltas'])} deltas to {target_path}")
+    else:
+        problems = verify(Path(args.snapshot_dir))
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("All snapshots are intact")
+
+
+if __name__ == "__main__":
+    main()
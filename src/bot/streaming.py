@@ -0,0 +1,217 @@
+"""Rendering of streamed answers into a Telegram message with a bounded number of edits."""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from loguru import logger
+
+import formatting
+import metrics
+
+EDITS_PER_ANSWER = metrics.histogram(
+    "bot_stream_edits_per_answer", "Telegram edits made to render one streamed answer",
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+TIME_TO_FIRST_RENDER = metrics.histogram(
+    "bot_stream_time_to_first_render_seconds", "Time from stream start until the first frame is shown"
+)
+TIME_TO_FINAL_RENDER = metrics.histogram(
+    "bot_stream_time_to_final_render_seconds", "Time from stream start until the final frame is shown"
+)
+# room left in a page for tags which are closed and reopened around it
+_PAGE_MARKUP_RESERVE = 96
+
+SKIPPED_FRAMES = metrics.counter(
+    "bot_stream_skipped_frames_total", "Intermediate frames which were never rendered because edits fell behind"
+)
+
+
+class EditBudget:
+    """Edit budget shared by all streams of the bot.
+
+    Every chat gets at most one edit per `chat_interval` seconds, and the whole bot at most `global_rate`
+    edits per second (token bucket), which keeps streaming edits under Telegram flood limits.
+    """
+
+    def __init__(self, chat_interval: float = 1.0, global_rate: float = 20.0, global_burst: int = 20):
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+
+        self._tokens = float(global_burst)
+        self._tokens_updated_at = time.monotonic()
+        self._chat_next_edit_at: dict[int, float] = {}
+
+    def delay(self, chat_id: int) -> float:
+        """Seconds to wait until an edit of the chat fits into the budget."""
+        now = time.monotonic()
+        self._refill(now)
+        chat_delay = max(0.0, self._chat_next_edit_at.get(chat_id, 0.0) - now)
+        global_delay = max(0.0, (1 - self._tokens) / self.global_rate)
+        return max(chat_delay, global_delay)
+
+    def consume(self, chat_id: int):
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        self._chat_next_edit_at[chat_id] = now + self.chat_interval
+
+        # forget chats which are allowed to edit anyway
+        if len(self._chat_next_edit_at) > 10000:
+            self._chat_next_edit_at = {
+                chat: next_edit_at for chat, next_edit_at in self._chat_next_edit_at.items() if next_edit_at > now
+            }
+
+    def _refill(self, now: float):
+        self._tokens = min(self.global_burst, self._tokens + (now - self._tokens_updated_at) * self.global_rate)
+        self._tokens_updated_at = now
+
+
+class AnswerBuffer:
+    """Text of a streamed answer kept as the list of its deltas, joined only when it is read."""
+
+    def __init__(self):
+        self.version = 0
+        self._chunks: list[str] = []
+
+    def append(self, text: str):
+        if text:
+            self._chunks.append(text)
+            self.version += 1
+
+    def text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+
+class StreamRenderer:
+    """Shows the latest state of a streamed answer.
+
+    `update` only remembers that the answer changed, a background task reads and renders it whenever the
+    edit budget allows, so frames which arrive while waiting are never even joined into a string.
+    `finish` renders the final text right away.
+    """
+
+    def __init__(self, render: Callable[[str, bool], Awaitable[None]], chat_id: int, budget: EditBudget):
+        self.render = render
+        self.chat_id = chat_id
+        self.budget = budget
+
+        self.n_edits = 0
+        self.started_at = time.monotonic()
+
+        self._answer: Optional[AnswerBuffer] = None
+        self._answer_version = 0
+        self._rendered_text = ""
+        self._n_updates_since_render = 0
+        self._updated = asyncio.Event()
+        self._render_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, answer: AnswerBuffer):
+        if answer is self._answer and answer.version == self._answer_version:
+            return
+        self._answer = answer
+        self._answer_version = answer.version
+        self._n_updates_since_render += 1
+        self._updated.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._render_loop())
+
+    async def finish(self, text: str):
+        if self._task is not None:
+            # an edit which is already in flight is completed, so it can not overwrite the final frame
+            async with self._render_lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        if text != self._rendered_text:
+            # the final frame does not wait for the budget, but still takes its share of it
+            self.budget.consume(self.chat_id)
+            await self._render(text, final=True)
+
+        EDITS_PER_ANSWER.observe(self.n_edits)
+        TIME_TO_FINAL_RENDER.observe(time.monotonic() - self.started_at)
+
+    def cancel(self):
+        """Stops rendering without showing anything else, e.g. when the stream failed."""
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _render_loop(self):
+        while True:
+            await self._updated.wait()
+
+            delay = self.budget.delay(self.chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # budget might be taken by another stream meanwhile
+
+            self._updated.clear()
+            self.budget.consume(self.chat_id)
+            try:
+                async with self._render_lock:
+                    await self._render(self._answer.text(), final=False)
+            except Exception as e:
+                logger.warning(f"Failed to render intermediate frame: {e}")
+
+    async def _render(self, text: str, final: bool):
+        if self._n_updates_since_render > 1:
+            SKIPPED_FRAMES.inc(self._n_updates_since_render - 1)
+        self._n_updates_since_render = 0
+
+        await self.render(text, final)
+        if self.n_edits == 0:
+            TIME_TO_FIRST_RENDER.observe(time.monotonic() - self.started_at)
+        self.n_edits += 1
+        self._rendered_text = text
+
+
+class MessagePager:
+    """Spreads a growing text over as many messages as needed.
+
+    Once the current message is full, the text rolls over to a new message. Pages before the last one
+    are edited only once more, to their final content, and never re-sent. Every page is rendered through
+    a FormattingTracker, so it parses on its own even in the middle of a code block or a tag.
+    """
+
+    def __init__(
+            self,
+            edit_page: Callable[[Any, str], Awaitable[None]],
+            send_page: Callable[[str], Awaitable[Any]],
+            first_message: Any,
+            parse_mode: Optional[str] = None,
+            page_size: int = formatting.TELEGRAM_MESSAGE_LIMIT - _PAGE_MARKUP_RESERVE
+    ):
+        self.edit_page = edit_page
+        self.send_page = send_page
+        self.parse_mode = parse_mode
+        self.page_size = page_size
+
+        self.messages = [first_message]
+        self._rendered_pages = [""]
+        self._tracker = formatting.FormattingTracker(parse_mode)
+
+    async def render(self, text: str, final: bool = False):
+        self._tracker.feed(text)
+
+        pages = []
+        page_start = 0
+        for chunk in formatting.split_text_into_chunks(text, self.page_size, self.parse_mode):
+            pages.append(self._tracker.frame(page_start, page_start + len(chunk), final=final))
+            page_start += len(chunk)
+
+        for i, page in enumerate(pages):
+            if page.strip() == "":
+                break  # nothing to show yet, Telegram does not accept empty messages
+            if i < len(self.messages):
+                if page != self._rendered_pages[i]:
+                    await self.edit_page(self.messages[i], page)
+                    self._rendered_pages[i] = page
+            else:
+                self.messages.append(await self.send_page(page))
+                self._rendered_pages.append(page)
@@ -0,0 +1,123 @@
+"""Rolling summaries of long dialogs.
+
+Once the messages of a dialog which are not summarized yet take more than `threshold_tokens`, all but the
+last `keep_messages` of them are folded into the summary stored on the dialog. This runs in a background
+task after the answer was sent, so it never delays one. Prompts then carry the summary instead of the
+folded messages, which keeps their size flat however long the dialog gets.
+"""
+import asyncio
+import time
+from typing import Optional
+
+from loguru import logger
+
+import chatgpt
+import metrics
+import tokens
+
+SUMMARIES = metrics.counter("bot_dialog_summaries_total", "Dialog summarization runs", ("status",))
+SUMMARY_DURATION = metrics.histogram("bot_dialog_summary_seconds", "Time to fold dialog messages into a summary")
+
+
+def unsummarized(dialog_messages: list[dict], dialog_summary: Optional[dict]) -> list[dict]:
+    """Dialog messages which are not part of the summary yet."""
+    if dialog_summary is None:
+        return dialog_messages
+    return [
+        dialog_message for dialog_message in dialog_messages
+        if dialog_message.get("id") is None or dialog_message["id"] > dialog_summary["until_id"]
+    ]
+
+
+def count_tokens(dialog_messages: list[dict]) -> int:
+    return sum(
+        dialog_message.get("n_tokens")
+        or tokens.count_dialog_message_tokens(dialog_message, tokens.STORED_COUNTS_MODEL)
+        for dialog_message in dialog_messages
+    )
+
+
+class DialogSummarizer:
+    def __init__(
+            self,
+            db,
+            completion_scheduler,
+            threshold_tokens: Optional[int] = None,
+            keep_messages: int = 4,
+            max_tokens: int = 500,
+            max_concurrency: int = 4
+    ):
+        self.db = db
+        self.completion_scheduler = completion_scheduler
+        self.threshold_tokens = threshold_tokens
+        self.keep_messages = keep_messages
+        self.max_tokens = max_tokens
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_tokens is not None
+
+    def maybe_schedule(self, user_id: int, dialog_id: str, dialog_messages: list[dict]):
+        """Starts summarizing the dialog in the background if its unsummarized messages got too long."""
+        if (
+                not self.enabled
+                or dialog_id in self._tasks
+                or len(dialog_messages) <= self.keep_messages
+                or count_tokens(dialog_messages) <= self.threshold_tokens
+        ):
+            return
+
+        task = asyncio.create_task(self._summarize(user_id, dialog_id))
+        self._tasks[dialog_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(dialog_id, None))
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _summarize(self, user_id: int, dialog_id: str):
+        async with self._semaphore:
+            try:
+                # a transcript too long for the backend is folded in several passes, oldest messages first
+                while await self._fold(user_id, dialog_id):
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                SUMMARIES.inc(status="error")
+                logger.warning(f"Failed to summarize dialog {dialog_id}: {e}")
+
+    async def _fold(self, user_id: int, dialog_id: str) -> bool:
+        """Folds dialog messages into the summary once, returns whether some are left to fold."""
+        started_at = time.monotonic()
+        dialog_summary = await self.db.get_dialog_summary(user_id, dialog_id)
+        dialog_messages = unsummarized(
+            await self.db.get_dialog_messages(user_id, dialog_id=dialog_id), dialog_summary
+        )
+        folded_messages = dialog_messages[:len(dialog_messages) - self.keep_messages]
+        if len(folded_messages) == 0:
+            return False
+
+        chatgpt_instance = chatgpt.ChatGPT()
+        async with self.completion_scheduler.slot(user_id, chatgpt_instance.routed_model()):
+            summary, n_folded = await chatgpt_instance.summarize(
+                folded_messages,
+                previous_summary=dialog_summary["summary"] if dialog_summary is not None else None,
+                max_tokens=self.max_tokens
+            )
+        if not summary:
+            raise ValueError("Backend returned an empty summary")
+
+        stored = await self.db.set_dialog_summary(
+            dialog_id,
+            summary,
+            folded_messages[n_folded - 1]["id"],
+            previous_until_id=dialog_summary["until_id"] if dialog_summary is not None else None
+        )
+        SUMMARIES.inc(status="ok" if stored else "conflict")
+        SUMMARY_DURATION.observe(time.monotonic() - started_at)
+        return stored and n_folded < len(folded_messages)
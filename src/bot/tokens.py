@@ -0,0 +1,68 @@
+"""Local token counting for prompt building, so the context is trimmed before a request is sent."""
+import functools
+import math
+
+import tiktoken
+from loguru import logger
+
+# context window sizes of known models, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# tokenizer of this model is used for token counts stored with dialog messages
+STORED_COUNTS_MODEL = "gpt-4-turbo"
+
+# every chat message is wrapped into a few service tokens, and the reply is primed with a few more
+# (see https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# conservative estimate used when the tokenizer can not be loaded (e.g. no access to the encodings storage)
+_APPROXIMATE_CHARS_PER_TOKEN = 3
+
+
+def get_context_window(model: str) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding | None:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return get_encoding("gpt-4")
+    except Exception as e:
+        logger.warning(f"Failed to load tokenizer for {model}, token counts will be approximate: {e}")
+        return None
+
+
+def has_same_tokenizer(model: str, other_model: str) -> bool:
+    return get_encoding(model) is get_encoding(other_model)
+
+
+@functools.lru_cache(maxsize=4096)
+def count_text_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / _APPROXIMATE_CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: dict[str, str], model: str) -> int:
+    return TOKENS_PER_MESSAGE + sum(count_text_tokens(value, model) for value in message.values())
+
+
+def count_dialog_message_tokens(dialog_message: dict, model: str) -> int:
+    """Tokens taken by a stored user/bot exchange once it is turned into two chat messages."""
+    return (
+        2 * TOKENS_PER_MESSAGE
+        + count_text_tokens("user", model) + count_text_tokens(dialog_message["user"] or "", model)
+        + count_text_tokens("assistant", model) + count_text_tokens(dialog_message["bot"] or "", model)
+    )
@@ -0,0 +1,75 @@
+"""Per-update tracing: how long every stage of answering a message takes.
+
+A span records its duration into one histogram, labelled with the stage, the chat mode and the
+completion backend of the update being handled, and whether the stage succeeded. Chat mode and backend
+are context labels: they are set once per update and picked up by every span recorded in its task.
+"""
+import asyncio
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+import metrics
+
+SPAN_DURATION = metrics.histogram(
+    "bot_span_duration_seconds", "Duration of a stage of handling an update",
+    ("span", "chat_mode", "backend", "status")
+)
+
+_context_labels: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "tracing_labels", default={"chat_mode": "", "backend": ""}
+)
+
+
+def set_labels(**labels: str):
+    """Sets context labels for the spans recorded from now on in the current task."""
+    _context_labels.set({**_context_labels.get(), **labels})
+
+
+def observe(name: str, seconds: float, status: str = "ok"):
+    SPAN_DURATION.observe(seconds, span=name, status=status, **_context_labels.get())
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        # labels set inside the span, e.g. the backend chosen for a completion, are included
+        observe(name, time.perf_counter() - started_at, status)
+
+
+def traced(name: str):
+    """Records every call of the decorated function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def traced_async(name: str):
+    """Records every call of the decorated coroutine function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import metrics
+
+REQUESTS = metrics.counter("bot_user_cache_requests_total", "User record lookups in the user cache", ("result",))
+EVICTIONS = metrics.counter("bot_user_cache_evictions_total", "User records evicted from the user cache")
+SIZE = metrics.gauge("bot_user_cache_size", "User records kept in the user cache")
+
+
+class _CachedUser:
+    __slots__ = ("record", "loaded_at")
+
+    def __init__(self, record: dict, loaded_at: float):
+        self.record = record
+        self.loaded_at = loaded_at
+
+
+class UserCache:
+    """In-process cache of `users` rows.
+
+    Records are evicted in LRU order once `max_size` is reached and reloaded after `ttl` seconds.
+    The cache never writes anything itself, the owner keeps the database in sync with `update`.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[int, _CachedUser] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        SIZE.set_function(lambda: len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            REQUESTS.inc(result="miss")
+            return None
+
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            self._evict(user_id)
+            self.misses += 1
+            REQUESTS.inc(result="miss")
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        REQUESTS.inc(result="hit")
+        return entry.record
+
+    def put(self, user_id: int, record: dict) -> dict:
+        entry = _CachedUser(dict(record), time.monotonic())
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_size:
+            self._evict(next(iter(self._entries)))
+
+        return entry.record
+
+    def update(self, user_id: int, values: dict[str, Any]):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.record.update(values)
+
+    def invalidate(self, user_id: int):
+        if user_id in self._entries:
+            self._evict(user_id)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self, user_id: int):
+        del self._entries[user_id]
+        self.evictions += 1
+        EVICTIONS.inc()
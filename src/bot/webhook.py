@@ -0,0 +1,91 @@
+"""Serving updates through a Telegram webhook instead of long polling.
+
+Telegram posts every update to an aiohttp server running in the same process as the handlers. The update
+is acknowledged right away and handled by the application in the background, so several bot workers can
+run behind one load balancer.
+"""
+import asyncio
+import hmac
+import signal
+
+from aiohttp import web
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def check_webhook_config(url: str | None, secret_token: str | None):
+    """Raises ValueError unless the webhook has a url and a secret token.
+
+    Without the token anyone who can reach the port could post updates in the name of any user.
+    """
+    if not url:
+        raise ValueError("telegram_webhook_url is required in webhook mode")
+    if not secret_token:
+        raise ValueError("telegram_webhook_secret_token is required in webhook mode")
+
+
+def create_webhook_app(application: Application, path: str, secret_token: str) -> web.Application:
+    if not secret_token:
+        raise ValueError("A webhook secret token is required")
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+                request.headers.get(SECRET_TOKEN_HEADER, "").encode("utf-8"), secret_token.encode("utf-8")
+        ):
+            logger.warning("Rejected webhook request with a wrong secret token from {}", request.remote)
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # not json, or json which is not an update
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+
+        # acknowledged before it is handled, Telegram does not wait for the answer
+        application.update_queue.put_nowait(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def run_webhook(
+        application: Application,
+        url: str,
+        listen: str = "0.0.0.0",
+        port: int = 8443,
+        path: str = "/telegram",
+        secret_token: str | None = None
+):
+    """Runs the application until SIGINT or SIGTERM, the lifecycle `run_polling` would otherwise manage."""
+    check_webhook_config(url, secret_token)
+    runner = web.AppRunner(create_webhook_app(application, path, secret_token), access_log=None)
+    await runner.setup()
+
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await web.TCPSite(runner, listen, port).start()
+        await application.bot.set_webhook(url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        logger.info("Receiving updates on {}:{}{} through webhook {}", listen, port, path, url)
+
+        stop_requested = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stop_requested.set)
+        await stop_requested.wait()
+    finally:
+        # the webhook is kept, other workers behind the same url keep receiving updates
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# modules of the bot import each other by their plain names
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "bot"))
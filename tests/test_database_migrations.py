@@ -0,0 +1,59 @@
+import multiprocessing
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+pytest.importorskip("loguru")
+pytest.importorskip("tiktoken")
+
+import database_migrations  # noqa: E402
+
+
+def _migrate_file(path: str):
+    with closing(sqlite3.connect(path, timeout=30.0)) as db_conn:
+        database_migrations.migrate(db_conn)
+
+
+def test_migrate_twice_on_one_connection(tmp_path):
+    with closing(sqlite3.connect(tmp_path / "sqlite.db")) as db_conn:
+        assert database_migrations.migrate(db_conn) == (0, database_migrations.SCHEMA_VERSION)
+        assert database_migrations.migrate(db_conn) == (
+            database_migrations.SCHEMA_VERSION, database_migrations.SCHEMA_VERSION
+        )
+
+
+def test_migrate_with_stale_version(tmp_path, monkeypatch):
+    path = tmp_path / "sqlite.db"
+    _migrate_file(str(path))
+
+    # as seen by a process which read the version before another one migrated the database
+    monkeypatch.setattr(database_migrations, "get_schema_version", _stale_then_real(0))
+    with closing(sqlite3.connect(path)) as db_conn:
+        database_migrations.migrate(db_conn)
+        assert db_conn.execute("PRAGMA user_version").fetchone()[0] == database_migrations.SCHEMA_VERSION
+
+
+def _stale_then_real(stale_version: int):
+    real = database_migrations.get_schema_version
+    calls = []
+
+    def get_schema_version(db_conn):
+        calls.append(None)
+        return stale_version if len(calls) == 1 else real(db_conn)
+
+    return get_schema_version
+
+
+@pytest.mark.parametrize("attempt", range(3))
+def test_concurrent_processes_migrate_once(tmp_path, attempt):
+    path = str(tmp_path / "sqlite.db")
+    processes = [multiprocessing.Process(target=_migrate_file, args=(path,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+
+    with closing(sqlite3.connect(path)) as db_conn:
+        assert database_migrations.get_schema_version(db_conn) == database_migrations.SCHEMA_VERSION
@@ -0,0 +1,188 @@
+import re
+from itertools import accumulate
+
+import pytest
+
+from formatting import FormattingTracker, split_text_into_chunks
+
+# answers as they were streamed by the backend, one delta per item
+HTML_STREAM = [
+    "Here", " is", " a", " <", "b>short", "</b", "> example", " of", " <i>it", "alic &", "amp;", " <", "code",
+    ">inline code</co", "de></i>:\n\n", "<pre", "><code class=\"language-python\">", "def f(x):\n",
+    "    return x &l", "t; 3\n", "</code></", "pre>\n", "And <a href=\"https://", "example.com\">a link</a>",
+    " with <tg-spoiler>a spo", "iler</tg-spoiler>."
+]
+MARKDOWN_STREAM = [
+    "Sure", "! Here", " is *", "bold*", " and _it", "alic_ text", ", some `in", "line` code", " and a [li",
+    "nk](https://exa", "mple.com)", ".\n\n", "``", "`python\n", "def f(x):\n", "    return x * 2",
+    "  # *not* bold\n", "`", "``\n", "Escaped \\", "* star", " and ", "2*3=6", "."
+]
+
+
+def _html_tokens(text: str):
+    for match in re.finditer(r"<[^<>]*>|&[^&;\s]*;?|[<>&]", text):
+        yield match.group()
+
+
+def assert_balanced_html(text: str):
+    stack = []
+    for token in _html_tokens(text):
+        if token in ("<", ">"):
+            raise AssertionError(f"Unmatched angle bracket in {text!r}")
+        if token.startswith("&"):
+            assert re.fullmatch(r"&(#\d+|[a-z]+);", token), f"Incomplete entity {token!r} in {text!r}"
+        elif token.startswith("</"):
+            name = token[2:-1].strip()
+            assert stack and stack[-1] == name, f"Unexpected closing tag {token!r} in {text!r}"
+            stack.pop()
+        else:
+            stack.append(token[1:-1].split(maxsplit=1)[0])
+    assert not stack, f"Unclosed tags {stack} in {text!r}"
+
+
+def assert_balanced_markdown(text: str):
+    """Parses text the way Telegram parses legacy markdown and fails on anything left open."""
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text) and text[i + 1] in "`*_[":
+            i += 2
+        elif text.startswith("```", i):
+            end = text.find("```", i + 3)
+            assert end != -1, f"Unclosed code block in {text!r}"
+            i = end + 3
+        elif char in "`*_":
+            end = text.find(char, i + 1)
+            assert end != -1, f"Unclosed {char} in {text!r}"
+            i = end + 1
+        elif char == "[":
+            # a bracket without a url is plain text, but Telegram needs the closing one
+            link_text_end = text.find("]", i + 1)
+            assert link_text_end != -1, f"Unclosed [ in {text!r}"
+            i = link_text_end + 1
+            if text.startswith("(", i):
+                url_end = text.find(")", i)
+                assert url_end != -1, f"Incomplete link url in {text!r}"
+                i = url_end + 1
+        else:
+            i += 1
+
+
+BALANCED = {"html": assert_balanced_html, "markdown": assert_balanced_markdown}
+
+
+def replay(parse_mode: str, deltas: list[str]) -> list[str]:
+    tracker = FormattingTracker(parse_mode)
+    frames = []
+    for text in accumulate(deltas):
+        tracker.feed(text)
+        frames.append(tracker.frame())
+    frames.append(tracker.frame(final=True))
+    return frames
+
+
+@pytest.mark.parametrize("parse_mode, deltas", [("html", HTML_STREAM), ("markdown", MARKDOWN_STREAM)])
+def test_every_frame_is_balanced(parse_mode, deltas):
+    for frame in replay(parse_mode, deltas):
+        BALANCED[parse_mode](frame)
+
+
+@pytest.mark.parametrize("parse_mode, deltas", [("html", HTML_STREAM), ("markdown", MARKDOWN_STREAM)])
+def test_frames_grow_with_the_stream(parse_mode, deltas):
+    tracker = FormattingTracker(parse_mode)
+    shown = 0
+    for text in accumulate(deltas):
+        tracker.feed(text)
+        tracker.frame()
+        assert tracker.position >= shown
+        shown = tracker.position
+    assert shown == len("".join(deltas))
+
+
+def test_html_final_frame_is_the_answer():
+    answer = "".join(HTML_STREAM)
+    assert replay("html", HTML_STREAM)[-1] == answer
+
+
+def test_html_frame_cuts_incomplete_tag_and_entity():
+    tracker = FormattingTracker("html")
+    tracker.feed("<b>bold</b> &am")
+    assert tracker.frame() == "<b>bold</b> "
+    tracker.feed("<b>bold</b> &amp; <co")
+    assert tracker.frame() == "<b>bold</b> &amp; "
+
+
+def test_html_intermediate_frame_closes_open_tags():
+    tracker = FormattingTracker("html")
+    tracker.feed("<b>bold <i>and ital")
+    assert tracker.frame() == "<b>bold <i>and ital</i></b>"
+
+
+def test_markdown_intermediate_frame_closes_open_entities():
+    tracker = FormattingTracker("markdown")
+    tracker.feed("*bold* and ```python\nprint(1)")
+    assert tracker.frame() == "*bold* and ```python\nprint(1)```"
+
+
+def test_markdown_final_frame_escapes_stray_markers():
+    frames = replay("markdown", ["2*3", "=6 and snake", "_case with `code`"])
+    assert frames[-2] == "2*3=6 and snake_case with `code`*"
+    assert frames[-1] == "2\\*3=6 and snake\\_case with `code`"
+    assert_balanced_markdown(frames[-1])
+
+
+def test_markdown_final_frame_escapes_unfinished_tokens():
+    frames = replay("markdown", ["see [the docs", " and ``"])
+    assert frames[-1] == "see \\[the docs and \\`\\`"
+    assert_balanced_markdown(frames[-1])
+
+
+def test_markdown_final_frame_closes_cut_off_code_block():
+    assert replay("markdown", ["```python\n", "print(2*3)"])[-1] == "```python\nprint(2*3)```"
+
+
+def test_markdown_matched_markers_are_kept_on_final_frame():
+    answer = "".join(MARKDOWN_STREAM)
+    final = replay("markdown", MARKDOWN_STREAM)[-1]
+    assert final.replace("2\\*3=6", "2*3=6") == answer
+
+
+def test_markdown_stream_growing_after_final_frame_is_rescanned():
+    tracker = FormattingTracker("markdown")
+    tracker.feed("*bold")
+    assert tracker.frame(final=True) == "\\*bold"
+    tracker.feed("*bold*")
+    assert tracker.frame(final=True) == "*bold*"
+
+
+MARKUP = {
+    "html": re.compile(r"<[^<>]*>|&[^&;\s]*;"),
+    "markdown": re.compile(r"\[[^\]\n]*\]\([^)\s]*\)|\\."),
+}
+
+
+# chunks are at least as long as the longest tag or link of the streams, as Telegram messages always are
+@pytest.mark.parametrize("parse_mode, deltas", [("html", HTML_STREAM), ("markdown", MARKDOWN_STREAM)])
+@pytest.mark.parametrize("chunk_size", [40, 57, 64, 100])
+def test_chunks_do_not_split_tags_or_entities(parse_mode, deltas, chunk_size):
+    text = "".join(deltas) * 3
+    chunks = list(split_text_into_chunks(text, chunk_size, parse_mode))
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+
+    boundaries = list(accumulate(len(chunk) for chunk in chunks))[:-1]
+    for match in MARKUP[parse_mode].finditer(text):
+        assert not any(match.start() < boundary < match.end() for boundary in boundaries), match.group()
+
+
+@pytest.mark.parametrize("parse_mode, deltas", [("html", HTML_STREAM), ("markdown", MARKDOWN_STREAM)])
+@pytest.mark.parametrize("chunk_size", [40, 57, 100])
+def test_paged_frames_are_balanced(parse_mode, deltas, chunk_size):
+    tracker = FormattingTracker(parse_mode)
+    for i, text in enumerate(accumulate(deltas), start=1):
+        tracker.feed(text)
+        final = i == len(deltas)
+        page_start = 0
+        for chunk in split_text_into_chunks(text, chunk_size, parse_mode):
+            BALANCED[parse_mode](tracker.frame(page_start, page_start + len(chunk), final=final))
+            page_start += len(chunk)